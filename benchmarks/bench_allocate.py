@@ -0,0 +1,47 @@
+# pylint: disable=protected-access
+import time
+from datetime import date, timedelta
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(num_batches, sku="BENCH-SKU"):
+    start = date(2011, 1, 1)
+    batches = [
+        Batch(f"batch-{i}", sku, qty=1000, eta=start + timedelta(days=i % 365))
+        for i in reversed(range(num_batches))
+    ]
+    return Product(sku, batches)
+
+
+def sort_per_call_allocate(product, line):
+    # the pre-index algorithm, kept as a reference point
+    batch = next(
+        b
+        for b in sorted(product.batches)
+        if b.sku == line.sku
+        and b._purchased_quantity - sum(l.qty for l in b._allocations) >= line.qty
+    )
+    batch._allocations.add(line)
+    return batch.reference
+
+
+def time_allocations(allocate, num_batches, num_lines):
+    product = make_product(num_batches)
+    lines = [OrderLine(f"order-{i}", product.sku, 1) for i in range(num_lines)]
+    start = time.perf_counter()
+    for line in lines:
+        allocate(product, line)
+    return (time.perf_counter() - start) / num_lines
+
+
+def main():
+    num_lines = 2000
+    print(f"{'batches':>8} {'indexed us/line':>16} {'sort-per-call us/line':>22}")
+    for num_batches in [10, 100, 500, 1000]:
+        indexed = time_allocations(Product.allocate, num_batches, num_lines)
+        naive = time_allocations(sort_per_call_allocate, num_batches, num_lines)
+        print(f"{num_batches:>8} {indexed * 1e6:>16.1f} {naive * 1e6:>22.1f}")
+
+
+if __name__ == "__main__":
+    main()
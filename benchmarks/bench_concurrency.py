@@ -0,0 +1,90 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus, unit_of_work
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, *_):
+        with self._lock:
+            self.value += 1
+
+
+def make_bus(session_factory, retry_policy, start_orm=False):
+    return bootstrap.bootstrap(
+        start_orm=start_orm,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=lambda *args: None,
+        publish=lambda *args: None,
+        retry_policy=retry_policy,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="database to use, e.g. a scratch Postgres")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--allocations", type=int, default=50, help="per thread")
+    parser.add_argument("--attempts", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url, isolation_level="READ COMMITTED")
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+
+    retries, failures = Counter(), Counter()
+    retry_policy = messagebus.RetryPolicy(
+        attempts=args.attempts,
+        retry_on=(unit_of_work.ConcurrencyConflict,),
+        on_retry=retries.increment,
+    )
+    sku = f"CONTENDED-{int(time.time())}"
+    make_bus(session_factory, retry_policy, start_orm=True).handle(
+        commands.CreateBatch(f"{sku}-batch", sku, 10**9, None)
+    )
+
+    def allocate_many(thread_number):
+        bus = make_bus(session_factory, retry_policy)
+        for i in range(args.allocations):
+            try:
+                bus.handle(commands.Allocate(f"order-{thread_number}-{i}", sku, 1))
+            except Exception:  # pylint: disable=broad-except
+                failures.increment()
+
+    threads = [
+        threading.Thread(target=allocate_many, args=(n,)) for n in range(args.threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.allocations
+    print(f"{engine.url!r}: {args.threads} threads x {args.allocations} allocations")
+    print(f"  throughput:    {(total - failures.value) / elapsed:.1f} allocations/s")
+    print(f"  conflict rate: {retries.value / total:.2%} (retries per allocation)")
+    print(
+        f"  failed:        {failures.value} of {total} after {args.attempts} attempts"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# pylint: disable=protected-access
+import time
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(num_lines, sku="BENCH-SKU"):
+    batch = Batch("batch-1", sku, qty=num_lines, eta=None)
+    product = Product(sku, [batch])
+    for i in range(num_lines):
+        product.allocate(OrderLine(f"order-{i}", sku, 1))
+    return product, batch
+
+
+def summing_change_batch_quantity(product, ref, qty):
+    # the pre-running-total algorithm, kept as a reference point
+    batch = next(b for b in product.batches if b.reference == ref)
+    batch._purchased_quantity = qty
+    while batch._purchased_quantity - sum(l.qty for l in batch._allocations) < 0:
+        batch._allocations.pop()
+
+
+def time_halving(change_batch_quantity, num_lines):
+    product, batch = make_product(num_lines)
+    start = time.perf_counter()
+    change_batch_quantity(product, batch.reference, num_lines // 2)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"{'lines':>8} {'running total ms':>17} {'summing ms':>11}")
+    for num_lines in [1000, 5000, 10000]:
+        running = time_halving(Product.change_batch_quantity, num_lines)
+        summing = time_halving(summing_change_batch_quantity, num_lines)
+        print(f"{num_lines:>8} {running * 1e3:>17.1f} {summing * 1e3:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
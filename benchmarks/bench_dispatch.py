@@ -0,0 +1,99 @@
+import argparse
+import functools
+import inspect
+import itertools
+import sys
+import time
+from pathlib import Path
+
+from allocation import bootstrap
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, messagebus
+
+# the fakes the unit tests use
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from tests.unit.test_handlers import (  # pylint: disable=wrong-import-position
+    FakeNotifications,
+    FakeUnitOfWork,
+)
+
+
+def lambda_injection(handler, dependencies):
+    # how handlers were wrapped before dispatch was precompiled
+    params = inspect.signature(handler).parameters
+    deps = {name: dep for name, dep in dependencies.items() if name in params}
+    return functools.wraps(handler)(lambda message: handler(message, **deps))
+
+
+def make_bus(inject) -> messagebus.MessageBus:
+    uow = FakeUnitOfWork()
+    dependencies = {
+        "uow": uow,
+        "notifications": FakeNotifications(),
+        "publish": lambda *args: None,
+        "view_cache": None,
+    }
+    return messagebus.MessageBus(
+        uow=uow,
+        event_handlers={
+            event_type: [inject(handler, dependencies) for handler in event_handlers]
+            for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+            # the read model needs a database; dispatch to it costs the same
+            if event_type not in (events.Allocated, events.Deallocated)
+        },
+        command_handlers={
+            command_type: inject(handler, dependencies)
+            for command_type, handler in handlers.COMMAND_HANDLERS.items()
+        },
+    )
+
+
+def measure(operation, samples, repeat):
+    # the best of repeat runs, the one least disturbed by the rest of the machine
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(samples):
+            operation(i)
+        best = min(best, time.perf_counter() - start)
+    return best / samples * 1e6
+
+
+def run(name, inject, samples, repeat):
+    bus = make_bus(inject)
+    bus.handle(commands.CreateBatch("batch", "sku", 10**9))
+    out_of_stock = events.OutOfStock("sku")
+    orderids = itertools.count()
+    event_us = measure(lambda _: bus.handle(out_of_stock), samples, repeat)
+    allocate_us = measure(
+        lambda _: bus.handle(commands.Allocate(f"order-{next(orderids)}", "sku", 1)),
+        samples,
+        repeat,
+    )
+    bootstrap_us = measure(lambda _: make_bus(inject), samples // 10 or 1, repeat)
+    print(
+        f"  {name:<24} OutOfStock {event_us:>7.2f} us"
+        f"   allocate {allocate_us:>7.2f} us   build bus {bootstrap_us:>8.2f} us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5, help="reporting the best")
+    args = parser.parse_args()
+
+    # binding with partials makes building a bus several times cheaper; per
+    # message, the two are within run-to-run noise of each other
+    print(f"{args.samples} messages through MessageBus.handle with fake adapters")
+    run("lambda(**deps)", lambda_injection, args.samples, args.repeat)
+    run(
+        "precompiled partials",
+        bootstrap.inject_dependencies,
+        args.samples,
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from tests.integration.test_repository import (  # pylint: disable=wrong-import-position
+    counting_queries,
+)
+
+
+def seed(uow, num_batches, num_lines):
+    for b in range(num_batches):
+        handlers.add_batch(commands.CreateBatch(f"batch-{b}", "sku", 10**6), uow)
+    for l in range(num_lines):
+        handlers.allocate(commands.Allocate(f"seed-{l}", "sku", 1), uow)
+
+
+def load(uow):
+    with uow:
+        for batch in uow.products.get("sku").batches:
+            batch.available_quantity  # pylint: disable=pointless-statement
+
+
+def measure(engine, operation, samples):
+    with counting_queries(engine) as statements:
+        start = time.perf_counter()
+        for i in range(samples):
+            operation(i)
+        elapsed = time.perf_counter() - start
+    return elapsed / samples * 1e3, len(statements) / samples
+
+
+def run(name, make_uow, url, num_batches, num_lines, samples):
+    engine = create_engine(url)
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    uow = make_uow(sessionmaker(bind=engine))
+    seed(uow, num_batches, num_lines)
+
+    load_ms, load_q = measure(engine, lambda _: load(uow), samples)
+    commit_ms, commit_q = measure(
+        engine,
+        lambda i: handlers.allocate(commands.Allocate(f"order-{i}", "sku", 1), uow),
+        samples,
+    )
+    print(
+        f"  {name:<28} load {load_ms:>8.3f} ms {load_q:>5.1f} q"
+        f"   allocate+commit {commit_ms:>8.3f} ms {commit_q:>5.1f} q"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="sqlite://", help="an empty database")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=1000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    orm.start_mappers()
+
+    uows = {
+        "SqlAlchemyRepository": unit_of_work.SqlAlchemyUnitOfWork,
+        "event store, no snapshots": lambda sf: unit_of_work.EventSourcedUnitOfWork(
+            sf, snapshot_every=10**9
+        ),
+        "event store, snapshot/50": lambda sf: unit_of_work.EventSourcedUnitOfWork(
+            sf, snapshot_every=50
+        ),
+    }
+    print(f"{args.batches} batches, {args.lines} allocations, {args.url}")
+    for name, make_uow in uows.items():
+        run(name, make_uow, args.url, args.batches, args.lines, args.samples)
+
+
+if __name__ == "__main__":
+    main()
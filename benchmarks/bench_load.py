@@ -0,0 +1,434 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import requests
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap, config, views
+from allocation.adapters import orm
+from allocation.domain import commands
+from allocation.service_layer import messagebus
+
+# the fakes the unit tests use
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from tests.unit.test_handlers import (  # pylint: disable=wrong-import-position
+    FakeNotifications,
+    FakeUnitOfWork,
+)
+
+OPERATIONS = ("allocate", "change", "view")
+# what a baseline is only comparable with the same values of
+WORKLOAD = ("products", "batches", "requests", "concurrency", "mix", "seed")
+# the fake target only runs for a fraction of a second, so its throughput
+# swings with whatever else the machine is doing, and its tail latencies are
+# thread switches rather than work: it is judged on throughput and median
+# latency only, with twice the tolerance
+GATED = {"fake": ("p50_ms",)}
+SLACK = {"fake": 2.0}
+BATCH_QTY = 1000
+
+
+class FakeReadModel:
+    # stands in for the allocations_view table, which the fakes don't have, as
+    # the session that the read model's handlers write to
+    def __init__(self):
+        self.rows = defaultdict(dict)  # type: Dict[str, Dict[str, str]]
+
+    def execute(self, statement: str, params: List[dict]):
+        operation = statement.split()[0]
+        for row in params:
+            if operation == "INSERT":
+                self.rows[row["orderid"]][row["sku"]] = row["batchref"]
+            elif operation == "DELETE":
+                self.rows[row["orderid"]].pop(row["sku"], None)
+            else:
+                raise NotImplementedError(statement)
+
+    def allocations(self, orderid):
+        return [
+            {"sku": sku, "batchref": batchref}
+            for sku, batchref in self.rows.get(orderid, {}).items()
+        ]
+
+
+class ReadModelUnitOfWork(FakeUnitOfWork):
+    def __init__(self, read_model: FakeReadModel):
+        super().__init__()
+        self.session = read_model
+
+
+class BusClient:
+    def __init__(self, make_bus, allocations, lock=None):
+        self.make_bus = make_bus
+        self._allocations = allocations
+        self._lock = lock
+
+    def handle(self, command):
+        if self._lock is None:
+            self.make_bus().handle(command)
+        else:
+            with self._lock:
+                self.make_bus().handle(command)
+
+    def add_batch(self, ref, sku, qty):
+        self.handle(commands.CreateBatch(ref, sku, qty))
+
+    def allocate(self, orderid, sku, qty):
+        self.handle(commands.Allocate(orderid, sku, qty))
+
+    def change_batch_quantity(self, ref, qty):
+        self.handle(commands.ChangeBatchQuantity(ref, qty))
+
+    def allocations(self, orderid):
+        return self._allocations(orderid)
+
+
+class HttpClient:
+    def __init__(self, url, change_batch_quantity):
+        self.url = url
+        self.change_batch_quantity = change_batch_quantity
+        self.session = requests.Session()
+
+    def add_batch(self, ref, sku, qty):
+        r = self.session.post(
+            f"{self.url}/add_batch", json=dict(ref=ref, sku=sku, qty=qty, eta=None)
+        )
+        r.raise_for_status()
+
+    def allocate(self, orderid, sku, qty):
+        r = self.session.post(
+            f"{self.url}/allocate", json=dict(orderid=orderid, sku=sku, qty=qty)
+        )
+        r.raise_for_status()
+
+    def allocations(self, orderid):
+        r = self.session.get(f"{self.url}/allocations/{orderid}")
+        if r.status_code != 404:
+            r.raise_for_status()
+
+
+def fake_target(args) -> Callable[[], BusClient]:
+    # one in-memory product store, so messages are handled one at a time
+    read_model = FakeReadModel()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=ReadModelUnitOfWork(read_model),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+    )
+    lock = threading.Lock()
+    return lambda: BusClient(lambda: bus, read_model.allocations, lock)
+
+
+def sqlalchemy_session_factory(args):
+    if args.url:
+        engine = create_engine(args.url, isolation_level="READ COMMITTED")
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "load.db")
+        engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    orm.metadata.drop_all(engine)
+    orm.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def sqlalchemy_bus_factory(args):
+    return bootstrap.bootstrap_per_request(
+        start_orm=False,
+        session_factory=sqlalchemy_session_factory(args),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+    )
+
+
+def sqlite_target(args) -> Callable[[], BusClient]:
+    # a bus and unit of work per message, as the api does per request
+    make_bus = sqlalchemy_bus_factory(args)
+    return lambda: BusClient(
+        make_bus, lambda orderid: views.allocations(orderid, make_bus().uow)
+    )
+
+
+def http_target(args) -> Callable[[], HttpClient]:
+    if args.api_url:
+        # the deployed service takes batch quantity changes from a redis stream
+        import redis  # pylint: disable=import-outside-toplevel
+
+        client = redis.Redis(**config.get_redis_host_and_port())
+
+        def change_batch_quantity(ref, qty):
+            client.xadd(
+                "change_batch_quantity",
+                {"data": json.dumps(dict(batchref=ref, qty=qty))},
+            )
+
+        return lambda: HttpClient(args.api_url, change_batch_quantity)
+
+    # otherwise the api is served from this process, in front of the sqlite
+    # target, and changes are handled as the redis consumer would
+    from werkzeug.serving import (  # pylint: disable=import-outside-toplevel
+        WSGIRequestHandler,
+        make_server,
+    )
+    from allocation.entrypoints.flask_app import (  # pylint: disable=import-outside-toplevel
+        create_app,
+    )
+
+    make_bus = sqlalchemy_bus_factory(args)
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server(
+        "127.0.0.1",
+        0,
+        create_app(make_bus=make_bus),
+        threaded=True,
+        request_handler=QuietRequestHandler,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    return lambda: HttpClient(
+        url,
+        lambda ref, qty: make_bus().handle(commands.ChangeBatchQuantity(ref, qty)),
+    )
+
+
+TARGETS = {"fake": fake_target, "sqlite": sqlite_target, "http": http_target}
+
+
+def seed(client, products, batches):
+    for p in range(products):
+        for b in range(batches):
+            client.add_batch(f"SKU-{p}-B{b}", f"SKU-{p}", BATCH_QTY)
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    weights = dict(part.split("=") for part in mix.split(","))
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return [(operation, float(weight)) for operation, weight in weights.items()]
+
+
+def worker(number, client, args, mix, latencies, errors):
+    rng = random.Random(args.seed + number)
+    operations, weights = zip(*mix)
+    orderids = []  # type: List[str]
+    for i in range(args.requests // args.concurrency):
+        operation = rng.choices(operations, weights)[0]
+        sku = f"SKU-{rng.randrange(args.products)}"
+        start = time.perf_counter()
+        try:
+            if operation == "allocate":
+                orderid = f"order-{number}-{i}"
+                client.allocate(orderid, sku, rng.randint(1, 10))
+                orderids.append(orderid)
+            elif operation == "change":
+                ref = f"{sku}-B{rng.randrange(args.batches)}"
+                client.change_batch_quantity(
+                    ref, rng.randint(BATCH_QTY // 2, BATCH_QTY)
+                )
+            else:
+                client.allocations(rng.choice(orderids) if orderids else "no-order")
+        except Exception:  # pylint: disable=broad-except
+            errors[operation] += 1
+            continue
+        latencies[operation].append(time.perf_counter() - start)
+
+
+def run(target: str, args) -> dict:
+    make_client = TARGETS[target](args)
+    seed(make_client(), args.products, args.batches)
+
+    mix = parse_mix(args.mix)
+    latencies = defaultdict(list)  # type: Dict[str, List[float]]
+    errors = defaultdict(int)  # type: Dict[str, int]
+    threads = [
+        threading.Thread(
+            target=worker, args=(n, make_client(), args, mix, latencies, errors)
+        )
+        for n in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "throughput": sum(map(len, latencies.values())) / elapsed,
+        "operations": {},
+    }
+    for operation in sorted(set(latencies) | set(errors)):
+        timings = sorted(latencies[operation])
+        result["operations"][operation] = {
+            "count": len(timings),
+            "errors": errors[operation],
+            "p50_ms": percentile(timings, 50) * 1e3,
+            "p99_ms": percentile(timings, 99) * 1e3,
+        }
+    return result
+
+
+def best_of(runs: List[dict]) -> dict:
+    # each figure from whichever run was least disturbed by everything else
+    # on the machine, which is what makes runs comparable
+    best = {"throughput": max(r["throughput"] for r in runs), "operations": {}}
+    for operation in runs[0]["operations"]:
+        stats = [r["operations"][operation] for r in runs]
+        best["operations"][operation] = {
+            "count": min(s["count"] for s in stats),
+            # but any run's errors are real
+            "errors": max(s["errors"] for s in stats),
+            "p50_ms": min(s["p50_ms"] for s in stats),
+            "p99_ms": min(s["p99_ms"] for s in stats),
+        }
+    return best
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def report(target: str, result: dict):
+    print(f"  {target:<8} {result['throughput']:>9.1f} ops/s")
+    for operation, stats in result["operations"].items():
+        print(
+            f"    {operation:<9} p50 {stats['p50_ms']:>8.3f} ms"
+            f"   p99 {stats['p99_ms']:>8.3f} ms"
+            f"   {stats['count']:>6} ok {stats['errors']:>4} errors"
+        )
+
+
+def regressions(results: dict, baseline: dict, args) -> List[str]:
+    # tail latencies are noisy, so they get their own tolerance, and nothing
+    # under min_delta_ms slower counts. Errors are version conflicts that ran
+    # out of retries, which vary from run to run, so they are only reported
+    tolerances = {"p50_ms": args.tolerance, "p99_ms": args.p99_tolerance}
+    found = []
+    for target, result in results.items():
+        if target not in baseline:
+            found.append(f"{target}: not in the baseline")
+            continue
+        expected = baseline[target]
+        slack = SLACK.get(target, 1.0)
+        if result["throughput"] < expected["throughput"] * (
+            1 - args.tolerance * slack
+        ):
+            found.append(
+                f"{target}: throughput {result['throughput']:.1f} ops/s,"
+                f" baseline {expected['throughput']:.1f}"
+            )
+        for operation, stats in result["operations"].items():
+            before = expected["operations"].get(operation)
+            if before is None:
+                found.append(f"{target} {operation}: not in the baseline")
+                continue
+            for key, tolerance in tolerances.items():
+                if key not in GATED.get(target, tolerances):
+                    continue
+                limit = max(
+                    before[key] * (1 + tolerance * slack),
+                    before[key] + args.min_delta_ms,
+                )
+                if stats[key] > limit:
+                    found.append(
+                        f"{target} {operation}: {key} {stats[key]:.3f},"
+                        f" baseline {before[key]:.3f}"
+                    )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", default="fake,sqlite", help="fake,sqlite,http")
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--batches", type=int, default=3, help="per product")
+    parser.add_argument("--requests", type=int, default=2000, help="in total")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mix", default="allocate=70,change=10,view=20")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="reporting the best")
+    parser.add_argument(
+        "--url", help="database for the sqlite/http targets instead; needs --reset-db"
+    )
+    parser.add_argument(
+        "--reset-db",
+        action="store_true",
+        help="drop and recreate the tables of --url, deleting everything in them",
+    )
+    parser.add_argument(
+        "--api-url", help="a running api, rather than one served here"
+    )
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH", help="fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--p99-tolerance", type=float, default=1.0)
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        # a thread that wants the GIL can wait this long for another to let go
+        default=sys.getswitchinterval() * 1e3,
+        help="ignore latency regressions smaller than this, e.g. GIL waits",
+    )
+    args = parser.parse_args()
+    if args.url and not args.reset_db:
+        parser.error("--url is emptied before each run, so it needs --reset-db")
+
+    # version conflicts are retried, and failures are counted as errors
+    logging.getLogger(messagebus.__name__).setLevel(logging.CRITICAL)
+
+    targets = args.targets.split(",")
+    if set(targets) - {"fake"}:
+        orm.start_mappers()
+    print(
+        f"{args.products} products x {args.batches} batches, {args.requests} requests,"
+        f" concurrency {args.concurrency}, {args.mix}"
+    )
+    results = {}
+    for target in targets:
+        results[target] = best_of([run(target, args) for _ in range(args.repeat)])
+        report(target, results[target])
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        mismatched = [
+            key for key in WORKLOAD if baseline["args"].get(key) != getattr(args, key)
+        ]
+        for key in mismatched:
+            print(f"error: baseline was run with --{key} {baseline['args'].get(key)}")
+        if mismatched:
+            sys.exit(1)
+        found = regressions(results, baseline["results"], args)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print(
+            f"no regressions against {args.compare} (tolerance {args.tolerance:.0%})"
+        )
+
+
+if __name__ == "__main__":
+    main()
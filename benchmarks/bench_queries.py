@@ -0,0 +1,138 @@
+# pylint: disable=protected-access
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm, repository
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from tests.integration.test_repository import (  # pylint: disable=wrong-import-position
+    counting_queries,
+)
+
+
+def seed(engine, num_products, batches_per_product, lines_per_batch):
+    products, batches, lines, allocations, view = [], [], [], [], []
+    for p in range(num_products):
+        sku = f"sku-{p}"
+        products.append(dict(sku=sku, version_number=0))
+        for b in range(batches_per_product):
+            batch_id = len(batches) + 1
+            ref = f"batch-{p}-{b}"
+            batches.append(
+                dict(id=batch_id, reference=ref, sku=sku, _purchased_quantity=1000)
+            )
+            for l in range(lines_per_batch):
+                line_id = len(lines) + 1
+                orderid = f"order-{p}-{b}-{l}"
+                lines.append(dict(id=line_id, sku=sku, qty=1, orderid=orderid))
+                allocations.append(dict(orderline_id=line_id, batch_id=batch_id))
+                view.append(dict(orderid=orderid, sku=sku, batchref=ref))
+    with engine.begin() as connection:
+        connection.execute(orm.products.insert(), products)
+        connection.execute(orm.batches.insert(), batches)
+        connection.execute(orm.order_lines.insert(), lines)
+        connection.execute(orm.allocations.insert(), allocations)
+        connection.execute(orm.allocations_view.insert(), view)
+
+
+def drop_indexes(engine):
+    for table in orm.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+
+def measure(engine, name, operation, args):
+    with counting_queries(engine) as statements:
+        start = time.perf_counter()
+        for arg in args:
+            operation(arg)
+        elapsed = time.perf_counter() - start
+    per_op = elapsed / len(args) * 1e3
+    print(
+        f"  {name:<28} {per_op:>9.3f} ms/op {len(statements) / len(args):>6.1f} q/op"
+    )
+
+
+def run(engine, num_products, batches_per_product, lines_per_batch, samples):
+    session_factory = sessionmaker(bind=engine)
+    rng = random.Random(0)
+    orders = [
+        (
+            f"order-{rng.randrange(num_products)}-"
+            f"{rng.randrange(batches_per_product)}-{rng.randrange(lines_per_batch)}"
+        )
+        for _ in range(samples)
+    ]
+
+    def view_lookup(orderid):
+        with engine.connect() as connection:
+            list(
+                connection.execute(
+                    text(
+                        "SELECT sku, batchref FROM allocations_view WHERE orderid = :o"
+                    ),
+                    o=orderid,
+                )
+            )
+
+    def view_delete(orderid):
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute(
+                text("DELETE FROM allocations_view WHERE orderid = :o AND sku = :s"),
+                o=orderid,
+                s="sku-" + orderid.split("-")[1],
+            )
+            transaction.rollback()
+
+    def get_by_batchref(orderid):
+        _, p, b, _ = orderid.split("-")
+        session = session_factory()
+        product = repository.SqlAlchemyRepository(session).get_by_batchref(
+            f"batch-{p}-{b}"
+        )
+        for batch in product.batches:
+            batch.available_quantity  # pylint: disable=pointless-statement
+        session.close()
+
+    measure(engine, "view lookup by orderid", view_lookup, orders)
+    measure(engine, "view delete by orderid+sku", view_delete, orders)
+    measure(engine, "load product by batchref", get_by_batchref, orders[:50])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="run against an existing, empty database")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--samples", type=int, default=500)
+    args = parser.parse_args()
+    orm.start_mappers()
+    sizes = (args.products, args.batches, args.lines, args.samples)
+
+    if args.url:
+        engine = create_engine(args.url)
+        orm.upgrade_schema(engine)
+        seed(engine, *sizes[:3])
+        print(f"{engine.url!r}")
+        run(engine, *sizes)
+        return
+
+    for indexed in [False, True]:
+        engine = create_engine("sqlite://")
+        orm.metadata.create_all(engine)
+        if not indexed:
+            drop_indexes(engine)
+        seed(engine, *sizes[:3])
+        print("sqlite, " + ("indexed" if indexed else "no indexes"))
+        run(engine, *sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# runs in a fresh interpreter each time, so nothing is imported or warm yet
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+from allocation.entrypoints import flask_app
+imported = time.perf_counter()
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from allocation import bootstrap
+from allocation.adapters import orm
+
+engine = create_engine(sys.argv[1], poolclass=StaticPool)
+orm.metadata.drop_all(engine)
+orm.metadata.create_all(engine)
+
+start_app = time.perf_counter()
+app = flask_app.create_app(
+    make_bus=bootstrap.bootstrap_per_request(
+        session_factory=sessionmaker(bind=engine), publish=lambda *args: None
+    )
+)
+client = app.test_client()
+created = time.perf_counter()
+
+timings = []
+for i in range(2):
+    start_request = time.perf_counter()
+    r = client.post(
+        "/add_batch", json=dict(ref=f"b{i}", sku="LAMP", qty=10, eta=None)
+    )
+    assert r.status_code == 201, r.data
+    timings.append(time.perf_counter() - start_request)
+
+print(json.dumps(dict(
+    import_flask_app=imported - start,
+    create_app=created - start_app,
+    first_request=timings[0],
+    second_request=timings[1],
+)))
+"""
+
+
+def sample(url):
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP, url],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="sqlite://", help="a database to wipe")
+    parser.add_argument("--samples", type=int, default=10)
+    args = parser.parse_args()
+
+    samples = [sample(args.url) for _ in range(args.samples)]
+    print(f"{args.samples} fresh interpreters, {args.url}")
+    for name in samples[0]:
+        timings = [s[name] * 1e3 for s in samples]
+        print(
+            f"  {name:<18} median {statistics.median(timings):>8.2f} ms"
+            f"   min {min(timings):>8.2f} ms   max {max(timings):>8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+from sqlalchemy.orm import Session
+
+from allocation.domain import model
+
+
+class AggregateCache:
+    # process-local copies of recently committed Product aggregates, keyed by
+    # sku. The cached copies are detached and never change: sessions only ever
+    # get merged copies of them, and only while the version still matches
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._lock = threading.Lock()
+
+    def get(self, sku: str, version_number: int) -> Optional[model.Product]:
+        with self._lock:
+            product = self._entries.get(sku)
+            if product is None or product.version_number != version_number:
+                self._entries.pop(sku, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(sku)
+            self.hits += 1
+            return product
+
+    def put(self, product: model.Product):
+        # product must be clean, i.e. just committed, and not yet expired
+        scratch = Session()
+        snapshot = scratch.merge(product, load=False)
+        scratch.close()
+        with self._lock:
+            self._entries[product.sku] = snapshot
+            self._entries.move_to_end(product.sku)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, sku: str):
+        with self._lock:
+            self._entries.pop(sku, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
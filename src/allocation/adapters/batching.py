@@ -0,0 +1,166 @@
+# pylint: disable=broad-except
+import atexit
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, Deque, Generic, Iterable, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# how long exiting waits for each worker to send what it still has
+EXIT_TIMEOUT = 5.0
+
+
+class BatchWorker(Generic[T]):
+    # hands the items it is given to send() on a background thread, in order
+    # and up to max_batch at a time: once that many are waiting, max_delay
+    # after the oldest of them was added, or on flush(). Adding never waits for
+    # send(). send() may return the items it could not send; those, or the
+    # whole batch if it raised, are tried again max_delay later, ahead of
+    # anything newer, up to max_retries times (None: until they are sent).
+    # Items added while max_buffer are already waiting are dropped (None: none
+    # are). The thread only runs while there is something to send, and what
+    # is left at exit is sent then, unless flush_at_exit is False
+    def __init__(
+        self,
+        send: Callable[[List[T]], Optional[List[T]]],
+        name: str,
+        max_batch: int = 100,
+        max_delay: float = 1.0,
+        max_buffer: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        flush_at_exit: bool = True,
+    ):
+        self.send = send
+        self.name = name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.dropped = 0
+        self._buffer = deque()  # type: Deque[T]
+        self._oldest = 0.0
+        # items added, items sent or dropped, and how many of the added ones
+        # a flush() wants sent now
+        self._added = self._done = self._flush_to = 0
+        self._condition = threading.Condition()
+        self._running = False
+        if flush_at_exit:
+            _workers.add(self)
+
+    def add(self, item: T) -> bool:
+        return self.extend([item])
+
+    def extend(self, items: Iterable[T]) -> bool:
+        # False if any of them had to be dropped
+        items = list(items)
+        with self._condition:
+            complete = True
+            if self.max_buffer is not None:
+                room = max(self.max_buffer - len(self._buffer), 0)
+                if room < len(items):
+                    complete = False
+                    self.dropped += len(items) - room
+                    logger.warning(
+                        "%s dropped %d items, %d are waiting to be sent",
+                        self.name,
+                        len(items) - room,
+                        len(self._buffer),
+                    )
+                    items = items[:room]
+            if not items:
+                return complete
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.extend(items)
+            self._added += len(items)
+            if not self._running:
+                self._running = True
+                threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                ).start()
+            elif len(self._buffer) >= self.max_batch:
+                self._condition.notify_all()
+        return complete
+
+    def flush(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        # sends what has been added so far without waiting for a full batch or
+        # max_delay; with wait, True once all of it has been sent or dropped
+        with self._condition:
+            target = self._added
+            if target > self._flush_to:
+                self._flush_to = target
+                self._condition.notify_all()
+            if not wait:
+                return self._done >= target
+            return self._condition.wait_for(lambda: self._done >= target, timeout)
+
+    def _run(self):
+        batch, attempts = [], 0  # type: List[T], int
+        while True:
+            if not batch:
+                with self._condition:
+                    batch = self._take()
+                    if not batch:
+                        self._running = False
+                        return
+            try:
+                unsent = list(self.send(batch) or [])
+            except Exception:
+                logger.exception("%s could not send %d items", self.name, len(batch))
+                unsent = batch
+            attempts = attempts + 1 if unsent else 0
+            done = len(batch) - len(unsent)
+            if (
+                unsent
+                and self.max_retries is not None
+                and attempts > self.max_retries
+            ):
+                logger.error(
+                    "%s dropped %d items after %d attempts",
+                    self.name,
+                    len(unsent),
+                    attempts,
+                )
+                self.dropped += len(unsent)
+                done, unsent, attempts = len(batch), [], 0
+            with self._condition:
+                self._done += done
+                self._condition.notify_all()
+            batch = unsent
+            if batch:
+                time.sleep(self.max_delay)
+
+    def _take(self) -> List[T]:
+        # the next batch once it is due, or nothing if nothing more was added
+        # within max_delay
+        while True:
+            if not self._buffer:
+                self._condition.wait(self.max_delay)
+                if not self._buffer:
+                    return []
+                continue
+            due = self._oldest + self.max_delay - time.monotonic()
+            if (
+                len(self._buffer) >= self.max_batch
+                or self._flush_to > self._done
+                or due <= 0
+            ):
+                break
+            self._condition.wait(due)
+        size = min(self.max_batch, len(self._buffer))
+        return [self._buffer.popleft() for _ in range(size)]
+
+
+_workers = weakref.WeakSet()  # type: weakref.WeakSet[BatchWorker]
+
+
+@atexit.register
+def _flush_workers():
+    for worker in list(_workers):
+        if not worker.flush(timeout=EXIT_TIMEOUT):
+            logger.warning("%s exited with items it could not send", worker.name)
@@ -0,0 +1,72 @@
+# pylint: disable=protected-access
+from datetime import date
+from typing import List, Optional
+
+from allocation.domain import model
+
+# what a commit changed in a Product aggregate, as json-friendly lists:
+#   ["batch", batchref, qty, eta], ["qty", batchref, qty],
+#   ["allocate", batchref, orderid, qty], ["deallocate", batchref, orderid, qty]
+Change = list
+
+
+def copy_product(product: model.Product, detach: bool = False) -> model.Product:
+    # order lines are immutable, so copies share them unless they come from a
+    # session, in which case they are detached from it
+    batches = []
+    for batch in product.batches:
+        copy = model.Batch(
+            batch.reference, batch.sku, batch._purchased_quantity, batch.eta
+        )
+        if detach:
+            copy._allocations = {
+                model.OrderLine(line.orderid, line.sku, line.qty)
+                for line in batch._allocations
+            }
+        else:
+            copy._allocations = set(batch._allocations)
+        copy._allocated_quantity = batch.allocated_quantity
+        batches.append(copy)
+    return model.Product(product.sku, batches, product.version_number)
+
+
+def diff(before: Optional[model.Product], after: model.Product) -> List[Change]:
+    batches_before = {b.reference: b for b in before.batches} if before else {}
+    changes = []  # type: List[Change]
+    for batch in after.batches:
+        previous = batches_before.get(batch.reference)
+        if previous is None:
+            eta = batch.eta.isoformat() if batch.eta else None
+            changes.append(["batch", batch.reference, batch._purchased_quantity, eta])
+            lines_before = set()  # type: set
+        else:
+            if previous._purchased_quantity != batch._purchased_quantity:
+                changes.append(["qty", batch.reference, batch._purchased_quantity])
+            lines_before = previous._allocations
+        if lines_before != batch._allocations:
+            for line in lines_before - batch._allocations:
+                changes.append(
+                    ["deallocate", batch.reference, line.orderid, line.qty]
+                )
+            for line in batch._allocations - lines_before:
+                changes.append(["allocate", batch.reference, line.orderid, line.qty])
+    return changes
+
+
+def apply(product: model.Product, changes: List[Change]):
+    batches = {b.reference: b for b in product.batches}
+    for op, batchref, *args in changes:
+        if op == "batch":
+            qty, eta = args
+            eta = date.fromisoformat(eta) if eta else None
+            batches[batchref] = model.Batch(batchref, product.sku, qty, eta)
+            product.batches.append(batches[batchref])
+            continue
+        batch = batches[batchref]
+        if op == "qty":
+            batch.change_purchased_quantity(*args)
+        elif op == "allocate":
+            batch._allocations.add(model.OrderLine(args[0], product.sku, args[1]))
+        elif op == "deallocate":
+            batch._allocations.discard(model.OrderLine(args[0], product.sku, args[1]))
+        batch._allocated_quantity = None
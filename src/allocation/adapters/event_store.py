@@ -0,0 +1,158 @@
+import json
+from typing import Dict, Optional, Set, Tuple
+
+from allocation.adapters.changes import apply, copy_product, diff
+from allocation.adapters.repository import AbstractRepository
+from allocation.domain import model
+
+# what each kind of change is called in a product's stream
+EVENT_TYPES = {
+    "batch": "BatchCreated",
+    "qty": "BatchQuantityChanged",
+    "allocate": "Allocated",
+    "deallocate": "Deallocated",
+}
+CHANGES = {event_type: op for op, event_type in EVENT_TYPES.items()}
+PRODUCT_CREATED = "ProductCreated"
+
+
+class EventSourcedRepository(AbstractRepository):
+    # Products are rebuilt from their latest snapshot plus the events after
+    # it, and commits only ever append events; two commits made from the same
+    # version collide on the events' primary key
+    def __init__(self, session, snapshot_every: int = 50):
+        super().__init__()
+        self.session = session
+        self.snapshot_every = snapshot_every
+        self._products = {}  # type: Dict[str, model.Product]
+        # sku -> (version, state as loaded, version of the latest snapshot)
+        self._loaded = {}  # type: Dict[str, Tuple[int, model.Product, int]]
+
+    def _add(self, product):
+        self._products[product.sku] = product
+
+    def _get(self, sku, loading=None):
+        if sku not in self._products:
+            product = self._replay(sku)
+            if product is None:
+                return None
+            self._products[sku] = product
+        return self._products[sku]
+
+    def _get_by_batchref(self, batchref, loading=None):
+        sku = self.session.execute(
+            "SELECT sku FROM product_events WHERE batchref = :batchref LIMIT 1",
+            dict(batchref=batchref),
+        ).scalar()
+        return None if sku is None else self._get(sku, loading)
+
+    def _replay(self, sku: str) -> Optional[model.Product]:
+        snapshot = self.session.execute(
+            "SELECT version, state FROM product_snapshots WHERE sku = :sku",
+            dict(sku=sku),
+        ).first()
+        if snapshot:
+            version, changes = snapshot.version, json.loads(snapshot.state)
+        else:
+            version, changes = None, []
+        rows = self.session.execute(
+            "SELECT version, event_type, batchref, payload FROM product_events"
+            " WHERE sku = :sku AND version > :version ORDER BY version, position",
+            dict(sku=sku, version=-1 if version is None else version),
+        )
+        for row in rows:
+            version = row.version
+            if row.event_type != PRODUCT_CREATED:
+                changes.append(
+                    [CHANGES[row.event_type], row.batchref, *json.loads(row.payload)]
+                )
+        if version is None:
+            return None
+        product = model.Product(sku, [], version)
+        apply(product, changes)
+        snapshot_version = snapshot.version if snapshot else 0
+        self._loaded[sku] = (version, copy_product(product), snapshot_version)
+        return product
+
+    def append_new_events(self):
+        events, snapshots = [], []
+        for product in self.seen:
+            version, before, snapshot_version = self._loaded.get(
+                product.sku, (None, None, 0)
+            )
+            changes = diff(before, product)
+            if before is not None and not changes:
+                continue
+            if product.version_number == version:
+                product.version_number += 1
+            stream = [[PRODUCT_CREATED, None]] if before is None else []
+            stream.extend([EVENT_TYPES[op], *change] for op, *change in changes)
+            events.extend(
+                self._event(product, position, event_type, batchref, args)
+                for position, (event_type, batchref, *args) in enumerate(stream)
+            )
+            if product.version_number - snapshot_version >= self.snapshot_every:
+                snapshot_version = product.version_number
+                snapshots.append(
+                    dict(
+                        sku=product.sku,
+                        version=snapshot_version,
+                        state=json.dumps(diff(None, product)),
+                    )
+                )
+            self._loaded[product.sku] = (
+                product.version_number,
+                copy_product(product),
+                snapshot_version,
+            )
+        if events:
+            self.session.execute(
+                "INSERT INTO product_events"
+                " (sku, version, position, event_type, batchref, payload)"
+                " VALUES (:sku, :version, :position, :event_type, :batchref, :payload)",
+                events,
+            )
+        if snapshots:
+            self.session.execute(
+                "DELETE FROM product_snapshots WHERE sku = :sku", snapshots
+            )
+            self.session.execute(
+                "INSERT INTO product_snapshots (sku, version, state)"
+                " VALUES (:sku, :version, :state)",
+                snapshots,
+            )
+
+    @staticmethod
+    def _event(product, position, event_type, batchref, args) -> dict:
+        # each commit's events start at position 0 of the new version
+        return dict(
+            sku=product.sku,
+            version=product.version_number,
+            position=position,
+            event_type=event_type,
+            batchref=batchref,
+            payload=json.dumps(args),
+        )
+
+
+def rebuild_allocations_view(session):
+    # the read model is a projection of the streams, so it can be recreated
+    allocated = set()  # type: Set[Tuple[str, str, str]]
+    rows = session.execute(
+        "SELECT sku, event_type, batchref, payload FROM product_events"
+        " WHERE event_type IN ('Allocated', 'Deallocated')"
+        " ORDER BY sku, version, position"
+    )
+    for row in rows:
+        orderid, _ = json.loads(row.payload)
+        if row.event_type == "Allocated":
+            allocated.add((orderid, row.sku, row.batchref))
+        else:
+            allocated.discard((orderid, row.sku, row.batchref))
+    session.execute("DELETE FROM allocations_view")
+    if allocated:
+        session.execute(
+            "INSERT INTO allocations_view (orderid, sku, batchref)"
+            " VALUES (:orderid, :sku, :batchref)",
+            [dict(orderid=o, sku=s, batchref=b) for o, s, b in sorted(allocated)],
+        )
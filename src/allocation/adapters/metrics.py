@@ -0,0 +1,182 @@
+import abc
+import bisect
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# seconds; Prometheus' defaults, from half a millisecond up
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class AbstractMetrics(abc.ABC):
+    # instrumentation for the bus and units of work; bootstrap only wires it
+    # in when given one, so there is nothing to pay without it
+    @abc.abstractmethod
+    def observe_message(self, message_type: str, queue_depth: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def observe_handler(
+        self, message_type: str, handler: str, seconds: float, failed: bool
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def observe_uow(self, operation: str, seconds: float, failed: bool):
+        raise NotImplementedError
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class PrometheusMetrics(AbstractMetrics):
+    # kept in this process, and rendered in Prometheus' text format for
+    # scraping; with several server processes, each is scraped on its own
+    def __init__(self, namespace: str = "allocation"):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)  # type: Dict[Tuple[str, Labels], int]
+        self._histograms = {}  # type: Dict[Tuple[str, Labels], Histogram]
+        self._collectors = (
+            []
+        )  # type: List[Tuple[str, Callable[[], Dict[str, float]]]]
+        self._help = {}  # type: Dict[str, Tuple[str, str]]
+
+    def observe_message(self, message_type, queue_depth):
+        labels = (("message_type", message_type),)
+        with self._lock:
+            self._count("messages_total", labels, "Messages handled by the bus")
+            self._observe(
+                "queue_depth",
+                (),
+                queue_depth,
+                DEPTH_BUCKETS,
+                "Messages still queued when one is taken off the bus' queue",
+            )
+
+    def observe_handler(self, message_type, handler, seconds, failed):
+        labels = (("message_type", message_type), ("handler", handler))
+        with self._lock:
+            self._observe(
+                "handler_duration_seconds",
+                labels,
+                seconds,
+                LATENCY_BUCKETS,
+                "Time spent in each handler, per message type",
+            )
+            if failed:
+                self._count("handler_errors_total", labels, "Handlers that raised")
+
+    def observe_uow(self, operation, seconds, failed):
+        labels = (("operation", operation),)
+        with self._lock:
+            self._observe(
+                "uow_duration_seconds",
+                labels,
+                seconds,
+                LATENCY_BUCKETS,
+                "Time spent committing or rolling back units of work",
+            )
+            if failed:
+                self._count(
+                    "uow_errors_total", labels, "Commits or rollbacks that raised"
+                )
+
+    def add_collector(self, name: str, collect: Callable[[], Dict[str, float]]):
+        # read when rendering, e.g. a cache's stats() as <name>_hits etc.
+        self._collectors.append((name, collect))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, description) in sorted(self._help.items()):
+                lines.append(f"# HELP {self.namespace}_{name} {description}")
+                lines.append(f"# TYPE {self.namespace}_{name} {kind}")
+                if kind == "counter":
+                    lines.extend(self._render_counter(name))
+                else:
+                    lines.extend(self._render_histogram(name))
+        for name, collect in self._collectors:
+            for key, value in sorted(collect().items()):
+                metric = f"{self.namespace}_{name}_{key}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _count(self, name: str, labels: Labels, description: str):
+        self._help.setdefault(name, ("counter", description))
+        self._counters[name, labels] += 1
+
+    def _observe(self, name, labels, value, buckets, description):
+        self._help.setdefault(name, ("histogram", description))
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[name, labels] = Histogram(buckets)
+        histogram.observe(value)
+
+    def _render_counter(self, name: str) -> List[str]:
+        metric = f"{self.namespace}_{name}"
+        return [
+            f"{metric}{format_labels(labels)} {value}"
+            for (counter, labels), value in sorted(self._counters.items())
+            if counter == name
+        ]
+
+    def _render_histogram(self, name: str) -> List[str]:
+        metric, lines = f"{self.namespace}_{name}", []
+        for (histogram_name, labels), histogram in sorted(
+            self._histograms.items(), key=lambda item: item[0][1]
+        ):
+            if histogram_name != name:
+                continue
+            for bound, count in histogram.cumulative():
+                bucket_labels = format_labels(labels + (("le", bound),))
+                lines.append(f"{metric}_bucket{bucket_labels} {count}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{metric}_count{format_labels(labels)} {histogram.count}")
+        return lines
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
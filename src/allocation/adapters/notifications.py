@@ -1,7 +1,16 @@
 # pylint: disable=too-few-public-methods
 import abc
+import asyncio
+import logging
+import queue
 import smtplib
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
 from allocation import config
+from allocation.adapters.batching import BatchWorker
+
+logger = logging.getLogger(__name__)
 
 
 class AbstractNotifications(abc.ABC):
@@ -9,15 +18,27 @@ class AbstractNotifications(abc.ABC):
     def send(self, destination, message):
         raise NotImplementedError
 
+    def close(self):
+        pass
+
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
+def default_host_and_port(smtp_host=None, port=None):
+    defaults = config.get_email_host_and_port()
+    return smtp_host or defaults["host"], port or defaults["port"]
 
 
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    # connects when the first message is sent
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host, self.port = default_host_and_port(smtp_host, port)
+        self._server = None  # type: Optional[smtplib.SMTP]
+
+    @property
+    def server(self) -> smtplib.SMTP:
+        if self._server is None:
+            self._server = smtplib.SMTP(self.smtp_host, port=self.port)
+            self._server.noop()
+        return self._server
 
     def send(self, destination, message):
         msg = f"Subject: allocation service notification\n{message}"
@@ -26,3 +47,120 @@ class EmailNotifications(AbstractNotifications):
             to_addrs=[destination],
             msg=msg,
         )
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+class AsyncEmailNotifications(AbstractNotifications):
+    def __init__(self, smtp_host=None, port=None):
+        self.smtp_host, self.port = default_host_and_port(smtp_host, port)
+        self._notifications = None
+        self._lock = threading.Lock()
+
+    async def send(self, destination, message):
+        await asyncio.to_thread(self._send, destination, message)
+
+    def _send(self, destination, message):
+        # smtplib connections aren't thread-safe, so sends share one, in turn
+        with self._lock:
+            if self._notifications is None:
+                self._notifications = EmailNotifications(self.smtp_host, self.port)
+            self._notifications.send(destination, message)
+
+
+class PooledEmailNotifications(AbstractNotifications):
+    # connections are opened on first use, pooled, and replaced if the server
+    # has dropped them; one that fails in any other way is closed. With a
+    # digest_window, repeats of the same message to the same destination (e.g.
+    # one out-of-stock sku) go out as one digest once the window closes, and a
+    # digest that cannot be sent is tried again max_retries times, a window
+    # apart. send() then only queues the message, so callers that must know it
+    # was delivered, like the outbox dispatcher, need digest_window=0
+    def __init__(
+        self,
+        smtp_host=None,
+        port=None,
+        pool_size: int = 2,
+        digest_window: float = 5.0,
+        connect: Callable[[], AbstractNotifications] = None,
+        max_retries: int = 3,
+        max_pending: int = 10000,
+    ):
+        self.connect = connect or (lambda: EmailNotifications(smtp_host, port))
+        self.digest_window = digest_window
+        self._pool = queue.LifoQueue(maxsize=pool_size)  # type: queue.LifoQueue
+        self._digests = None  # type: Optional[BatchWorker[Tuple[str, str]]]
+        if digest_window:
+            self._digests = BatchWorker(
+                self._send_digests,
+                "email digests",
+                max_batch=max_pending,
+                max_delay=digest_window,
+                max_buffer=max_pending,
+                max_retries=max_retries,
+            )
+
+    def send(self, destination, message):
+        if self._digests is None:
+            self._send_now(destination, message)
+            return
+        self._digests.add((destination, message))
+
+    def flush(self):
+        # sends the digests queued so far without waiting for the window
+        if self._digests is not None:
+            self._digests.flush()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _send_digests(self, queued: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        pending = {}  # type: Dict[str, Counter]
+        for destination, message in queued:
+            pending.setdefault(destination, Counter())[message] += 1
+        unsent = []
+        for destination, messages in pending.items():
+            digest = "\n".join(
+                message if count == 1 else f"{message} (x{count})"
+                for message, count in messages.items()
+            )
+            try:
+                self._send_now(destination, digest)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Exception sending digest to %s", destination)
+                unsent.extend(
+                    (destination, message) for message in messages.elements()
+                )
+        return unsent
+
+    def _send_now(self, destination, message):
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+        try:
+            try:
+                connection.send(destination, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                logger.info("SMTP connection lost, reconnecting")
+                connection.close()
+                connection = self.connect()
+                connection.send(destination, message)
+        except Exception:
+            connection.close()
+            raise
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
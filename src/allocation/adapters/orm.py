@@ -1,13 +1,17 @@
 import logging
+from collections import deque
 from sqlalchemy import (
     Table,
     MetaData,
     Column,
     Integer,
     String,
+    Text,
     Date,
     ForeignKey,
+    Index,
     event,
+    inspect,
 )
 from sqlalchemy.orm import mapper, relationship
 
@@ -41,6 +45,8 @@ batches = Table(
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index("ix_batches_reference", "reference", unique=True),
+    Index("ix_batches_sku", "sku"),
 )
 
 allocations = Table(
@@ -49,6 +55,8 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index("ix_allocations_orderline_id", "orderline_id"),
+    Index("ix_allocations_batch_id", "batch_id"),
 )
 
 allocations_view = Table(
@@ -57,9 +65,84 @@ allocations_view = Table(
     Column("orderid", String(255)),
     Column("sku", String(255)),
     Column("batchref", String(255)),
+    Index("ix_allocations_view_orderid_sku", "orderid", "sku"),
+)
+
+# how many of each sku's committed events allocations_view has yet to apply
+unprojected_events = Table(
+    "unprojected_events",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("events", Integer, nullable=False),
+)
+
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    # the trace the event was raised in, for the dispatcher to carry on
+    Column("traceparent", String(55)),
+)
+
+# outbox rows that could not be decoded, so were taken out of the way of those
+# behind them
+outbox_dead_letters = Table(
+    "outbox_dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("traceparent", String(55)),
+    Column("error", Text, nullable=False),
+)
+
+# event-sourced products: one stream per sku, with the occasional snapshot
+product_events = Table(
+    "product_events",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, primary_key=True),
+    Column("position", Integer, primary_key=True),
+    Column("event_type", String(255), nullable=False),
+    Column("batchref", String(255)),
+    Column("payload", Text, nullable=False),
+    Index("ix_product_events_batchref", "batchref"),
+)
+
+product_snapshots = Table(
+    "product_snapshots",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("state", Text, nullable=False),
 )
 
 
+def upgrade_schema(engine):
+    # create_all only adds missing tables, so columns and indexes added to
+    # existing tables since they were created are added here; added columns
+    # must be nullable, and a unique index fails if the existing rows already
+    # break it
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info("Adding column %s.%s", table.name, column.name)
+                engine.execute(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name}"
+                    f" {column.type.compile(engine.dialect)}"
+                )
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s", index.name)
+                index.create(engine)
+
+
 def start_mappers():
     logger.info("Starting mappers")
     lines_mapper = mapper(model.OrderLine, order_lines)
@@ -78,9 +161,27 @@ def start_mappers():
         model.Product,
         products,
         properties={"batches": relationship(batches_mapper)},
+        # optimistic locking; the domain model bumps version_number itself
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
     )
 
 
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.events = []
+    product.events = deque()
+    product._eta_index = None
+
+
+@event.listens_for(model.Product, "expire")
+def receive_product_expire(product, _):
+    if product is not None:
+        product._eta_index = None
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "refresh")
+@event.listens_for(model.Batch, "expire")
+def reset_batch_caches(batch, *_):
+    if batch is not None:
+        batch._allocated_quantity = None
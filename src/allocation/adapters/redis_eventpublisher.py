@@ -1,16 +1,105 @@
+import asyncio
 import json
 import logging
+import weakref
 from dataclasses import asdict
+from typing import List, Tuple
 import redis
 
 from allocation import config
+from allocation.adapters import tracing
+from allocation.adapters.batching import BatchWorker
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+r = None
+# asyncio clients are bound to the event loop they were first used on
+async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client() -> redis.Redis:
+    global r  # pylint: disable=global-statement,invalid-name
+    if r is None:
+        r = redis.Redis(**config.get_redis_host_and_port())
+    return r
+
+
+def serialize(event: events.Event) -> str:
+    # carries the trace it was published from, if any, to whoever receives it
+    message = asdict(event)
+    traceparent = tracing.current_traceparent()
+    if traceparent is not None:
+        message["traceparent"] = traceparent
+    return json.dumps(message)
 
 
 def publish(channel, event: events.Event):
     logging.info("publishing: channel=%s, event=%s", channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, serialize(event))
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = async_clients.get(loop)
+    if client is None:
+        # only async buses need it, and it is slow to import
+        import redis.asyncio  # pylint: disable=import-outside-toplevel
+
+        client = async_clients[loop] = redis.asyncio.Redis(
+            **config.get_redis_host_and_port()
+        )
+    return client
+
+
+async def publish_async(channel, event: events.Event):
+    logging.info("publishing: channel=%s, event=%s", channel, event)
+    await get_async_client().publish(channel, serialize(event))
+
+
+class BufferedPublisher:
+    # a drop-in for publish() that hands events to a background thread, which
+    # sends them through a pipeline, max_buffer to a round trip, at most
+    # max_delay after they were published; bootstrap also has it send as soon
+    # as the bus has finished handling a message. A round trip that fails is
+    # retried max_retries times, and while max_pending events are already
+    # waiting for redis, new ones are dropped rather than kept
+    def __init__(
+        self,
+        client: redis.Redis = None,
+        max_buffer: int = 100,
+        max_delay: float = 0.05,
+        max_connections: int = None,
+        max_pending: int = 10000,
+        max_retries: int = 3,
+    ):
+        if client is None:
+            pool = redis.ConnectionPool(
+                **config.get_redis_host_and_port(),
+                max_connections=max_connections or config.get_redis_max_connections(),
+            )
+            client = redis.Redis(connection_pool=pool)
+        self.client = client
+        self._sender = BatchWorker(
+            self._send,
+            "redis publisher",
+            max_batch=max_buffer,
+            max_delay=max_delay,
+            max_buffer=max_pending,
+            max_retries=max_retries,
+        )  # type: BatchWorker[Tuple[str, str]]
+
+    def __call__(self, channel, event: events.Event):
+        logging.info("buffering: channel=%s, event=%s", channel, event)
+        self._sender.add((channel, serialize(event)))
+
+    def flush(self, wait: bool = True):
+        # sends what has been published so far, without waiting for a full
+        # round trip or max_delay; with wait, returns once it has been sent
+        self._sender.flush(wait)
+
+    def _send(self, buffered: List[Tuple[str, str]]):
+        pipe = self.client.pipeline(transaction=False)
+        for channel, message in buffered:
+            pipe.publish(channel, message)
+        pipe.execute()
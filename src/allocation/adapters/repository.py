@@ -1,9 +1,22 @@
 import abc
-from typing import Set
+import enum
+from typing import Dict, Optional, Set
+from sqlalchemy.orm import joinedload, noload, selectinload
 from allocation.adapters import orm
+from allocation.adapters.aggregate_cache import AggregateCache
 from allocation.domain import model
 
 
+class Loading(enum.Enum):
+    # how much of a Product aggregate to load up front
+    LAZY = "lazy"  # one query per relationship, on first access
+    SELECTIN = "selectin"  # three queries, whatever the aggregate's size
+    JOINED = "joined"  # one query, but with a row per allocation
+    # batches only, for read-only paths: allocations load as empty, so
+    # available quantities are wrong and the aggregate mustn't be changed
+    WITHOUT_ALLOCATIONS = "without_allocations"
+
+
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen = set()  # type: Set[model.Product]
@@ -12,14 +25,14 @@ class AbstractRepository(abc.ABC):
         self._add(product)
         self.seen.add(product)
 
-    def get(self, sku) -> model.Product:
-        product = self._get(sku)
+    def get(self, sku, loading: Loading = None) -> model.Product:
+        product = self._get(sku, loading)
         if product:
             self.seen.add(product)
         return product
 
-    def get_by_batchref(self, batchref) -> model.Product:
-        product = self._get_by_batchref(batchref)
+    def get_by_batchref(self, batchref, loading: Loading = None) -> model.Product:
+        product = self._get_by_batchref(batchref, loading)
         if product:
             self.seen.add(product)
         return product
@@ -29,31 +42,101 @@ class AbstractRepository(abc.ABC):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get(self, sku) -> model.Product:
+    def _get(self, sku, loading: Loading = None) -> model.Product:
         raise NotImplementedError
 
     @abc.abstractmethod
-    def _get_by_batchref(self, batchref) -> model.Product:
+    def _get_by_batchref(self, batchref, loading: Loading = None) -> model.Product:
         raise NotImplementedError
 
 
+LOADER_OPTIONS = {
+    Loading.LAZY: [],
+    Loading.SELECTIN: [selectinload("batches").selectinload("_allocations")],
+    Loading.JOINED: [joinedload("batches").joinedload("_allocations")],
+    Loading.WITHOUT_ALLOCATIONS: [selectinload("batches").noload("_allocations")],
+}
+
+
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    def __init__(
+        self,
+        session,
+        loading: Loading = Loading.SELECTIN,
+        cache: AggregateCache = None,
+    ):
         super().__init__()
         self.session = session
+        self.loading = loading
+        self.cache = cache
+        self._partial = set()  # type: Set[model.Product]
 
     def _add(self, product):
         self.session.add(product)
 
-    def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+    def _get(self, sku, loading=None):
+        if self.cache is not None:
+            return self._get_through_cache(sku, loading)
+        return self._query(loading).filter_by(sku=sku).first()
 
-    def _get_by_batchref(self, batchref):
+    def _get_through_cache(self, sku, loading):
+        version_number = self.session.execute(
+            "SELECT version_number FROM products WHERE sku = :sku",
+            dict(sku=sku),
+        ).scalar()
+        if version_number is None:
+            self.cache.invalidate(sku)
+            return None
+        cached = self.cache.get(sku, version_number)
+        if cached is not None:
+            return self.session.merge(cached, load=False)
+        product = self._query(loading).filter_by(sku=sku).first()
+        if product and (loading or self.loading) is Loading.WITHOUT_ALLOCATIONS:
+            self._partial.add(product)
+        return product
+
+    def cache_seen(self):
+        # called once the aggregates' state has been committed
+        for product in self.seen - self._partial:
+            self.cache.put(product)
+
+    def _get_by_batchref(self, batchref, loading=None):
         return (
-            self.session.query(model.Product)
+            self._query(loading)
             .join(model.Batch)
             .filter(
                 orm.batches.c.reference == batchref,
             )
             .first()
         )
+
+    def _query(self, loading):
+        return self.session.query(model.Product).options(
+            *LOADER_OPTIONS[loading or self.loading]
+        )
+
+
+class InMemoryRepository(AbstractRepository):
+    # hands out working copies of the aggregates a WriteBehindStore keeps
+    # resident; the store checks their versions when they are committed
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.base_versions = {}  # type: Dict[str, Optional[int]]
+        self._checked_out = {}  # type: Dict[str, model.Product]
+
+    def _add(self, product):
+        self._checked_out[product.sku] = product
+
+    def _get(self, sku, loading=None):
+        product = self._checked_out.get(sku)
+        if product is None:
+            product = self.store.checkout(sku)
+            if product is not None:
+                self._checked_out[sku] = product
+                self.base_versions[sku] = product.version_number
+        return product
+
+    def _get_by_batchref(self, batchref, loading=None):
+        sku = self.store.sku_for_batchref(batchref)
+        return None if sku is None else self._get(sku, loading)
@@ -0,0 +1,225 @@
+# pylint: disable=broad-except
+import abc
+import contextvars
+import json
+import random
+import re
+import time
+import urllib.request
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from allocation import config
+from allocation.adapters.batching import BatchWorker
+
+# W3C trace context, as in a `traceparent` header: version-trace-span-flags
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    attributes: Dict[str, str] = field(default_factory=dict)
+    error: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+    duration: float = 0.0
+    started: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_zipkin(self, service: str) -> dict:
+        tags = dict(self.attributes)
+        if self.error is not None:
+            tags["error"] = self.error
+        span = {
+            "traceId": self.trace_id,
+            "id": self.span_id,
+            "name": self.name,
+            "timestamp": int(self.timestamp * 1e6),
+            "duration": max(int(self.duration * 1e6), 1),
+            "localEndpoint": {"serviceName": service},
+            "tags": tags,
+        }
+        if self.parent_id is not None:
+            span["parentId"] = self.parent_id
+        return span
+
+
+# the span that whatever runs now is part of; asyncio tasks and
+# asyncio.to_thread() inherit it, plain threads start without one
+CURRENT_SPAN = contextvars.ContextVar(
+    "current_span", default=None
+)  # type: contextvars.ContextVar[Optional[Span]]
+
+
+def current_traceparent() -> Optional[str]:
+    span = CURRENT_SPAN.get()
+    return None if span is None else span.traceparent
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[Tuple[str, str]]:
+    match = TRACEPARENT.match(traceparent or "")
+    return match.groups() if match else None
+
+
+class AbstractSpanExporter(abc.ABC):
+    @abc.abstractmethod
+    def export(self, span: Span):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class BatchingSpanExporter(AbstractSpanExporter):
+    # spans go to a background thread max_batch at a time, or at most
+    # max_delay after they were exported, so finishing a span never waits for
+    # I/O. Traces are a sample, so spans exported while max_queued batches'
+    # worth are already waiting, and batches the collector fails to take, are
+    # dropped rather than kept
+    def __init__(
+        self,
+        service: str,
+        max_batch: int = 100,
+        max_delay: float = 1.0,
+        max_queued: int = 10,
+    ):
+        self.service = service
+        self._worker = BatchWorker(
+            self._export_batch,
+            f"{type(self).__name__} for {service}",
+            max_batch=max_batch,
+            max_delay=max_delay,
+            max_buffer=max_batch * max_queued,
+            max_retries=0,
+        )  # type: BatchWorker[Span]
+
+    @property
+    def dropped(self) -> int:
+        return self._worker.dropped
+
+    def export(self, span):
+        self._worker.add(span)
+
+    def flush(self):
+        # sends everything exported so far
+        self._worker.flush()
+
+    def _export_batch(self, spans: List[Span]):
+        self._send([span.to_zipkin(self.service) for span in spans])
+
+    @abc.abstractmethod
+    def _send(self, spans: List[dict]):
+        raise NotImplementedError
+
+
+class FileSpanExporter(BatchingSpanExporter):
+    # one zipkin json span per line
+    def __init__(self, path: str, service: str = "allocation", **kwargs):
+        super().__init__(service, **kwargs)
+        self.path = path
+
+    def _send(self, spans):
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(span) + "\n" for span in spans)
+
+
+class ZipkinSpanExporter(BatchingSpanExporter):
+    # a zipkin collector's v2 api, e.g. http://zipkin:9411/api/v2/spans;
+    # jaeger and the opentelemetry collector can receive it too
+    def __init__(self, url: str, service: str = "allocation", **kwargs):
+        super().__init__(service, **kwargs)
+        self.url = url
+
+    def _send(self, spans):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(spans).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=5):
+            pass
+
+
+class Tracer:
+    def __init__(self, exporter: AbstractSpanExporter):
+        self.exporter = exporter
+
+    def start(self, name: str, traceparent: str = None, **attributes: str) -> Span:
+        # a child of the given remote span, else of the current one, else the
+        # first span of a new trace
+        remote = parse_traceparent(traceparent)
+        if remote is not None:
+            trace_id, parent_id = remote
+        else:
+            parent = CURRENT_SPAN.get()
+            trace_id = (
+                parent.trace_id if parent else "%032x" % random.getrandbits(128)
+            )
+            parent_id = parent.span_id if parent else None
+        return Span(
+            name,
+            trace_id,
+            "%016x" % random.getrandbits(64),
+            parent_id,
+            {key: str(value) for key, value in attributes.items()},
+        )
+
+    def finish(self, span: Span, error: Exception = None):
+        span.duration = time.perf_counter() - span.started
+        if error is not None:
+            span.error = repr(error)
+        self.exporter.export(span)
+
+    @contextmanager
+    def span(self, name: str, traceparent: str = None, **attributes: str):
+        span = self.start(name, traceparent, **attributes)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except Exception as e:
+            self.finish(span, e)
+            raise
+        else:
+            self.finish(span)
+        finally:
+            CURRENT_SPAN.reset(token)
+
+
+@contextmanager
+def continued(traceparent: Optional[str]):
+    # makes a remote span current without recording a span of our own, so that
+    # whatever runs inside, such as publish(), carries its trace on
+    remote = parse_traceparent(traceparent)
+    if remote is None:
+        yield None
+        return
+    token = CURRENT_SPAN.set(Span("remote", *remote))
+    try:
+        yield CURRENT_SPAN.get()
+    finally:
+        CURRENT_SPAN.reset(token)
+
+
+def span(tracer: Optional[Tracer], name: str, traceparent: str = None, **attributes):
+    # for entrypoints, whose tracing is optional
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, traceparent, **attributes)
+
+
+def tracer_from_config() -> Optional[Tracer]:
+    url, path = config.get_trace_collector_url(), config.get_trace_file()
+    if url:
+        exporter = ZipkinSpanExporter(url, config.get_trace_service_name())
+    elif path:
+        exporter = FileSpanExporter(path, config.get_trace_service_name())
+    else:
+        return None
+    return Tracer(exporter)
@@ -0,0 +1,203 @@
+import abc
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import redis
+
+from allocation import config
+
+logger = logging.getLogger(__name__)
+
+Rows = List[Dict[str, str]]
+
+
+class AbstractViewCache(abc.ABC):
+    # rows are read from the database between generation() and set(), which
+    # drops them if the orderid has been invalidated since, so rows read
+    # before a change can't be cached after it
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, orderid: str) -> Optional[Rows]:
+        rows = self._get(orderid)
+        if rows is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rows
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    @abc.abstractmethod
+    def _get(self, orderid: str) -> Optional[Rows]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def generation(self, orderid: str) -> Any:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, orderid: str, rows: Rows, generation: Any):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def invalidate(self, orderid: str):
+        raise NotImplementedError
+
+
+class InMemoryViewCache(AbstractViewCache):
+    # only invalidated by the buses of this process
+    def __init__(self, max_size: int = 10000, ttl: float = 5.0):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        # expiry, rows (None once invalidated) and the number of invalidations
+        # as of the orderid's latest one
+        self._entries = (
+            OrderedDict()
+        )  # type: OrderedDict[str, Tuple[float, Optional[Rows], int]]
+        self._invalidations = 0
+        # the latest invalidation of an evicted entry, which stands in for that
+        # of any orderid without one
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def _get(self, orderid):
+        with self._lock:
+            entry = self._entries.get(orderid)
+            if entry is None:
+                return None
+            expires_at, rows, _ = entry
+            if rows is None or expires_at < time.monotonic():
+                return None
+            self._entries.move_to_end(orderid)
+            return rows
+
+    def generation(self, orderid):
+        with self._lock:
+            return self._invalidations
+
+    def set(self, orderid, rows, generation):
+        with self._lock:
+            entry = self._entries.get(orderid)
+            invalidated = self._forgotten if entry is None else entry[2]
+            if invalidated > generation:
+                return
+            self._put(orderid, (time.monotonic() + self.ttl, rows, invalidated))
+
+    def invalidate(self, orderid):
+        with self._lock:
+            self._invalidations += 1
+            self._put(orderid, (0.0, None, self._invalidations))
+
+    def _put(self, orderid, entry):
+        self._entries[orderid] = entry
+        self._entries.move_to_end(orderid)
+        while len(self._entries) > self.max_size:
+            _, (_, _, invalidated) = self._entries.popitem(last=False)
+            self._forgotten = max(self._forgotten, invalidated)
+
+
+SET_IF_CURRENT = """
+if (redis.call("GET", KEYS[2]) or "") == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+end
+"""
+
+
+class RedisViewCache(AbstractViewCache):
+    # shared between processes; a redis outage only turns hits into misses
+    def __init__(self, client: redis.Redis = None, ttl: int = 30):
+        super().__init__()
+        self.client = client or redis.Redis(**config.get_redis_host_and_port())
+        self.ttl = ttl
+        self._set_if_current = self.client.register_script(SET_IF_CURRENT)
+
+    def _get(self, orderid):
+        try:
+            cached = self.client.get(self._key(orderid))
+        except redis.RedisError:
+            logger.exception("Exception reading cached view for %s", orderid)
+            return None
+        return None if cached is None else json.loads(cached)
+
+    def generation(self, orderid):
+        # None if it can't be read, which set() takes as invalidated
+        try:
+            current = self.client.get(self._generation_key(orderid))
+        except redis.RedisError:
+            logger.exception("Exception reading view generation for %s", orderid)
+            return None
+        return "" if current is None else current.decode()
+
+    def set(self, orderid, rows, generation):
+        if generation is None:
+            return
+        try:
+            self._set_if_current(
+                keys=[self._key(orderid), self._generation_key(orderid)],
+                args=[generation, json.dumps(rows), self.ttl],
+            )
+        except redis.RedisError:
+            logger.exception("Exception caching view for %s", orderid)
+
+    def invalidate(self, orderid):
+        # a new generation, rather than a count, can't come round again once
+        # the key has expired
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(self._generation_key(orderid), uuid.uuid4().hex, ex=self.ttl)
+            pipe.delete(self._key(orderid))
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception("Exception invalidating cached view for %s", orderid)
+
+    @staticmethod
+    def _key(orderid):
+        return f"allocations_view:{orderid}"
+
+    @staticmethod
+    def _generation_key(orderid):
+        return f"allocations_view_generation:{orderid}"
+
+
+class TieredViewCache(AbstractViewCache):
+    # other processes only invalidate the shared tier, so keep the local ttl short
+    def __init__(self, local: AbstractViewCache, shared: AbstractViewCache):
+        super().__init__()
+        self.local = local
+        self.shared = shared
+
+    def _get(self, orderid):
+        rows = self.local.get(orderid)
+        if rows is None:
+            generation = self.local.generation(orderid)
+            rows = self.shared.get(orderid)
+            if rows is not None:
+                self.local.set(orderid, rows, generation)
+        return rows
+
+    def generation(self, orderid):
+        return self.local.generation(orderid), self.shared.generation(orderid)
+
+    def set(self, orderid, rows, generation):
+        local, shared = generation
+        self.shared.set(orderid, rows, shared)
+        self.local.set(orderid, rows, local)
+
+    def invalidate(self, orderid):
+        self.shared.invalidate(orderid)
+        self.local.invalidate(orderid)
+
+
+def view_cache_from_config() -> Optional[AbstractViewCache]:
+    # shared, so that every process's buses invalidate the one all of them read
+    if not config.get_view_cache_enabled():
+        return None
+    return RedisViewCache()
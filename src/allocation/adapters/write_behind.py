@@ -0,0 +1,306 @@
+# pylint: disable=broad-except
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from allocation.adapters import orm, repository
+from allocation.adapters.batching import BatchWorker
+from allocation.adapters.changes import apply, copy_product, diff
+from allocation.domain import model
+
+logger = logging.getLogger(__name__)
+
+Record = dict  # {"seq", "sku", "version", "changes": [[op, batchref, ...], ...]}
+
+
+class StaleAggregate(Exception):
+    pass
+
+
+class CommitLog:
+    # append-only json lines; concurrent commits share fsyncs (group commit):
+    # whoever gets to sync first makes everything written so far durable.
+    # Records already in the database are cut off the front of the file once
+    # they take up compact_bytes, or as soon as nothing after them is left
+    def __init__(self, path: str, compact_bytes: int = 16 * 2**20):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self._file = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._size = 0
+        # how much of the file is records already truncated, and the seq and
+        # the file's size once it was written of each record still in it
+        self._flushed = 0
+        self._ends = deque()  # type: Deque[Tuple[int, int]]
+
+    @property
+    def last_seq(self) -> int:
+        return self._written
+
+    def open(self) -> List[Record]:
+        records = []
+        self._ends.clear()
+        self._size = self._flushed = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # torn write from a crash; nothing after it was synced
+                        logger.warning("Ignoring partial record in %s", self.path)
+                        break
+                    self._size += len(line)
+                    self._ends.append((records[-1]["seq"], self._size))
+            if os.path.getsize(self.path) > self._size:
+                os.truncate(self.path, self._size)
+        self._file = open(self.path, "a")  # pylint: disable=consider-using-with
+        self._written = self._synced = records[-1]["seq"] if records else 0
+        return records
+
+    def write(self, record: Record):
+        line = json.dumps(record) + "\n"  # ascii, so one byte per character
+        with self._lock:
+            self._file.write(line)
+            self._written = record["seq"]
+            self._size += len(line)
+            self._ends.append((self._written, self._size))
+
+    def sync(self, seq: int):
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            with self._lock:
+                self._file.flush()
+                written = self._written
+            os.fsync(self._file.fileno())
+            self._synced = written
+
+    def truncate(self, seq: int):
+        # drops the records up to seq, once they are safely in the database;
+        # syncs wait, so that they never sync a file that has been replaced
+        with self._sync_lock, self._lock:
+            while self._ends and self._ends[0][0] <= seq:
+                _, self._flushed = self._ends.popleft()
+            if not self._ends:
+                self._file.truncate(0)
+                self._size = self._flushed = 0
+            elif self._flushed >= self.compact_bytes:
+                self._compact()
+
+    def _compact(self):
+        # rewrites the log without the records before the first one kept
+        self._file.flush()
+        temporary = self.path + ".tmp"
+        with open(self.path, "rb") as old, open(temporary, "wb") as new:
+            old.seek(self._flushed)
+            shutil.copyfileobj(old, new)
+            new.flush()
+            os.fsync(new.fileno())
+        os.replace(temporary, self.path)
+        self._file.close()
+        self._file = open(self.path, "a")  # pylint: disable=consider-using-with
+        self._size -= self._flushed
+        self._ends = deque((seq, end - self._flushed) for seq, end in self._ends)
+        self._flushed = 0
+
+    def close(self):
+        self._file.close()
+
+
+class WriteBehindStore:
+    # keeps Product aggregates resident in memory. Commits are made durable in
+    # a local CommitLog, and written to the database later, in batches, by a
+    # background thread. Only one process may own a given sku, and only one
+    # store a given log: see shared_store()
+    def __init__(
+        self,
+        log_path: str,
+        session_factory,
+        batch_size: int = 500,
+        flush_interval: float = 0.2,
+    ):
+        self.log = CommitLog(log_path)
+        self.checkpoint_path = log_path + ".checkpoint"
+        self.session_factory = session_factory
+        self._products = {}  # type: Dict[str, model.Product]
+        self._skus_by_batchref = {}  # type: Dict[str, str]
+        self._seq = 0
+        self._lock = threading.Lock()
+        # records are never dropped, and until they are written they are in
+        # the log, so stop() rather than exiting needs to wait for them
+        self._writer = BatchWorker(
+            self._write_batch,
+            f"write-behind {log_path}",
+            max_batch=batch_size,
+            max_delay=flush_interval,
+            flush_at_exit=False,
+        )  # type: BatchWorker[Record]
+        self.started = False
+
+    def start(self):
+        # anything logged but not yet in the database is written before any
+        # aggregate is loaded from it
+        checkpoint = self._read_checkpoint()
+        unflushed = [r for r in self.log.open() if r["seq"] > checkpoint]
+        self._seq = unflushed[-1]["seq"] if unflushed else checkpoint
+        for i in range(0, len(unflushed), self._writer.max_batch):
+            self._write_to_database(unflushed[i : i + self._writer.max_batch])
+        self._write_checkpoint(self._seq)
+        self.log.truncate(self.log.last_seq)
+        self.started = True
+
+    def stop(self, timeout: float = 10.0):
+        if not self.flush(timeout):
+            logger.warning("Stopped before writing every record; they are logged")
+        self.log.close()
+        with _stores_lock:
+            if _stores.get(self.log.path) is self:
+                del _stores[self.log.path]
+
+    def flush(self, timeout: float = None) -> bool:
+        # True once everything committed so far is in the database
+        return self._writer.flush(timeout=timeout)
+
+    def checkout(self, sku: str) -> Optional[model.Product]:
+        product = self._products.get(sku)
+        if product is None:
+            product = self._load(sku)
+            if product is None:
+                return None
+            with self._lock:
+                product = self._products.setdefault(sku, product)
+                for batch in product.batches:
+                    self._skus_by_batchref[batch.reference] = sku
+        # resident aggregates are never changed, only replaced on commit
+        return copy_product(product)
+
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        sku = self._skus_by_batchref.get(batchref)
+        if sku is None:
+            session = self.session_factory()
+            try:
+                sku = session.execute(
+                    "SELECT sku FROM batches WHERE reference = :batchref",
+                    dict(batchref=batchref),
+                ).scalar()
+            finally:
+                session.close()
+        return sku
+
+    def commit(
+        self,
+        products: Iterable[model.Product],
+        base_versions: Dict[str, Optional[int]],
+    ):
+        records = []
+        with self._lock:
+            changed = []
+            for product in products:
+                resident = self._products.get(product.sku)
+                current = resident.version_number if resident else None
+                if current != base_versions.get(product.sku):
+                    raise StaleAggregate(product.sku)
+                changes = diff(resident, product)
+                if changes and current == product.version_number:
+                    # every change gets a new version, which is what makes
+                    # replaying a record into the database idempotent
+                    product.version_number += 1
+                if changes or resident is None:
+                    changed.append((product, changes))
+            for product, changes in changed:
+                self._seq += 1
+                record = dict(
+                    seq=self._seq,
+                    sku=product.sku,
+                    version=product.version_number,
+                    changes=changes,
+                )
+                self.log.write(record)
+                records.append(record)
+                resident = copy_product(product)
+                self._products[product.sku] = resident
+                for batch in resident.batches:
+                    self._skus_by_batchref[batch.reference] = product.sku
+                base_versions[product.sku] = product.version_number
+            # queued in log order, so the database sees commits in that order
+            self._writer.extend(records)
+        if records:
+            self.log.sync(records[-1]["seq"])
+
+    def _write_batch(self, records: List[Record]):
+        self._write_to_database(records)
+        self._write_checkpoint(records[-1]["seq"])
+        self.log.truncate(records[-1]["seq"])
+
+    def _load(self, sku: str) -> Optional[model.Product]:
+        session = self.session_factory()
+        try:
+            product = repository.SqlAlchemyRepository(session).get(sku)
+            return None if product is None else copy_product(product, detach=True)
+        finally:
+            session.close()
+
+    def _write_to_database(self, records: List[Record]):
+        session = self.session_factory()
+        try:
+            skus = {record["sku"] for record in records}
+            products = {
+                product.sku: product
+                for product in session.query(model.Product)
+                .options(*repository.LOADER_OPTIONS[repository.Loading.SELECTIN])
+                .filter(orm.products.c.sku.in_(skus))
+            }
+            versions = {sku: p.version_number for sku, p in products.items()}
+            for record in records:
+                sku = record["sku"]
+                if record["version"] <= versions.get(sku, -1):
+                    continue  # already written before a crash
+                product = products.get(sku)
+                if product is None:
+                    product = model.Product(sku, [], record["version"])
+                    session.add(product)
+                    products[sku] = product
+                apply(product, record["changes"])
+                product.version_number = record["version"]
+            session.commit()
+        finally:
+            session.close()
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)["seq"]
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq: int):
+        temporary = self.checkpoint_path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"seq": seq}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.checkpoint_path)
+
+
+_stores = {}  # type: Dict[str, WriteBehindStore]
+_stores_lock = threading.Lock()
+
+
+def shared_store(log_path: str, session_factory) -> WriteBehindStore:
+    # the store using log_path, which another store mustn't also write to and
+    # truncate; it is started by whoever gets it first
+    with _stores_lock:
+        store = _stores.get(log_path)
+        if store is None:
+            store = _stores[log_path] = WriteBehindStore(log_path, session_factory)
+        elif store.session_factory is not session_factory:
+            raise ValueError(f"{log_path} is in use with another database")
+        return store
@@ -1,51 +1,370 @@
+import atexit
+import functools
 import inspect
-from typing import Callable
-from allocation.adapters import orm, redis_eventpublisher
+from typing import Callable, Dict, Iterable, List, Tuple, Type, Union
+from allocation import config
+from allocation.adapters import orm, redis_eventpublisher, write_behind
+from allocation.adapters.metrics import AbstractMetrics
 from allocation.adapters.notifications import (
     AbstractNotifications,
-    EmailNotifications,
+    AsyncEmailNotifications,
+    PooledEmailNotifications,
+)
+from allocation.adapters.tracing import Tracer
+from allocation.adapters.view_cache import AbstractViewCache, view_cache_from_config
+from allocation.domain import commands, events
+from allocation.service_layer import (
+    handlers,
+    messagebus,
+    outbox,
+    projector,
+    sharding,
+    unit_of_work,
 )
-from allocation.service_layer import handlers, messagebus, unit_of_work
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+    uow: unit_of_work.AbstractUnitOfWork = None,
     notifications: AbstractNotifications = None,
-    publish: Callable = redis_eventpublisher.publish,
-) -> messagebus.MessageBus:
+    publish: Callable = None,
+    batch_events: bool = False,
+    asynchronous: bool = False,
+    use_outbox: bool = False,
+    view_cache: AbstractViewCache = None,
+    retry_policy: messagebus.RetryPolicy = None,
+    write_behind: bool = False,
+    batch_projection: bool = False,
+    metrics: AbstractMetrics = None,
+    tracer: Tracer = None,
+) -> Union[messagebus.MessageBus, messagebus.AsyncMessageBus]:
 
-    if notifications is None:
-        notifications = EmailNotifications()
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            outbox_event_types=tuple(handlers.OUTBOX_HANDLERS) if use_outbox else (),
+            projected_event_types=(
+                projector.PROJECTED_EVENTS if batch_projection else ()
+            ),
+        )
+
+    store = None
+    if write_behind:
+        # keeps the given unit of work's database, but only writes to it later
+        store = write_behind.shared_store(
+            config.get_write_behind_log_path(), uow.session_factory
+        )
+        uow = unit_of_work.WriteBehindUnitOfWork(store, uow.session_factory)
+
+    if use_outbox:
+        require_event_types(
+            uow, "outbox_event_types", handlers.OUTBOX_HANDLERS, "use_outbox"
+        )
+
+    if batch_projection:
+        # write-behind commits don't reach the database in a transaction that
+        # could count them
+        require_event_types(
+            uow,
+            "projected_event_types",
+            projector.PROJECTED_EVENTS,
+            "batch_projection",
+        )
+
+    if notifications is None and not use_outbox:
+        notifications = (
+            AsyncEmailNotifications() if asynchronous else PooledEmailNotifications()
+        )
+
+    if publish is None:
+        publish = (
+            redis_eventpublisher.publish_async
+            if asynchronous
+            else redis_eventpublisher.publish
+        )
+
+    if retry_policy is None:
+        retry_policy = default_retry_policy()
+
+    if metrics is not None:
+        uow.metrics = metrics
+
+    if tracer is not None:
+        uow.tracer = tracer
+
+    if asynchronous:
+        uow = unit_of_work.AsyncUnitOfWork(uow)
 
     if start_orm:
         orm.start_mappers()
 
-    dependencies = {"uow": uow, "notifications": notifications, "publish": publish}
-    injected_event_handlers = {
+    if store is not None and not store.started:
+        store.start()
+        atexit.register(store.stop)
+
+    read_model = None
+    if batch_projection:
+        # projects on its own thread, so it can't share the bus's session
+        read_model = projector.ReadModelProjector(
+            unit_of_work.SqlAlchemyUnitOfWork(uow.session_factory), view_cache
+        )
+        read_model.catch_up()
+
+    injected_event_handlers, injected_command_handlers = compile_handlers(
+        bus_event_handlers(use_outbox, read_model),
+        {
+            "uow": uow,
+            "notifications": notifications,
+            "publish": publish,
+            "view_cache": view_cache,
+        },
+        metrics,
+        tracer,
+    )
+
+    if asynchronous:
+        bus = messagebus.AsyncMessageBus(
+            uow=uow,
+            event_handlers=injected_event_handlers,
+            command_handlers=injected_command_handlers,
+            retry_policy=retry_policy,
+            metrics=metrics,
+        )
+    else:
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers=injected_event_handlers,
+            command_handlers=injected_command_handlers,
+            batch_events=batch_events,
+            retry_policy=retry_policy,
+            metrics=metrics,
+        )
+    add_idle_hooks(bus, read_model, publish)
+    return bus
+
+
+def require_event_types(
+    uow, attribute: str, event_types: Iterable[type], option: str
+):
+    missing = set(event_types) - set(getattr(uow, attribute, ()))
+    if missing:
+        raise ValueError(
+            f"{option} needs a unit of work made with {attribute}"
+            f" including {', '.join(sorted(t.__name__ for t in missing))}"
+        )
+
+
+def default_retry_policy() -> messagebus.RetryPolicy:
+    return messagebus.RetryPolicy(
+        attempts=3, retry_on=(unit_of_work.ConcurrencyConflict,)
+    )
+
+
+def bus_event_handlers(
+    use_outbox: bool, read_model: projector.ReadModelProjector = None
+) -> Dict[Type[events.Event], List[Callable]]:
+    # the outbox's handlers run after the commit, in the OutboxDispatcher, and
+    # a read model projector stands in for the read model's handlers
+    outboxed = handlers.OUTBOX_HANDLERS if use_outbox else {}
+    return {
         event_type: [
-            inject_dependencies(handler, dependencies)
+            (
+                read_model.add
+                if read_model is not None and handler in handlers.READ_MODEL_HANDLERS
+                else handler
+            )
             for handler in event_handlers
+            if handler not in outboxed.get(event_type, [])
         ]
         for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
     }
-    injected_command_handlers = {
-        command_type: inject_dependencies(handler, dependencies)
+
+
+def compile_handlers(
+    event_handlers: Dict[Type[events.Event], List[Callable]],
+    dependencies: Dict[str, object],
+    metrics: AbstractMetrics = None,
+    tracer: Tracer = None,
+) -> Tuple[messagebus.HandlerTable, Dict[Type[commands.Command], Callable]]:
+    def compile_handler(handler):
+        compiled = inject_dependencies(handler, dependencies)
+        if metrics is not None:
+            compiled = messagebus.instrumented(compiled, metrics)
+        if tracer is not None:
+            compiled = messagebus.traced(compiled, tracer)
+        return compiled
+
+    compiled_event_handlers = messagebus.HandlerTable(
+        {
+            event_type: [compile_handler(handler) for handler in handlers_for_type]
+            for event_type, handlers_for_type in event_handlers.items()
+        }
+    )
+    compiled_command_handlers = {
+        command_type: compile_handler(handler)
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
+    return compiled_event_handlers, compiled_command_handlers
 
-    return messagebus.MessageBus(
-        uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers,
-    )
+
+def add_idle_hooks(bus, read_model, publish):
+    if read_model is not None:
+        bus.add_idle_hook(read_model.flush)
+    if isinstance(publish, redis_eventpublisher.BufferedPublisher):
+        # by then, the events of the message's commits have been published;
+        # they are sent in the background, not by the thread handling messages
+        bus.add_idle_hook(functools.partial(publish.flush, wait=False))
 
 
 def inject_dependencies(handler, dependencies):
-    params = inspect.signature(handler).parameters
+    # binds them once per bus, which is what makes bootstrapping cheap; a call
+    # through the partial costs about what one through a forwarding lambda did
+    names = dependency_names(handler)
+    if not names:
+        return handler
     deps = {
-        name: dependency
-        for name, dependency in dependencies.items()
-        if name in params
+        name: dependency for name, dependency in dependencies.items() if name in names
+    }
+    return functools.update_wrapper(functools.partial(handler, **deps), handler)
+
+
+def dependency_names(handler) -> Tuple[str, ...]:
+    # every parameter after the message. Handler functions are inspected once
+    # per process rather than each time a bus is bootstrapped
+    if inspect.isfunction(handler):
+        return _function_dependency_names(handler)
+    return tuple(inspect.signature(handler).parameters)[1:]
+
+
+@functools.lru_cache(maxsize=None)
+def _function_dependency_names(handler) -> Tuple[str, ...]:
+    return tuple(inspect.signature(handler).parameters)[1:]
+
+
+def bootstrap_outbox_dispatcher(
+    uow: unit_of_work.SqlAlchemyUnitOfWork = None,
+    notifications: AbstractNotifications = None,
+    publish: Callable = redis_eventpublisher.publish,
+    batch_size: int = 100,
+    tracer: Tracer = None,
+) -> outbox.OutboxDispatcher:
+
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
+    if notifications is None:
+        # rows are deleted once their handlers return, so they must have sent
+        notifications = PooledEmailNotifications(digest_window=0)
+
+    dependencies = {"notifications": notifications, "publish": publish}
+    injected_event_handlers = {
+        event_type: [
+            inject_dependencies(handler, dependencies) for handler in event_handlers
+        ]
+        for event_type, event_handlers in handlers.OUTBOX_HANDLERS.items()
     }
-    return lambda message: handler(message, **deps)
+    return outbox.OutboxDispatcher(uow, injected_event_handlers, batch_size, tracer)
+
+
+def bootstrap_sharded(
+    start_orm: bool = True,
+    processes: int = None,
+    uow: unit_of_work.AbstractUnitOfWork = None,
+    bus_factory: Callable[[], messagebus.MessageBus] = None,
+) -> sharding.ShardedDispatcher:
+
+    if processes is None:
+        processes = config.get_allocation_workers()
+
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
+
+    if bus_factory is None:
+        bus_factory = bootstrap_shard
+
+    if start_orm:
+        orm.start_mappers()
+
+    return sharding.ShardedDispatcher(bus_factory, uow, processes)
+
+
+def bootstrap_shard() -> messagebus.MessageBus:
+    # runs in the worker process. The api and the redis consumer still write
+    # to the same skus without going through the dispatcher, so the worker's
+    # aggregates can't be cached on the assumption that only it changes them
+    return bootstrap(view_cache=view_cache_from_config())
+
+
+def bootstrap_per_request(
+    start_orm: bool = True,
+    session_factory=None,
+    notifications: AbstractNotifications = None,
+    publish: Callable = None,
+    view_cache: AbstractViewCache = None,
+    batch_events: bool = False,
+    use_outbox: bool = False,
+    retry_policy: messagebus.RetryPolicy = None,
+    batch_projection: bool = False,
+    metrics: AbstractMetrics = None,
+    tracer: Tracer = None,
+) -> Callable[[], messagebus.MessageBus]:
+    # a MessageBus and its unit of work are only ever used by one thread at a
+    # time, so threaded servers get a new pair for each request; the handlers,
+    # adapters and the connection pool behind them are shared by the whole
+    # process, with the handlers bound to whichever unit of work is current
+
+    if session_factory is None:
+        session_factory = unit_of_work.default_session_factory
+
+    if notifications is None and not use_outbox:
+        notifications = PooledEmailNotifications()
+
+    if publish is None:
+        publish = redis_eventpublisher.publish
+
+    if retry_policy is None:
+        retry_policy = default_retry_policy()
+
+    if start_orm:
+        orm.start_mappers()
+
+    read_model = None
+    if batch_projection:
+        read_model = projector.ReadModelProjector(
+            unit_of_work.SqlAlchemyUnitOfWork(session_factory), view_cache
+        )
+        read_model.catch_up()
+
+    event_handlers, command_handlers = compile_handlers(
+        bus_event_handlers(use_outbox, read_model),
+        {
+            "uow": unit_of_work.CurrentUnitOfWork(),
+            "notifications": notifications,
+            "publish": publish,
+            "view_cache": view_cache,
+        },
+        metrics,
+        tracer,
+    )
+    outbox_event_types = tuple(handlers.OUTBOX_HANDLERS) if use_outbox else ()
+    projected_event_types = projector.PROJECTED_EVENTS if batch_projection else ()
+
+    def make_bus() -> messagebus.MessageBus:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory,
+            outbox_event_types,
+            projected_event_types=projected_event_types,
+        )
+        uow.metrics = metrics
+        uow.tracer = tracer
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers=event_handlers,
+            command_handlers=command_handlers,
+            batch_events=batch_events,
+            retry_policy=retry_policy,
+            metrics=metrics,
+        )
+        add_idle_hooks(bus, read_model, publish)
+        return bus
+
+    return make_bus
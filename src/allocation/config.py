@@ -9,18 +9,94 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_postgres_isolation_level():
+    return os.environ.get("DB_ISOLATION_LEVEL", "READ COMMITTED")
+
+
+def get_db_pool_size():
+    return int(os.environ.get("DB_POOL_SIZE", 5))
+
+
+def get_db_max_overflow():
+    return int(os.environ.get("DB_MAX_OVERFLOW", 10))
+
+
+def get_db_pool_timeout():
+    return float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+
+def get_db_pool_recycle():
+    return int(os.environ.get("DB_POOL_RECYCLE", -1))
+
+
+def get_db_expire_on_commit():
+    return os.environ.get("DB_EXPIRE_ON_COMMIT", "1") == "1"
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
 
 
+def get_api_workers():
+    return int(os.environ.get("API_WORKERS", 2 * (os.cpu_count() or 1) + 1))
+
+
+def get_api_threads():
+    return int(os.environ.get("API_THREADS", 4))
+
+
+def get_api_use_outbox():
+    return os.environ.get("API_USE_OUTBOX", "0") == "1"
+
+
+def get_api_batch_projection():
+    return os.environ.get("API_BATCH_PROJECTION", "0") == "1"
+
+
+def get_view_cache_enabled():
+    return os.environ.get("VIEW_CACHE_ENABLED", "0") == "1"
+
+
+def get_metrics_enabled():
+    return os.environ.get("METRICS_ENABLED", "0") == "1"
+
+
+def get_trace_file():
+    return os.environ.get("TRACE_FILE")
+
+
+def get_trace_collector_url():
+    return os.environ.get("TRACE_COLLECTOR_URL")
+
+
+def get_trace_service_name():
+    return os.environ.get("TRACE_SERVICE_NAME", "allocation")
+
+
 def get_redis_host_and_port():
     host = os.environ.get("REDIS_HOST", "localhost")
     port = 63791 if host == "localhost" else 6379
     return dict(host=host, port=port)
 
 
+def get_redis_max_connections():
+    return int(os.environ.get("REDIS_MAX_CONNECTIONS", 10))
+
+
+def get_redis_consumer_workers():
+    return int(os.environ.get("REDIS_CONSUMER_WORKERS", 1))
+
+
+def get_allocation_workers():
+    return int(os.environ.get("ALLOCATION_WORKERS", os.cpu_count() or 1))
+
+
+def get_write_behind_log_path():
+    return os.environ.get("WRITE_BEHIND_LOG", "/tmp/allocation-commits.log")
+
+
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
@@ -1,6 +1,6 @@
 # pylint: disable=too-few-public-methods
 from datetime import date
-from typing import Optional
+from typing import List, Optional, Tuple
 from dataclasses import dataclass
 
 
@@ -15,6 +15,12 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateMany(Command):
+    orderid: str
+    lines: List[Tuple[str, int]]  # (sku, qty) pairs
+
+
 @dataclass
 class CreateBatch(Command):
     ref: str
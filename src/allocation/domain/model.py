@@ -1,7 +1,9 @@
 from __future__ import annotations
+import bisect
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Callable, Deque, Iterable, Optional, List, Set, Tuple
 from . import commands, events
 
 
@@ -10,32 +12,65 @@ class Product:
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
-        self.events = []  # type: List[events.Event]
+        self.events = deque()  # type: Deque[events.Event]
+        # the batches it was sorted from, and the sorted batches
+        self._eta_index = None  # type: Optional[Tuple[List[Batch], List[Batch]]]
+
+    def add_batch(self, batch: Batch):
+        # a new version, like any other change, so cached copies are stale
+        self.batches.append(batch)
+        self.version_number += 1
 
     def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
+        batchref = self._allocate(line)
+        if batchref is not None:
             self.version_number += 1
-            self.events.append(
-                events.Allocated(
-                    orderid=line.orderid,
-                    sku=line.sku,
-                    qty=line.qty,
-                    batchref=batch.reference,
-                )
-            )
-            return batch.reference
+        return batchref
+
+    def change_batch_quantity(
+        self, ref: str, qty: int, policy: DeallocationPolicy = None
+    ):
+        # lines the smaller batch can no longer hold are reallocated right away,
+        # as part of the same change
+        batch = next(b for b in self.batches if b.reference == ref)
+        batch.change_purchased_quantity(qty)
+        self.version_number += 1
+        displaced = batch.deallocate_excess(policy or best_fit)
+        for line in displaced:
+            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+        for line in displaced:
+            self._allocate(line)
+
+    def _allocate(self, line: OrderLine) -> Optional[str]:
+        try:
+            batch = next(b for b in self._batches_by_eta() if b.can_allocate(line))
         except StopIteration:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.allocate(line)
+        self.events.append(
+            events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference,
+            )
+        )
+        return batch.reference
+
+    def _batches_by_eta(self) -> List[Batch]:
+        # rebuilt lazily whenever self.batches no longer holds the very batches
+        # it was sorted from, since the ORM and handlers change it directly
+        index = self._eta_index
+        if index is None or not _same_items(index[0], self.batches):
+            index = (list(self.batches), sorted(self.batches, key=Batch.eta_key))
+            self._eta_index = index
+        return index[1]
 
-    def change_batch_quantity(self, ref: str, qty: int):
-        batch = next(b for b in self.batches if b.reference == ref)
-        batch._purchased_quantity = qty
-        while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(events.Deallocated(line.orderid, line.sku, line.qty))
+
+def _same_items(these: List, those: List) -> bool:
+    # by identity, as batches compare equal by reference alone
+    return len(these) == len(those) and all(a is b for a, b in zip(these, those))
 
 
 @dataclass(unsafe_hash=True)
@@ -52,6 +87,7 @@ class Batch:
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0  # type: Optional[int]
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -71,16 +107,37 @@ class Batch:
             return True
         return self.eta > other.eta
 
+    def eta_key(self) -> Tuple[bool, date]:
+        return (self.eta is not None, self.eta or date.min)
+
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
-
-    def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+            self._allocated_quantity = self.allocated_quantity + line.qty
+
+    def deallocate(self, line: OrderLine):
+        if line in self._allocations:
+            self._allocations.remove(line)
+            self._allocated_quantity = self.allocated_quantity - line.qty
+
+    def deallocate_excess(self, policy: DeallocationPolicy) -> List[OrderLine]:
+        shortfall = -self.available_quantity
+        if shortfall <= 0:
+            return []
+        lines = policy(self._allocations, shortfall)
+        for line in lines:
+            self.deallocate(line)
+        return lines
+
+    def change_purchased_quantity(self, qty: int):
+        self._purchased_quantity = qty
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        # running total; only summed once after the ORM (re)loads _allocations
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -88,3 +145,31 @@ class Batch:
 
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
+
+
+# picks the lines to deallocate from a batch, given the quantity to free up
+DeallocationPolicy = Callable[[Iterable[OrderLine], int], List[OrderLine]]
+
+
+def best_fit(lines: Iterable[OrderLine], shortfall: int) -> List[OrderLine]:
+    # the smallest line that covers what's left of the shortfall, or else the
+    # largest line, so as few orders as possible are moved and little stock is
+    # freed beyond what's needed; ties go by orderid, so the choice is stable
+    by_size = sorted((line.qty, line.orderid, line) for line in lines)
+    chosen = []
+    while shortfall > 0 and by_size:
+        i = bisect.bisect_left(by_size, (shortfall,))
+        qty, _, line = by_size.pop(min(i, len(by_size) - 1))
+        chosen.append(line)
+        shortfall -= qty
+    return chosen
+
+
+def largest_first(lines: Iterable[OrderLine], shortfall: int) -> List[OrderLine]:
+    chosen = []
+    for line in sorted(lines, key=lambda l: (-l.qty, l.orderid)):
+        if shortfall <= 0:
+            break
+        chosen.append(line)
+        shortfall -= line.qty
+    return chosen
@@ -0,0 +1,8 @@
+# the same api for an ASGI server, e.g.
+#   gunicorn -c allocation/entrypoints/gunicorn_conf.py \
+#       -k uvicorn.workers.UvicornWorker allocation.entrypoints.asgi:app
+# requests still run synchronously, on the event loop's default thread pool
+from asgiref.wsgi import WsgiToAsgi
+from allocation.entrypoints.flask_app import create_app
+
+app = WsgiToAsgi(create_app())
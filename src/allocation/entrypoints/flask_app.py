@@ -1,14 +1,84 @@
+import functools
 from datetime import datetime
-from flask import Flask, jsonify, request
+from typing import Callable, Optional
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request
+from allocation.adapters import tracing
+from allocation.adapters.metrics import PrometheusMetrics
+from allocation.adapters.view_cache import AbstractViewCache, view_cache_from_config
 from allocation.domain import commands
-from allocation.service_layer.handlers import InvalidSku
-from allocation import bootstrap, views
+from allocation.service_layer.handlers import DuplicateLine, InvalidSku
+from allocation.service_layer.messagebus import MessageBus
+from allocation import bootstrap, config, views
 
-app = Flask(__name__)
-bus = bootstrap.bootstrap()
+api = Blueprint("allocation", __name__)
 
 
-@app.route("/add_batch", methods=["POST"])
+def create_app(
+    make_bus: Callable[[], MessageBus] = None,
+    view_cache: AbstractViewCache = None,
+    metrics: PrometheusMetrics = None,
+    tracer: tracing.Tracer = None,
+) -> Flask:
+    # one app per process; each request gets its own bus and unit of work, so
+    # the app can be served by any number of threads
+    if view_cache is None and make_bus is None:
+        # a given make_bus's handlers couldn't invalidate it
+        view_cache = view_cache_from_config()
+    if metrics is None and config.get_metrics_enabled():
+        metrics = PrometheusMetrics()
+    if metrics is not None and view_cache is not None:
+        metrics.add_collector("view_cache", view_cache.stats)
+    if tracer is None:
+        tracer = tracing.tracer_from_config()
+    if make_bus is None:
+        make_bus = bootstrap.bootstrap_per_request(
+            view_cache=view_cache,
+            use_outbox=config.get_api_use_outbox(),
+            batch_projection=config.get_api_batch_projection(),
+            metrics=metrics,
+            tracer=tracer,
+        )
+
+    app = Flask(__name__)
+    app.extensions["allocation"] = dict(
+        make_bus=make_bus, view_cache=view_cache, metrics=metrics, tracer=tracer
+    )
+    app.register_blueprint(api)
+    return app
+
+
+def get_bus() -> MessageBus:
+    if "bus" not in g:
+        g.bus = current_app.extensions["allocation"]["make_bus"]()
+    return g.bus
+
+
+def get_view_cache() -> Optional[AbstractViewCache]:
+    return current_app.extensions["allocation"]["view_cache"]
+
+
+def traced_request(view):
+    # continues the caller's trace, if it sent a traceparent header, and
+    # hands the trace on in the response's
+    @functools.wraps(view)
+    def traced_view(*args, **kwargs):
+        tracer = current_app.extensions["allocation"]["tracer"]
+        if tracer is None:
+            return view(*args, **kwargs)
+        with tracer.span(
+            f"{request.method} {request.url_rule.rule}",
+            request.headers.get("traceparent"),
+        ) as span:
+            response = current_app.make_response(view(*args, **kwargs))
+            span.attributes["http.status_code"] = str(response.status_code)
+        response.headers["traceparent"] = span.traceparent
+        return response
+
+    return traced_view
+
+
+@api.route("/add_batch", methods=["POST"])
+@traced_request
 def add_batch():
     eta = request.json["eta"]
     if eta is not None:
@@ -16,26 +86,55 @@ def add_batch():
     cmd = commands.CreateBatch(
         request.json["ref"], request.json["sku"], request.json["qty"], eta
     )
-    bus.handle(cmd)
+    get_bus().handle(cmd)
     return "OK", 201
 
 
-@app.route("/allocate", methods=["POST"])
+@api.route("/allocate", methods=["POST"])
+@traced_request
 def allocate_endpoint():
     try:
         cmd = commands.Allocate(
             request.json["orderid"], request.json["sku"], request.json["qty"]
         )
-        bus.handle(cmd)
+        get_bus().handle(cmd)
     except InvalidSku as e:
         return {"message": str(e)}, 400
 
     return "OK", 202
 
 
-@app.route("/allocations/<orderid>", methods=["GET"])
+@api.route("/allocate_many", methods=["POST"])
+@traced_request
+def allocate_many_endpoint():
+    try:
+        cmd = commands.AllocateMany(
+            request.json["orderid"],
+            [(l["sku"], l["qty"]) for l in request.json["lines"]],
+        )
+        batchrefs = get_bus().handle(cmd)
+    except (InvalidSku, DuplicateLine) as e:
+        return {"message": str(e)}, 400
+
+    results = [
+        {"sku": sku, "qty": qty, "batchref": batchref}
+        for (sku, qty), batchref in zip(cmd.lines, batchrefs)
+    ]
+    return jsonify(results), 202
+
+
+@api.route("/allocations/<orderid>", methods=["GET"])
+@traced_request
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, get_bus().uow, get_view_cache())
     if not result:
         return "not found", 404
     return jsonify(result), 200
+
+
+@api.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    metrics = current_app.extensions["allocation"]["metrics"]
+    if metrics is None:
+        return "metrics are disabled", 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,8 @@
+# gunicorn settings for the api, from the same environment as everything else
+from allocation import config
+
+bind = "0.0.0.0:80"
+workers = config.get_api_workers()
+threads = config.get_api_threads()
+# each worker builds its own app, and so its own connection pool, after forking
+preload_app = False
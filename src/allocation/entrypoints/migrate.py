@@ -0,0 +1,16 @@
+import logging
+from sqlalchemy import create_engine
+
+from allocation import config
+from allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info("Upgrading schema")
+    orm.upgrade_schema(create_engine(config.get_postgres_uri()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import logging
+
+from allocation import bootstrap
+from allocation.adapters import tracing
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logger.info("Outbox dispatcher starting")
+    dispatcher = bootstrap.bootstrap_outbox_dispatcher(
+        tracer=tracing.tracer_from_config()
+    )
+    dispatcher.run()
+
+
+if __name__ == "__main__":
+    main()
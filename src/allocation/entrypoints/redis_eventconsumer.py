@@ -1,30 +1,236 @@
+# pylint: disable=broad-except
 import json
 import logging
+import socket
+import threading
+from typing import Dict, List, Optional, Tuple
 import redis
 
 from allocation import bootstrap, config
+from allocation.adapters import tracing
+from allocation.adapters.view_cache import view_cache_from_config
 from allocation.domain import commands
+from allocation.service_layer import unit_of_work
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+r = None
 
+STREAM = "change_batch_quantity"
+GROUP = "allocation"
+BATCH_SIZE = 100
+BLOCK_MS = 1000
+# entries left unacked this long, by a consumer that failed or died, are
+# claimed and tried again; after MAX_DELIVERIES they go to the DEAD_LETTERS
+# stream instead, with the id they had and how often they were delivered
+CLAIM_IDLE_MS = 60000
+MAX_DELIVERIES = 5
+DEAD_LETTERS = f"{STREAM}.dead"
+# consumers apply changes to one batch one at a time, holding its lock, and
+# record the id of the last entry applied to it; an older entry, e.g. one
+# reclaimed from a consumer that died, is acked without being applied
+LOCK_TIMEOUT = CLAIM_IDLE_MS / 1000
+APPLIED = f"{STREAM}.applied"
 
-def main():
-    logger.info("Redis pubsub starting")
-    bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe("change_batch_quantity")
 
-    for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
+def get_client() -> redis.Redis:
+    global r  # pylint: disable=global-statement,invalid-name
+    if r is None:
+        r = redis.Redis(**config.get_redis_host_and_port())
+    return r
 
 
-def handle_change_batch_quantity(m, bus):
-    logger.info("handling %s", m)
-    data = json.loads(m["data"])
-    cmd = commands.ChangeBatchQuantity(ref=data["batchref"], qty=data["qty"])
-    bus.handle(cmd)
+def main(workers: int = None):
+    logger.info("Redis stream consumer starting")
+    workers = workers or config.get_redis_consumer_workers()
+    create_consumer_group()
+    tracer = tracing.tracer_from_config()
+    view_cache = view_cache_from_config()
+    buses = [
+        bootstrap.bootstrap(
+            start_orm=i == 0,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(),
+            view_cache=view_cache,
+            tracer=tracer,
+        )
+        for i in range(workers)
+    ]
+    threads = [
+        threading.Thread(
+            target=consume,
+            # the same names after a restart, to pick up their pending entries
+            args=(bus, f"{socket.gethostname()}-{i}"),
+            kwargs=dict(tracer=tracer),
+        )
+        for i, bus in enumerate(buses)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def create_consumer_group(client=None):
+    client = client or get_client()
+    try:
+        client.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def consume(bus, consumer, client=None, tracer: tracing.Tracer = None):
+    client = client or get_client()
+    # start with anything this consumer read but never acked, until none of it
+    # can be, then new messages
+    last_id = "0"
+    while True:
+        acked = consume_batch(bus, consumer, last_id, client, tracer)
+        if last_id == "0" and not acked:
+            last_id = ">"
+        reclaim(bus, consumer, client, tracer)
+
+
+def consume_batch(
+    bus, consumer, last_id=">", client=None, tracer: tracing.Tracer = None
+) -> int:
+    client = client or get_client()
+    response = client.xreadgroup(
+        GROUP, consumer, {STREAM: last_id}, count=BATCH_SIZE, block=BLOCK_MS
+    )
+    messages = response[0][1] if response else []
+    return handle_messages(bus, messages, client, tracer)
+
+
+def reclaim(bus, consumer, client=None, tracer: tracing.Tracer = None) -> int:
+    client = client or get_client()
+    _, messages, *_ = client.xautoclaim(
+        STREAM, GROUP, consumer, CLAIM_IDLE_MS, count=BATCH_SIZE
+    )
+    if not messages:
+        return 0
+    deliveries = {
+        entry["message_id"]: entry["times_delivered"]
+        for entry in client.xpending_range(
+            STREAM,
+            GROUP,
+            min=messages[0][0],
+            max=messages[-1][0],
+            count=len(messages),
+            consumername=consumer,
+        )
+    }
+    retried = []
+    for message_id, fields in messages:
+        if deliveries.get(message_id, 0) > MAX_DELIVERIES:
+            logger.error(
+                "giving up on %s after %d deliveries",
+                message_id,
+                deliveries[message_id],
+            )
+            dead_letter(message_id, fields, client, deliveries=deliveries[message_id])
+        else:
+            retried.append((message_id, fields))
+    return handle_messages(bus, retried, client, tracer)
+
+
+def dead_letter(message_id, fields, client, **reason):
+    # fields are None for an entry deleted from the stream while pending
+    client.xadd(DEAD_LETTERS, dict(fields or {}, id=message_id, **reason))
+    client.xack(STREAM, GROUP, message_id)
+
+
+def handle_messages(bus, messages, client, tracer: tracing.Tracer = None) -> int:
+    # acks what was handled or dead-lettered and returns how many entries that
+    # was; the rest stay pending, for reclaim() to retry once they have been
+    # idle long enough
+    acked = 0
+    changes = []  # type: List[Tuple[bytes, Change]]
+    for message_id, fields in messages:
+        try:
+            changes.append((message_id, parse(fields)))
+        except Exception as e:
+            logger.exception("Malformed entry %s", message_id)
+            dead_letter(message_id, fields, client, error=repr(e))
+            acked += 1
+    for cmd, message_ids, traceparent in coalesce(changes):
+        try:
+            if not handle_in_order(
+                cmd, message_ids[-1], bus, client, tracer, traceparent
+            ):
+                continue
+        except Exception:
+            logger.exception("Exception handling %s", cmd)
+            continue
+        client.xack(STREAM, GROUP, *message_ids)
+        acked += len(message_ids)
+    return acked
+
+
+Change = Tuple[commands.ChangeBatchQuantity, Optional[str]]
+Coalesced = Tuple[commands.ChangeBatchQuantity, List[bytes], Optional[str]]
+
+
+def parse(fields) -> Change:
+    data = json.loads(fields[b"data"])
+    cmd = commands.ChangeBatchQuantity(
+        ref=str(data["batchref"]), qty=int(data["qty"])
+    )
+    return cmd, data.get("traceparent")
+
+
+def coalesce(changes: List[Tuple[bytes, Change]]) -> List[Coalesced]:
+    # only the last quantity for each batch matters, and it's that message's
+    # trace that the change is handled in
+    latest = {}  # type: Dict[str, Coalesced]
+    for message_id, (cmd, traceparent) in changes:
+        _, message_ids, _ = latest.get(cmd.ref, (None, [], None))
+        latest[cmd.ref] = (cmd, message_ids + [message_id], traceparent)
+    return list(latest.values())
+
+
+def handle_in_order(
+    cmd,
+    message_id: bytes,
+    bus,
+    client,
+    tracer: tracing.Tracer = None,
+    traceparent: str = None,
+) -> bool:
+    # False, leaving the entries pending, if another consumer is applying a
+    # change to the same batch
+    lock = client.lock(f"{STREAM}.lock:{cmd.ref}", timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        applied = client.hget(APPLIED, cmd.ref)
+        if applied and stream_position(message_id) < stream_position(applied):
+            logger.info("skipping %s, %s is older than %s", cmd, message_id, applied)
+        else:
+            handle_change_batch_quantity(cmd, bus, tracer, traceparent)
+            client.hset(APPLIED, cmd.ref, message_id)
+    finally:
+        lock.release()
+    return True
+
+
+def stream_position(message_id: bytes) -> Tuple[int, int]:
+    milliseconds, sequence = message_id.split(b"-")
+    return int(milliseconds), int(sequence)
+
+
+def handle_change_batch_quantity(
+    cmd, bus, tracer: tracing.Tracer = None, traceparent: str = None
+):
+    logger.info("handling %s", cmd)
+    with tracing.span(
+        tracer,
+        f"consume {STREAM}",
+        traceparent,
+        batchref=cmd.ref,
+        qty=cmd.qty,
+    ):
+        bus.handle(cmd)
 
 
 if __name__ == "__main__":
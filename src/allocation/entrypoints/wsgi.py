@@ -0,0 +1,5 @@
+# the multi-process, multi-threaded way to serve the api, e.g.
+#   gunicorn -c allocation/entrypoints/gunicorn_conf.py allocation.entrypoints.wsgi:app
+from allocation.entrypoints.flask_app import create_app
+
+app = create_app()
@@ -1,12 +1,12 @@
 # pylint: disable=unused-argument
 from __future__ import annotations
-from dataclasses import asdict
-from typing import List, Dict, Callable, Type, TYPE_CHECKING
+from typing import List, Dict, Callable, Optional, Type, TYPE_CHECKING
+from allocation.adapters.repository import Loading
 from allocation.domain import commands, events, model
 from allocation.domain.model import OrderLine
 
 if TYPE_CHECKING:
-    from allocation.adapters import notifications
+    from allocation.adapters import notifications, view_cache as cache
     from . import unit_of_work
 
 
@@ -14,16 +14,27 @@ class InvalidSku(Exception):
     pass
 
 
+class DuplicateLine(Exception):
+    pass
+
+
+def handles_batches(handler: Callable) -> Callable:
+    # the bus passes these handlers a list of consecutive events of one type
+    handler.handles_batches = True  # type: ignore
+    return handler
+
+
 def add_batch(
     cmd: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
 ):
     with uow:
-        product = uow.products.get(sku=cmd.sku)
+        # adding a batch never touches existing allocations
+        product = uow.products.get(sku=cmd.sku, loading=Loading.LAZY)
         if product is None:
             product = model.Product(cmd.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+        product.add_batch(model.Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
         uow.commit()
 
 
@@ -40,11 +51,26 @@ def allocate(
         uow.commit()
 
 
-def reallocate(
-    event: events.Deallocated,
+def allocate_many(
+    cmd: commands.AllocateMany,
     uow: unit_of_work.AbstractUnitOfWork,
-):
-    allocate(commands.Allocate(**asdict(event)), uow=uow)
+) -> List[Optional[str]]:
+    # the batchref each line was allocated to, in order, or None if out of stock
+    lines = [OrderLine(cmd.orderid, sku, qty) for sku, qty in cmd.lines]
+    # equal lines are one allocation to a batch, so a second would be dropped
+    duplicates = [line for i, line in enumerate(lines) if line in lines[:i]]
+    if duplicates:
+        line = duplicates[0]
+        raise DuplicateLine(f"Duplicate line {line.sku} x {line.qty}")
+    with uow:
+        products = {}  # type: Dict[str, model.Product]
+        for sku in dict.fromkeys(line.sku for line in lines):
+            products[sku] = uow.products.get(sku=sku)
+            if products[sku] is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+        batchrefs = [products[line.sku].allocate(line) for line in lines]
+        uow.commit()
+    return batchrefs
 
 
 def change_batch_quantity(
@@ -64,7 +90,7 @@ def send_out_of_stock_notification(
     event: events.OutOfStock,
     notifications: notifications.AbstractNotifications,
 ):
-    notifications.send(
+    return notifications.send(
         "stock@made.com",
         f"Out of stock for {event.sku}",
     )
@@ -74,12 +100,14 @@ def publish_allocated_event(
     event: events.Allocated,
     publish: Callable,
 ):
-    publish("line_allocated", event)
+    return publish("line_allocated", event)
 
 
+@handles_batches
 def add_allocation_to_read_model(
-    event: events.Allocated,
+    allocated: List[events.Allocated],
     uow: unit_of_work.SqlAlchemyUnitOfWork,
+    view_cache: Optional[cache.AbstractViewCache],
 ):
     with uow:
         uow.session.execute(
@@ -87,14 +115,20 @@ def add_allocation_to_read_model(
             INSERT INTO allocations_view (orderid, sku, batchref)
             VALUES (:orderid, :sku, :batchref)
             """,
-            dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref),
+            [
+                dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref)
+                for e in allocated
+            ],
         )
         uow.commit()
+    invalidate_cached_views(allocated, view_cache)
 
 
+@handles_batches
 def remove_allocation_from_read_model(
-    event: events.Deallocated,
+    deallocated: List[events.Deallocated],
     uow: unit_of_work.SqlAlchemyUnitOfWork,
+    view_cache: Optional[cache.AbstractViewCache],
 ):
     with uow:
         uow.session.execute(
@@ -102,19 +136,40 @@ def remove_allocation_from_read_model(
             DELETE FROM allocations_view
             WHERE orderid = :orderid AND sku = :sku
             """,
-            dict(orderid=event.orderid, sku=event.sku),
+            [dict(orderid=e.orderid, sku=e.sku) for e in deallocated],
         )
         uow.commit()
+    invalidate_cached_views(deallocated, view_cache)
+
+
+def invalidate_cached_views(changes: List, view_cache):
+    if view_cache is not None:
+        for orderid in {e.orderid for e in changes}:
+            view_cache.invalidate(orderid)
 
 
 EVENT_HANDLERS = {
     events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
-    events.Deallocated: [remove_allocation_from_read_model, reallocate],
+    events.Deallocated: [remove_allocation_from_read_model],
     events.OutOfStock: [send_out_of_stock_notification],
 }  # type: Dict[Type[events.Event], List[Callable]]
 
+# external side-effects that bootstrap(use_outbox=True) moves out of the bus and
+# into the outbox, to be run by an OutboxDispatcher after the commit
+OUTBOX_HANDLERS = {
+    events.Allocated: [publish_allocated_event],
+    events.OutOfStock: [send_out_of_stock_notification],
+}  # type: Dict[Type[events.Event], List[Callable]]
+
+# what bootstrap(batch_projection=True) replaces with a ReadModelProjector
+READ_MODEL_HANDLERS = [
+    add_allocation_to_read_model,
+    remove_allocation_from_read_model,
+]
+
 COMMAND_HANDLERS = {
     commands.Allocate: allocate,
+    commands.AllocateMany: allocate_many,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
 }  # type: Dict[Type[commands.Command], Callable]
@@ -1,10 +1,32 @@
 # pylint: disable=broad-except, attribute-defined-outside-init
 from __future__ import annotations
+import asyncio
+import functools
+import inspect
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    Type,
+    TYPE_CHECKING,
+)
+from allocation.adapters.tracing import CURRENT_SPAN
 from allocation.domain import commands, events
+from allocation.service_layer.unit_of_work import CURRENT_UOW
 
 if TYPE_CHECKING:
+    from allocation.adapters.metrics import AbstractMetrics
+    from allocation.adapters.tracing import Span, Tracer
     from . import unit_of_work
 
 logger = logging.getLogger(__name__)
@@ -12,44 +34,307 @@ logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]
 
 
+@dataclass
+class RetryPolicy:
+    attempts: int = 1
+    backoff: float = 0.01  # seconds before the first retry, doubling after that
+    max_backoff: float = 0.5
+    retry_on: Tuple[Type[Exception], ...] = ()
+    on_retry: Optional[Callable[[Message, Exception], None]] = None
+
+    def delays(self) -> Iterator[float]:
+        # full jitter, so that conflicting workers don't retry in lockstep
+        for attempt in range(self.attempts - 1):
+            yield random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def retrying(self, message: Message, error: Exception, delay: Optional[float]):
+        if delay is None or not isinstance(error, self.retry_on):
+            return False
+        logger.info("retrying %s in %.3fs after %r", message, delay, error)
+        if self.on_retry:
+            self.on_retry(message, error)
+        return True
+
+
+class HandlerTable(dict):
+    # event handlers by event type. An event goes to the handlers of every
+    # registered type in its MRO, most specific first, so subclasses of an
+    # event are handled like it; each type is resolved once, on first use
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._resolved = {}  # type: Dict[type, Tuple[Callable, ...]]
+
+    def handlers_for(self, message_type: type) -> Tuple[Callable, ...]:
+        try:
+            return self._resolved[message_type]
+        except KeyError:
+            handlers = tuple(
+                handler
+                for base in message_type.__mro__
+                for handler in self.get(base, ())
+            )
+            self._resolved[message_type] = handlers
+            return handlers
+
+
+def as_handler_table(event_handlers: Dict[Type[events.Event], List[Callable]]):
+    # a HandlerTable is shared as it is, along with the types it has resolved
+    if isinstance(event_handlers, HandlerTable):
+        return event_handlers
+    return HandlerTable(event_handlers)
+
+
 class MessageBus:
+    idle_hooks = ()  # type: Tuple[Callable[[], None], ...]
+
     def __init__(
         self,
         uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
         command_handlers: Dict[Type[commands.Command], Callable],
+        batch_events: bool = False,
+        retry_policy: RetryPolicy = None,
+        metrics: AbstractMetrics = None,
     ):
         self.uow = uow
-        self.event_handlers = event_handlers
+        self.event_handlers = as_handler_table(event_handlers)
         self.command_handlers = command_handlers
+        self.batch_events = batch_events
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics
 
     def handle(self, message: Message):
-        self.queue = [message]
+        # returns whatever the command's handler returned, if it was a command
+        token = CURRENT_UOW.set(self.uow)
+        try:
+            return self._handle(message)
+        finally:
+            CURRENT_UOW.reset(token)
+
+    def _handle(self, message: Message):
+        result = None
+        self.queue = deque([message])  # type: Deque[Message]
         while self.queue:
-            message = self.queue.pop(0)
+            message = self.queue.popleft()
+            if self.metrics is not None:
+                self.metrics.observe_message(type(message).__name__, len(self.queue))
             if isinstance(message, events.Event):
                 self.handle_event(message)
             elif isinstance(message, commands.Command):
-                self.handle_command(message)
+                result = self.handle_command(message)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        for hook in self.idle_hooks:
+            hook()
+        return result
+
+    def add_idle_hook(self, hook: Callable[[], None]):
+        # called whenever a message and everything it led to has been handled
+        self.idle_hooks = self.idle_hooks + (hook,)
 
     def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+        batch = self._take_consecutive(event)
+        for handler in self.event_handlers.handlers_for(type(event)):
+            # batch handlers always get a list, even outside batch_events mode
+            calls = [batch] if getattr(handler, "handles_batches", False) else batch
+            for message in calls:
+                try:
+                    logger.debug(
+                        "handling event %s with handler %s", message, handler
+                    )
+                    handler(message)
+                    self.queue.extend(self.uow.collect_new_events())
+                except Exception:
+                    logger.exception("Exception handling event %s", message)
+                    continue
+
+    def _take_consecutive(self, event: events.Event) -> List[events.Event]:
+        batch = [event]
+        if self.batch_events:
+            while self.queue and type(self.queue[0]) is type(event):
+                batch.append(self.queue.popleft())
+        return batch
+
+    def handle_command(self, command: commands.Command):
+        logger.debug("handling command %s", command)
+        delays = self.retry_policy.delays()
+        while True:
             try:
-                logger.debug("handling event %s with handler %s", event, handler)
-                handler(event)
+                handler = self.command_handlers[type(command)]
+                result = handler(command)
                 self.queue.extend(self.uow.collect_new_events())
-            except Exception:
-                logger.exception("Exception handling event %s", event)
-                continue
+                return result
+            except Exception as e:
+                delay = next(delays, None)
+                if not self.retry_policy.retrying(command, e, delay):
+                    logger.exception("Exception handling command %s", command)
+                    raise
+            time.sleep(delay)
 
-    def handle_command(self, command: commands.Command):
+
+class AsyncMessageBus:
+    idle_hooks = ()  # type: Tuple[Callable[[], None], ...]
+
+    def __init__(
+        self,
+        uow: unit_of_work.AsyncUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        retry_policy: RetryPolicy = None,
+        metrics: AbstractMetrics = None,
+    ):
+        self.uow = uow
+        self.event_handlers = as_handler_table(event_handlers)
+        self.command_handlers = command_handlers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics
+
+    async def handle(self, message: Message):
+        result = None
+        queue = deque([message])  # type: Deque[Message]
+        while queue:
+            message = queue.popleft()
+            if self.metrics is not None:
+                self.metrics.observe_message(type(message).__name__, len(queue))
+            if isinstance(message, events.Event):
+                await self.handle_event(message)
+            elif isinstance(message, commands.Command):
+                result = await self.handle_command(message)
+            else:
+                raise Exception(f"{message} was not an Event or Command")
+            queue.extend(self.uow.collect_new_events())
+        for hook in self.idle_hooks:
+            await call_handler(hook)
+        return result
+
+    def add_idle_hook(self, hook: Callable[[], None]):
+        self.idle_hooks = self.idle_hooks + (hook,)
+
+    async def handle_event(self, event: events.Event):
+        await asyncio.gather(
+            *(
+                self._handle_event_with(handler, event)
+                for handler in self.event_handlers.handlers_for(type(event))
+            )
+        )
+
+    async def _handle_event_with(self, handler: Callable, event: events.Event):
+        try:
+            logger.debug("handling event %s with handler %s", event, handler)
+            if getattr(handler, "handles_batches", False):
+                await call_handler(handler, [event])
+            else:
+                await call_handler(handler, event)
+        except Exception:
+            logger.exception("Exception handling event %s", event)
+
+    async def handle_command(self, command: commands.Command):
         logger.debug("handling command %s", command)
+        delays = self.retry_policy.delays()
+        while True:
+            try:
+                handler = self.command_handlers[type(command)]
+                return await call_handler(handler, command)
+            except Exception as e:
+                delay = next(delays, None)
+                if not self.retry_policy.retrying(command, e, delay):
+                    logger.exception("Exception handling command %s", command)
+                    raise
+            await asyncio.sleep(delay)
+
+
+async def call_handler(handler: Callable, *args):
+    # sync handlers run in worker threads so they can't stall the event loop,
+    # and any awaitable they hand back (e.g. from an async adapter) is awaited
+    if inspect.iscoroutinefunction(inspect.unwrap(handler)):
+        result = handler(*args)
+    else:
+        result = await asyncio.to_thread(handler, *args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def instrumented(handler: Callable, metrics: AbstractMetrics) -> Callable:
+    # times each call of the handler, including anything awaitable it returns
+    name = getattr(handler, "__name__", repr(handler))
+
+    def observe(message, start, failed):
+        first = message[0] if isinstance(message, list) else message
+        metrics.observe_handler(
+            type(first).__name__, name, time.perf_counter() - start, failed
+        )
+
+    async def timed(message, start, awaitable):
         try:
-            handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            result = await awaitable
         except Exception:
-            logger.exception("Exception handling command %s", command)
+            observe(message, start, True)
             raise
+        observe(message, start, False)
+        return result
+
+    def run(message):
+        start = time.perf_counter()
+        try:
+            result = handler(message)
+        except Exception:
+            observe(message, start, True)
+            raise
+        if inspect.isawaitable(result):
+            return timed(message, start, result)
+        observe(message, start, False)
+        return result
+
+    if inspect.iscoroutinefunction(inspect.unwrap(handler)):
+
+        async def run_async(message):
+            return await timed(message, time.perf_counter(), handler(message))
+
+        return functools.update_wrapper(run_async, handler)
+    return functools.update_wrapper(run, handler)
+
+
+def traced(handler: Callable, tracer: Tracer) -> Callable:
+    # each call is a span, the parent of any spans (or traceparents) made by
+    # the handler, until anything awaitable it returns has completed
+    name = getattr(handler, "__name__", repr(handler))
+
+    def start(message) -> Span:
+        first = message[0] if isinstance(message, list) else message
+        return tracer.start(name, message_type=type(first).__name__)
+
+    async def finish_after(span, awaitable):
+        token = CURRENT_SPAN.set(span)
+        try:
+            result = await awaitable
+        except Exception as e:
+            tracer.finish(span, e)
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+        tracer.finish(span)
+        return result
+
+    def run(message):
+        span = start(message)
+        token = CURRENT_SPAN.set(span)
+        try:
+            result = handler(message)
+        except Exception as e:
+            tracer.finish(span, e)
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+        if inspect.isawaitable(result):
+            return finish_after(span, result)
+        tracer.finish(span)
+        return result
+
+    if inspect.iscoroutinefunction(inspect.unwrap(handler)):
+
+        async def run_async(message):
+            return await finish_after(start(message), handler(message))
+
+        return functools.update_wrapper(run_async, handler)
+    return functools.update_wrapper(run, handler)
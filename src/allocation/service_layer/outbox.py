@@ -0,0 +1,95 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Type, TYPE_CHECKING
+from sqlalchemy import select
+
+from allocation.adapters import orm, tracing
+from allocation.domain import events
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    def __init__(
+        self,
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        batch_size: int = 100,
+        tracer: tracing.Tracer = None,
+    ):
+        self.uow = uow
+        self.event_handlers = event_handlers
+        self.batch_size = batch_size
+        self.tracer = tracer
+        self._event_types = {t.__name__: t for t in event_handlers}
+
+    def run(self, poll_interval: float = 0.5):
+        while True:
+            try:
+                dispatched = self.dispatch_batch()
+            except Exception:
+                # e.g. the database is unavailable; the rows wait in the outbox
+                logger.exception("Exception dispatching the outbox")
+                dispatched = 0
+            if not dispatched:
+                time.sleep(poll_interval)
+
+    def dispatch_batch(self) -> int:
+        # the number of rows taken off the outbox, dispatched or dead-lettered
+        dispatched, dead_letters = [], []
+        with self.uow:
+            rows = self.uow.session.execute(
+                select([orm.outbox])
+                .order_by(orm.outbox.c.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).fetchall()
+            for row in rows:
+                try:
+                    event = self.decode(row)
+                except Exception as e:
+                    # it never will decode, so it mustn't hold up the rows after it
+                    logger.exception("Exception decoding outbox row %s", row.id)
+                    dead_letters.append(dict(row, error=repr(e)))
+                    continue
+                try:
+                    with self._trace(row.traceparent, row.event_type):
+                        self.handle(event)
+                except Exception:
+                    # keep the row (and those after it, to preserve ordering)
+                    # for the next batch; delivery is at-least-once
+                    logger.exception("Exception dispatching event %s", event)
+                    break
+                dispatched.append(row.id)
+            if dead_letters:
+                self.uow.session.execute(
+                    orm.outbox_dead_letters.insert(), dead_letters
+                )
+                dispatched += [row["id"] for row in dead_letters]
+            if dispatched:
+                self.uow.session.execute(
+                    orm.outbox.delete().where(orm.outbox.c.id.in_(dispatched))
+                )
+            self.uow.commit()
+        return len(dispatched)
+
+    def decode(self, row) -> events.Event:
+        return self._event_types[row.event_type](**json.loads(row.payload))
+
+    def _trace(self, traceparent: Optional[str], event_type: str):
+        # handlers continue the trace the event was raised in, so that what
+        # they publish carries it on too
+        if self.tracer is None:
+            return tracing.continued(traceparent)
+        return self.tracer.span("outbox.dispatch", traceparent, event_type=event_type)
+
+    def handle(self, event: events.Event):
+        for handler in self.event_handlers[type(event)]:
+            logger.debug("dispatching event %s with handler %s", event, handler)
+            handler(event)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import itertools
+from collections import Counter
+from typing import List, Optional, Set, Union, TYPE_CHECKING
+from sqlalchemy import bindparam, text
+from allocation.adapters.batching import BatchWorker
+from allocation.domain import events
+
+if TYPE_CHECKING:
+    from allocation.adapters import view_cache as cache
+    from . import unit_of_work
+
+Projected = Union[events.Allocated, events.Deallocated]
+
+ALLOCATE = """
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    VALUES (:orderid, :sku, :batchref)
+"""
+DEALLOCATE = """
+    DELETE FROM allocations_view
+    WHERE orderid = :orderid AND sku = :sku
+"""
+
+
+def for_skus(sql: str):
+    return text(sql).bindparams(bindparam("skus", expanding=True))
+
+
+VIEW_ORDERIDS = for_skus("SELECT orderid FROM allocations_view WHERE sku IN :skus")
+DELETE_VIEW_ROWS = for_skus("DELETE FROM allocations_view WHERE sku IN :skus")
+REBUILD_VIEW_ROWS = for_skus("""
+    INSERT INTO allocations_view (orderid, sku, batchref)
+    SELECT ol.orderid, ol.sku, b.reference
+    FROM allocations AS a
+    JOIN order_lines AS ol ON a.orderline_id = ol.id
+    JOIN batches AS b ON a.batch_id = b.id
+    WHERE b.sku IN :skus
+    """)
+DELETE_COUNTS = for_skus("DELETE FROM unprojected_events WHERE sku IN :skus")
+STALE_SKUS = """
+    SELECT p.sku FROM products AS p
+    LEFT JOIN unprojected_events AS u ON u.sku = p.sku
+    WHERE u.events IS NULL OR u.events <> 0
+"""
+
+# what units of work count for the projector, as projected_event_types
+PROJECTED_EVENTS = (events.Allocated, events.Deallocated)
+
+
+class ReadModelProjector:
+    # stands in for the read model's event handlers: events are applied on a
+    # background thread, up to max_batch of them in one transaction, and
+    # flush(), which bootstrap calls each time the bus goes idle, waits until
+    # those added so far have been. Units of work made with
+    # projected_event_types=PROJECTED_EVENTS count each sku's events in the
+    # transaction that commits them, and applying them counts them off, so the
+    # events of a batch that still fails after max_retries attempts, of one
+    # added while max_pending are waiting, or lost in a crash stay counted,
+    # and catch_up() rebuilds those skus' rows from the write model. It must
+    # not run while events for the same skus are being applied, so bootstrap
+    # runs it before the projector is given any
+    def __init__(
+        self,
+        uow: unit_of_work.SqlAlchemyUnitOfWork,
+        view_cache: Optional[cache.AbstractViewCache] = None,
+        max_batch: int = 1000,
+        max_delay: float = 1.0,
+        max_pending: int = 10000,
+        max_retries: int = 3,
+    ):
+        self.uow = uow
+        self.view_cache = view_cache
+        self._worker = BatchWorker(
+            self._apply,
+            "read model projector",
+            max_batch=max_batch,
+            max_delay=max_delay,
+            max_buffer=max_pending,
+            max_retries=max_retries,
+        )  # type: BatchWorker[Projected]
+
+    def add(self, event: Projected):
+        self._worker.add(event)
+
+    def flush(self):
+        self._worker.flush()
+
+    def catch_up(self, chunk_size: int = 500) -> int:
+        with self.uow:
+            stale = [sku for sku, in self.uow.session.execute(STALE_SKUS)]
+        for i in range(0, len(stale), chunk_size):
+            self._rebuild(stale[i : i + chunk_size])
+        return len(stale)
+
+    def _apply(self, batch: List[Projected]):
+        with self.uow:
+            session = self.uow.session
+            for event_type, run in itertools.groupby(batch, type):
+                session.execute(
+                    ALLOCATE if event_type is events.Allocated else DEALLOCATE,
+                    [view_row(e) for e in run],
+                )
+            session.execute(
+                "UPDATE unprojected_events SET events = events - :events"
+                " WHERE sku = :sku",
+                [
+                    dict(sku=sku, events=count)
+                    for sku, count in Counter(e.sku for e in batch).items()
+                ],
+            )
+            self.uow.commit()
+        self._invalidate({e.orderid for e in batch})
+
+    def _rebuild(self, skus: List[str]):
+        with self.uow:
+            session = self.uow.session
+            orderids = [o for o, in session.execute(VIEW_ORDERIDS, dict(skus=skus))]
+            session.execute(DELETE_VIEW_ROWS, dict(skus=skus))
+            session.execute(REBUILD_VIEW_ROWS, dict(skus=skus))
+            session.execute(DELETE_COUNTS, dict(skus=skus))
+            session.execute(
+                "INSERT INTO unprojected_events (sku, events) VALUES (:sku, 0)",
+                [dict(sku=sku) for sku in skus],
+            )
+            self.uow.commit()
+        self._invalidate(set(orderids))
+
+    def _invalidate(self, orderids: Set[str]):
+        if self.view_cache is not None:
+            for orderid in orderids:
+                self.view_cache.invalidate(orderid)
+
+
+def view_row(event: Projected) -> dict:
+    if isinstance(event, events.Allocated):
+        return dict(orderid=event.orderid, sku=event.sku, batchref=event.batchref)
+    return dict(orderid=event.orderid, sku=event.sku)
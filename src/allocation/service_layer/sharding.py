@@ -0,0 +1,158 @@
+# pylint: disable=broad-except
+from __future__ import annotations
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple, TYPE_CHECKING
+from allocation.adapters.repository import Loading
+from allocation.domain import commands
+
+if TYPE_CHECKING:
+    from . import messagebus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# how often the collector checks that the workers are still running
+LIVENESS_INTERVAL = 0.5
+
+
+class WorkerDied(Exception):
+    pass
+
+
+SHARDED_COMMANDS = (
+    commands.Allocate,
+    commands.CreateBatch,
+    commands.ChangeBatchQuantity,
+)
+
+
+class ShardedDispatcher:
+    # each worker process runs its own bus and owns the skus that hash to it,
+    # so commands for one sku are handled one at a time, in the order sent
+    def __init__(
+        self,
+        bus_factory: Callable[[], messagebus.MessageBus],
+        uow: unit_of_work.AbstractUnitOfWork,
+        processes: int = 2,
+    ):
+        # spawned rather than forked, so that workers never share the parent's
+        # database connections or threads
+        context = multiprocessing.get_context("spawn")
+        self.uow = uow
+        self._replies = context.Queue()
+        self._inboxes = [context.Queue() for _ in range(processes)]
+        self._workers = [
+            context.Process(
+                target=work, args=(bus_factory, inbox, self._replies), daemon=True
+            )
+            for inbox in self._inboxes
+        ]
+        self._call_ids = itertools.count()
+        self._pending = {}  # type: Dict[int, Tuple[int, Future]]
+        self._dead = {}  # type: Dict[int, WorkerDied]
+        self._lookup_lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        for worker in self._workers:
+            worker.start()
+        self._collector.start()
+
+    def handle(self, cmd: commands.Command, timeout: Optional[float] = 30.0):
+        return self.submit(cmd).result(timeout)
+
+    def submit(self, cmd: commands.Command) -> Future:
+        shard = self.shard_for(self.sku_for(cmd))
+        call_id = next(self._call_ids)
+        future = Future()  # type: Future
+        self._pending[call_id] = (shard, future)
+        if shard in self._dead:
+            self._fail(call_id, self._dead[shard])
+        else:
+            self._inboxes[shard].put((call_id, cmd))
+        return future
+
+    def sku_for(self, cmd: commands.Command) -> str:
+        if not isinstance(cmd, SHARDED_COMMANDS):
+            raise TypeError(f"{type(cmd).__name__} can't be routed to a single sku")
+        if isinstance(cmd, commands.ChangeBatchQuantity):
+            # callers may submit from several threads, but a unit of work
+            # can only be used by one at a time
+            with self._lookup_lock, self.uow:
+                product = self.uow.products.get_by_batchref(
+                    cmd.ref, loading=Loading.WITHOUT_ALLOCATIONS
+                )
+            # an unknown batch fails in whichever worker it lands on
+            return product.sku if product else cmd.ref
+        return cmd.sku
+
+    def shard_for(self, sku: str) -> int:
+        # not hash(), which differs between interpreters
+        return zlib.crc32(sku.encode()) % len(self._inboxes)
+
+    def close(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._replies.put(None)
+        self._collector.join()
+
+    def _collect(self):
+        while True:
+            try:
+                reply = self._replies.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if reply is None:
+                return
+            call_id, error = reply
+            _, future = self._pending.pop(call_id, (None, None))
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _check_workers(self):
+        # a worker that died fails what was sent to it, and all that follows,
+        # rather than leave its callers waiting for replies that never come
+        for shard, worker in enumerate(self._workers):
+            if shard in self._dead or worker.is_alive():
+                continue
+            error = WorkerDied(f"shard {shard} exited with code {worker.exitcode}")
+            logger.error("%s", error)
+            self._dead[shard] = error
+            for call_id, (call_shard, _) in list(self._pending.items()):
+                if call_shard == shard:
+                    self._fail(call_id, error)
+
+    def _fail(self, call_id: int, error: Exception):
+        _, future = self._pending.pop(call_id, (None, None))
+        if future is not None:
+            future.set_exception(error)
+
+
+def work(bus_factory: Callable[[], messagebus.MessageBus], inbox, replies):
+    bus = bus_factory()
+    for call_id, cmd in iter(inbox.get, None):
+        try:
+            bus.handle(cmd)
+            replies.put((call_id, None))
+        except Exception as e:
+            replies.put((call_id, picklable(e)))
+
+
+def picklable(error: Exception) -> Exception:
+    # the queue pickles in a background thread, where a failure would be lost
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
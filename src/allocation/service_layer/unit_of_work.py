@@ -1,31 +1,79 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import asdict
+from typing import Callable, Deque, Dict, Optional, Tuple, Type
 from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
 
 
 from allocation import config
-from allocation.adapters import repository
+from allocation.adapters import repository, tracing
+from allocation.adapters.aggregate_cache import AggregateCache
+from allocation.adapters.event_store import EventSourcedRepository
+from allocation.adapters.metrics import AbstractMetrics
+from allocation.adapters.tracing import Tracer
+from allocation.adapters.write_behind import StaleAggregate, WriteBehindStore
+from allocation.domain import events
+
+
+class ConcurrencyConflict(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
+    metrics = None  # type: Optional[AbstractMetrics]
+    tracer = None  # type: Optional[Tracer]
+    _committed = False
 
     def __enter__(self) -> AbstractUnitOfWork:
+        self._committed = False
         return self
 
     def __exit__(self, *args):
-        self.rollback()
+        # rolling back after a commit is a no-op that isn't worth observing
+        if self.metrics is None or (self._committed and args[0] is None):
+            self.rollback()
+        else:
+            self._timed("rollback", self.rollback)
 
     def commit(self):
-        self._commit()
+        if self.tracer is not None:
+            with self.tracer.span("uow.commit", uow=type(self).__name__):
+                self._observed_commit()
+        else:
+            self._observed_commit()
+        self._committed = True
+
+    def _observed_commit(self):
+        if self.metrics is None:
+            self._commit()
+        else:
+            self._timed("commit", self._commit)
+
+    def _timed(self, operation: str, action: Callable[[], None]):
+        start = time.perf_counter()
+        try:
+            action()
+        except Exception:
+            self.metrics.observe_uow(operation, time.perf_counter() - start, True)
+            raise
+        self.metrics.observe_uow(operation, time.perf_counter() - start, False)
 
     def collect_new_events(self):
         for product in self.products.seen:
             while product.events:
-                yield product.events.pop(0)
+                yield product.events.popleft()
 
     @abc.abstractmethod
     def _commit(self):
@@ -36,21 +84,60 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
+def make_session_factory(uri: str = None) -> sessionmaker:
+    # every thread serving requests holds at most one connection at a time, so
+    # pool_size + max_overflow should cover the threads of one process
+    engine = create_engine(
+        uri or config.get_postgres_uri(),
+        isolation_level=config.get_postgres_isolation_level(),
+        pool_size=config.get_db_pool_size(),
+        max_overflow=config.get_db_max_overflow(),
+        pool_timeout=config.get_db_pool_timeout(),
+        pool_recycle=config.get_db_pool_recycle(),
+        pool_pre_ping=True,
+    )
+    return sessionmaker(
+        bind=engine, expire_on_commit=config.get_db_expire_on_commit()
     )
-)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_sessionmaker() -> sessionmaker:
+    return make_session_factory()
+
+
+def default_session_factory(**kwargs) -> Session:
+    # the engine is only built, from config, when the first session is opened
+    return _default_sessionmaker()(**kwargs)
+
+
+SERIALIZATION_FAILURE = "40001"
 
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    def __init__(
+        self,
+        session_factory=default_session_factory,
+        outbox_event_types: Tuple[Type[events.Event], ...] = (),
+        aggregate_cache: AggregateCache = None,
+        projected_event_types: Tuple[Type[events.Event], ...] = (),
+    ):
         self.session_factory = session_factory
+        self.outbox_event_types = outbox_event_types
+        self.aggregate_cache = aggregate_cache
+        self.projected_event_types = projected_event_types
 
     def __enter__(self):
-        self.session = self.session_factory()  # type: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        if self.aggregate_cache is None:
+            self.session = self.session_factory()  # type: Session
+        else:
+            # committed aggregates are copied into the cache after commit
+            self.session = self.session_factory(expire_on_commit=False)
+        self.products = repository.SqlAlchemyRepository(
+            self.session, cache=self.aggregate_cache
+        )
+        # by id, holding on to each event so that its id can't be reused
+        self._recorded = {}  # type: Dict[int, events.Event]
         return super().__enter__()
 
     def __exit__(self, *args):
@@ -58,7 +145,202 @@ class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
         self.session.close()
 
     def _commit(self):
-        self.session.commit()
+        if self.outbox_event_types or self.projected_event_types:
+            self._record_new_events()
+        try:
+            self.session.commit()
+        except StaleDataError as e:
+            # another transaction has committed a newer Product.version_number
+            raise ConcurrencyConflict(str(e)) from e
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) == SERIALIZATION_FAILURE:
+                raise ConcurrencyConflict(str(e)) from e
+            raise
+        if self.aggregate_cache is not None:
+            self.products.cache_seen()
+
+    def _record_new_events(self):
+        # new events are still queued on the aggregates at this point, so they
+        # are recorded in the same transaction as the state change: those for
+        # the outbox as rows, and those for the read model's projector as the
+        # number of each sku's events that it has yet to apply
+        rows = []
+        unprojected = Counter()  # type: Counter[str]
+        traceparent = tracing.current_traceparent()
+        for product in self.products.seen:
+            for event in product.events:
+                if self._recorded.get(id(event)) is event:
+                    continue
+                self._recorded[id(event)] = event
+                if isinstance(event, self.outbox_event_types):
+                    rows.append(
+                        dict(
+                            event_type=type(event).__name__,
+                            payload=json.dumps(asdict(event)),
+                            traceparent=traceparent,
+                        )
+                    )
+                if isinstance(event, self.projected_event_types):
+                    unprojected[product.sku] += 1
+        if rows:
+            self.session.execute(
+                "INSERT INTO outbox (event_type, payload, traceparent)"
+                " VALUES (:event_type, :payload, :traceparent)",
+                rows,
+            )
+        for sku, count in unprojected.items():
+            counted = self.session.execute(
+                "UPDATE unprojected_events SET events = events + :count"
+                " WHERE sku = :sku",
+                dict(sku=sku, count=count),
+            )
+            if not counted.rowcount:
+                self.session.execute(
+                    "INSERT INTO unprojected_events (sku, events)"
+                    " VALUES (:sku, :count)",
+                    dict(sku=sku, count=count),
+                )
 
     def rollback(self):
         self.session.rollback()
+
+
+class EventSourcedUnitOfWork(SqlAlchemyUnitOfWork):
+    def __init__(self, session_factory=default_session_factory, snapshot_every=50):
+        super().__init__(session_factory)
+        self.snapshot_every = snapshot_every
+
+    def __enter__(self):
+        super().__enter__()
+        self.products = EventSourcedRepository(self.session, self.snapshot_every)
+        return self
+
+    def _commit(self):
+        try:
+            self.products.append_new_events()
+        except IntegrityError as e:
+            # another commit has already appended this version to the stream
+            raise ConcurrencyConflict(str(e)) from e
+        super()._commit()
+
+
+class WriteBehindUnitOfWork(AbstractUnitOfWork):
+    # aggregates live in a WriteBehindStore and commits don't wait for the
+    # database; a session is only opened for handlers that need one, such as
+    # the read model's
+    def __init__(
+        self,
+        store: WriteBehindStore,
+        session_factory=default_session_factory,
+    ):
+        self.store = store
+        self.session_factory = session_factory
+
+    def __enter__(self):
+        self.products = repository.InMemoryRepository(self.store)
+        self._session = None  # type: Session
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        if self._session is not None:
+            self._session.close()
+
+    @property
+    def session(self) -> Session:
+        if self._session is None:
+            self._session = self.session_factory()
+        return self._session
+
+    def _commit(self):
+        try:
+            self.store.commit(self.products.seen, self.products.base_versions)
+        except StaleAggregate as e:
+            raise ConcurrencyConflict(str(e)) from e
+        if self._session is not None:
+            self._session.commit()
+
+    def rollback(self):
+        # working copies are simply dropped
+        if self._session is not None:
+            self._session.rollback()
+
+
+class AsyncUnitOfWork(AbstractUnitOfWork):
+    # wraps a unit of work shared by handlers that the AsyncMessageBus runs
+    # concurrently in worker threads: one `with` block at a time, and each
+    # block's events are set aside before the next one can replace `products`
+    def __init__(self, uow: AbstractUnitOfWork):
+        self.uow = uow
+        self._lock = threading.RLock()
+        self._events = deque()  # type: Deque[events.Event]
+
+    def __getattr__(self, name):
+        if name == "uow":
+            raise AttributeError(name)
+        return getattr(self.uow, name)
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self.uow.__enter__()
+        except Exception:
+            self._lock.release()
+            raise
+        self.products = self.uow.products
+        return self
+
+    def __exit__(self, *args):
+        try:
+            new_events = self.uow.collect_new_events()
+            if args[0] is None:
+                self._events.extend(new_events)
+            else:
+                # rolled back, so they never happened; a retry raises its own
+                for _ in new_events:
+                    pass
+            self.uow.__exit__(*args)
+        finally:
+            self._lock.release()
+
+    def _commit(self):
+        self.uow.commit()
+
+    def rollback(self):
+        self.uow.rollback()
+
+    def collect_new_events(self):
+        while self._events:
+            yield self._events.popleft()
+
+
+# the unit of work of the bus that is handling the current message
+CURRENT_UOW = contextvars.ContextVar(
+    "current_uow"
+)  # type: contextvars.ContextVar[AbstractUnitOfWork]
+
+
+class CurrentUnitOfWork(AbstractUnitOfWork):
+    # stands in for CURRENT_UOW, so that handlers can be bound to it once and
+    # then be shared by many buses, each with its own unit of work
+    def __getattr__(self, name):
+        return getattr(CURRENT_UOW.get(), name)
+
+    def __enter__(self):
+        CURRENT_UOW.get().__enter__()
+        return self
+
+    def __exit__(self, *args):
+        CURRENT_UOW.get().__exit__(*args)
+
+    def commit(self):
+        CURRENT_UOW.get().commit()
+
+    def _commit(self):
+        raise NotImplementedError  # commit() goes to the current unit of work
+
+    def rollback(self):
+        CURRENT_UOW.get().rollback()
+
+    def collect_new_events(self):
+        return CURRENT_UOW.get().collect_new_events()
@@ -1,7 +1,18 @@
+from typing import Optional
+from allocation.adapters.view_cache import AbstractViewCache
 from allocation.service_layer import unit_of_work
 
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def allocations(
+    orderid: str,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    cache: Optional[AbstractViewCache] = None,
+):
+    if cache is not None:
+        cached = cache.get(orderid)
+        if cached is not None:
+            return cached
+        generation = cache.generation(orderid)
     with uow:
         results = uow.session.execute(
             """
@@ -9,4 +20,7 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             """,
             dict(orderid=orderid),
         )
-    return [dict(r) for r in results]
+        rows = [dict(r) for r in results]
+    if cache is not None:
+        cache.set(orderid, rows, generation)
+    return rows
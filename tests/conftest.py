@@ -11,7 +11,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
-from allocation.adapters.orm import metadata, start_mappers
+from allocation.adapters.orm import metadata, start_mappers, upgrade_schema
 from allocation import config
 
 pytest.register_assert_rewrite("tests.e2e.api_client")
@@ -56,7 +56,7 @@ def wait_for_redis_to_come_up():
 def postgres_db():
     engine = create_engine(config.get_postgres_uri(), isolation_level="SERIALIZABLE")
     wait_for_postgres_to_come_up(engine)
-    metadata.create_all(engine)
+    upgrade_schema(engine)
     return engine
 
 
@@ -25,6 +25,20 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_many(orderid, lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/allocate_many",
+        json={
+            "orderid": orderid,
+            "lines": [{"sku": sku, "qty": qty} for sku, qty in lines],
+        },
+    )
+    if expect_success:
+        assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
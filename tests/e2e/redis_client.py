@@ -16,3 +16,7 @@ def subscribe_to(channel):
 
 def publish_message(channel, message):
     r.publish(channel, json.dumps(message))
+
+
+def add_to_stream(stream, message):
+    r.xadd(stream, {"data": json.dumps(message)})
@@ -37,3 +37,19 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_allocate_many_returns_a_batchref_per_line():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku("other")
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 10, None)
+
+    r = api_client.post_to_allocate_many(orderid, [(sku, 3), (othersku, 20)])
+    assert r.json() == [
+        {"sku": sku, "qty": 3, "batchref": batch},
+        {"sku": othersku, "qty": 20, "batchref": None},
+    ]
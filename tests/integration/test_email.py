@@ -35,3 +35,23 @@ def test_out_of_stock_email(bus):
     assert email["Raw"]["From"] == "allocations@example.com"
     assert email["Raw"]["To"] == ["stock@made.com"]
     assert f"Out of stock for {sku}" in email["Raw"]["Data"]
+
+
+def test_out_of_stock_digest_email(sqlite_session_factory):
+    pooled_notifications = notifications.PooledEmailNotifications(digest_window=60)
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=pooled_notifications,
+        publish=lambda *args: None,
+    )
+    try:
+        sku = random_sku()
+        bus.handle(commands.CreateBatch("batch1", sku, 9, None))
+        bus.handle(commands.Allocate("order1", sku, 10))
+        bus.handle(commands.Allocate("order2", sku, 10))
+        pooled_notifications.flush()
+    finally:
+        clear_mappers()
+    email = get_email_from_mailhog(sku)
+    assert f"Out of stock for {sku} (x2)" in email["Raw"]["Data"]
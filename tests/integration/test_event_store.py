@@ -0,0 +1,91 @@
+import pytest
+from allocation.adapters import event_store
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+from .test_repository import counting_queries
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def test_products_are_rebuilt_from_their_stream(sqlite_session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "LAMP", 20), uow)
+    handlers.add_batch(commands.CreateBatch("b2", "LAMP", 100), uow)
+    handlers.allocate(commands.Allocate("o1", "LAMP", 10), uow)
+    handlers.allocate(commands.Allocate("o2", "LAMP", 10), uow)
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("b1", 10), uow)
+
+    with uow:
+        product = uow.products.get("LAMP")
+        quantities = {b.reference: b.available_quantity for b in product.batches}
+    assert quantities == {"b1": 0, "b2": 90}
+    assert product.version_number == 5
+
+    session = sqlite_session_factory()
+    event_types = [
+        row.event_type
+        for row in session.execute(
+            "SELECT event_type FROM product_events ORDER BY version, position"
+        )
+    ]
+    assert event_types == [
+        "ProductCreated",
+        "BatchCreated",
+        "BatchCreated",
+        "Allocated",
+        "Allocated",
+        "BatchQuantityChanged",
+        "Deallocated",
+        "Allocated",
+    ]
+
+
+def test_snapshots_bound_the_events_replayed(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    uow = unit_of_work.EventSourcedUnitOfWork(
+        sqlite_session_factory, snapshot_every=5
+    )
+    handlers.add_batch(commands.CreateBatch("b1", "TABLE", 100), uow)
+    for i in range(12):
+        handlers.allocate(commands.Allocate(f"o{i}", "TABLE", 1), uow)
+
+    session = sqlite_session_factory()
+    [[version]] = session.execute("SELECT version FROM product_snapshots")
+    assert version == 10
+    with counting_queries(in_memory_sqlite_db) as statements:
+        with uow:
+            [batch] = uow.products.get("TABLE").batches
+            assert batch.available_quantity == 88
+    assert len(statements) == 2
+
+
+def test_appending_from_a_stale_version_is_a_conflict(sqlite_session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    other_uow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "CHAIR", 100), uow)
+
+    with uow:
+        product = uow.products.get("CHAIR")
+        handlers.allocate(commands.Allocate("o2", "CHAIR", 10), other_uow)
+        product.allocate(model.OrderLine("o1", "CHAIR", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow.commit()
+
+
+def test_read_model_can_be_rebuilt_from_the_streams(sqlite_session_factory):
+    uow = unit_of_work.EventSourcedUnitOfWork(sqlite_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "SOFA", 10), uow)
+    handlers.add_batch(commands.CreateBatch("b2", "SOFA", 10), uow)
+    handlers.allocate(commands.Allocate("o1", "SOFA", 10), uow)
+    handlers.allocate(commands.Allocate("o2", "SOFA", 10), uow)
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("b1", 0), uow)
+
+    session = sqlite_session_factory()
+    event_store.rebuild_allocations_view(session)
+    session.commit()
+
+    rows = session.execute(
+        "SELECT orderid, batchref FROM allocations_view ORDER BY orderid"
+    )
+    assert [tuple(row) for row in rows] == [("o2", "b2")]
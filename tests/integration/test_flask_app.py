@@ -0,0 +1,131 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.adapters import tracing
+from allocation.adapters.metrics import PrometheusMetrics
+from allocation.adapters.view_cache import InMemoryViewCache
+from allocation.entrypoints.flask_app import create_app
+from ..unit.test_handlers import FakeNotifications
+from ..unit.test_tracing import REMOTE, FakeSpanExporter
+
+
+@pytest.fixture
+def buses(sqlite_session_factory):
+    make_bus = bootstrap.bootstrap_per_request(
+        session_factory=sqlite_session_factory,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+    )
+    created = []
+
+    def make_and_record_bus():
+        created.append(make_bus())
+        return created[-1]
+
+    yield make_and_record_bus, created
+    clear_mappers()
+
+
+@pytest.fixture
+def client(buses):
+    make_bus, _ = buses
+    return create_app(make_bus=make_bus).test_client()
+
+
+def test_each_request_gets_its_own_bus_and_unit_of_work(client, buses):
+    _, created = buses
+    client.post("/add_batch", json=dict(ref="b1", sku="LAMP", qty=10, eta=None))
+    client.post("/allocate", json=dict(orderid="o1", sku="LAMP", qty=3))
+    assert len(created) == 2
+    assert created[0] is not created[1]
+    assert created[0].uow is not created[1].uow
+    # while the handlers are bound once, to whichever unit of work is current
+    assert created[0].event_handlers is created[1].event_handlers
+    assert created[0].command_handlers is created[1].command_handlers
+
+
+def test_requests_see_each_others_commits(client):
+    r = client.post("/add_batch", json=dict(ref="b1", sku="LAMP", qty=10, eta=None))
+    assert r.status_code == 201
+    r = client.post("/allocate", json=dict(orderid="o1", sku="LAMP", qty=3))
+    assert r.status_code == 202
+    r = client.get("/allocations/o1")
+    assert r.status_code == 200
+    assert r.json == [{"sku": "LAMP", "batchref": "b1"}]
+
+
+def test_allocate_many_reports_each_lines_batch(client):
+    client.post("/add_batch", json=dict(ref="b1", sku="LAMP", qty=5, eta=None))
+    client.post(
+        "/add_batch", json=dict(ref="b2", sku="LAMP", qty=10, eta="2030-01-01")
+    )
+    lines = [
+        dict(sku="LAMP", qty=4),
+        dict(sku="LAMP", qty=3),
+        dict(sku="LAMP", qty=20),
+    ]
+    r = client.post("/allocate_many", json=dict(orderid="o1", lines=lines))
+    assert r.status_code == 202
+    assert r.json == [
+        {"sku": "LAMP", "qty": 4, "batchref": "b1"},
+        {"sku": "LAMP", "qty": 3, "batchref": "b2"},
+        {"sku": "LAMP", "qty": 20, "batchref": None},
+    ]
+
+
+def test_duplicate_lines_are_a_bad_request(client):
+    client.post("/add_batch", json=dict(ref="b1", sku="LAMP", qty=100, eta=None))
+    lines = [dict(sku="LAMP", qty=4), dict(sku="LAMP", qty=4)]
+    r = client.post("/allocate_many", json=dict(orderid="o1", lines=lines))
+    assert r.status_code == 400
+    assert r.json["message"] == "Duplicate line LAMP x 4"
+
+
+def test_unknown_sku_is_a_bad_request(client):
+    r = client.post("/allocate", json=dict(orderid="o1", sku="NOPE", qty=3))
+    assert r.status_code == 400
+    assert r.json["message"] == "Invalid sku NOPE"
+
+
+def test_metrics_are_only_served_when_enabled(client, buses):
+    assert client.get("/metrics").status_code == 404
+
+    make_bus, _ = buses
+    metrics = PrometheusMetrics()
+    client = create_app(
+        make_bus=make_bus, view_cache=InMemoryViewCache(), metrics=metrics
+    ).test_client()
+    client.get("/allocations/o1")
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    assert "allocation_view_cache_misses 1" in r.get_data(as_text=True)
+
+
+def test_requests_continue_the_callers_trace(sqlite_session_factory):
+    exporter = FakeSpanExporter()
+    tracer = tracing.Tracer(exporter)
+    make_bus = bootstrap.bootstrap_per_request(
+        session_factory=sqlite_session_factory,
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        tracer=tracer,
+    )
+    try:
+        client = create_app(make_bus=make_bus, tracer=tracer).test_client()
+        client.post("/add_batch", json=dict(ref="b1", sku="LAMP", qty=10, eta=None))
+        r = client.post(
+            "/allocate",
+            json=dict(orderid="o1", sku="LAMP", qty=3),
+            headers={"traceparent": REMOTE},
+        )
+    finally:
+        clear_mappers()
+
+    request = exporter.named("POST /allocate")
+    assert request.parent_id == REMOTE.split("-")[2]
+    assert request.attributes["http.status_code"] == "202"
+    assert r.headers["traceparent"] == request.traceparent
+    assert exporter.named("allocate").parent_id == request.span_id
+    assert exporter.named("add_allocation_to_read_model").trace_id == request.trace_id
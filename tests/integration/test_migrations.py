@@ -0,0 +1,27 @@
+from sqlalchemy import create_engine, inspect
+from allocation.adapters import orm
+
+
+def test_upgrade_adds_indexes_to_existing_tables():
+    engine = create_engine("sqlite:///:memory:")
+    engine.execute("CREATE TABLE allocations_view (orderid, sku, batchref)")
+
+    orm.upgrade_schema(engine)
+    orm.upgrade_schema(engine)
+
+    indexes = inspect(engine).get_indexes("allocations_view")
+    assert [i["name"] for i in indexes] == ["ix_allocations_view_orderid_sku"]
+    assert "outbox" in inspect(engine).get_table_names()
+
+
+def test_upgrade_adds_columns_to_existing_tables():
+    engine = create_engine("sqlite:///:memory:")
+    engine.execute(
+        "CREATE TABLE outbox (id INTEGER PRIMARY KEY, event_type, payload)"
+    )
+
+    orm.upgrade_schema(engine)
+    orm.upgrade_schema(engine)
+
+    columns = [c["name"] for c in inspect(engine).get_columns("outbox")]
+    assert columns == ["id", "event_type", "payload", "traceparent"]
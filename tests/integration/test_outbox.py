@@ -0,0 +1,160 @@
+# pylint: disable=redefined-outer-name
+import json
+from unittest import mock
+import pytest
+from sqlalchemy.orm import clear_mappers
+from allocation import bootstrap
+from allocation.adapters import redis_eventpublisher, tracing
+from allocation.domain import commands, events
+from allocation.service_layer import handlers, unit_of_work
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def outbox_bus(sqlite_session_factory, published):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(
+            sqlite_session_factory, outbox_event_types=tuple(handlers.OUTBOX_HANDLERS)
+        ),
+        notifications=mock.Mock(),
+        publish=lambda *args: published.append(args),
+        use_outbox=True,
+    )
+    yield bus
+    clear_mappers()
+
+
+def make_dispatcher(session_factory, publish, notifications=None):
+    return bootstrap.bootstrap_outbox_dispatcher(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=notifications or mock.Mock(),
+        publish=publish,
+    )
+
+
+def outbox_rows(session_factory):
+    return list(
+        session_factory().execute("SELECT event_type FROM outbox ORDER BY id")
+    )
+
+
+def test_external_events_go_to_the_outbox_not_inline(
+    outbox_bus, published, sqlite_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+    outbox_bus.handle(commands.Allocate("o2", "sku1", 10))
+
+    assert published == []
+    assert outbox_rows(sqlite_session_factory) == [("Allocated",), ("OutOfStock",)]
+
+
+def test_dispatcher_drains_the_outbox(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+    outbox_bus.handle(commands.Allocate("o2", "sku1", 10))
+    publish, notifications = mock.Mock(), mock.Mock()
+    dispatcher = make_dispatcher(sqlite_session_factory, publish, notifications)
+
+    assert dispatcher.dispatch_batch() == 2
+
+    publish.assert_called_once_with(
+        "line_allocated", events.Allocated("o1", "sku1", 10, "b1")
+    )
+    notifications.send.assert_called_once_with(
+        "stock@made.com", "Out of stock for sku1"
+    )
+    assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_failed_dispatch_is_retried(outbox_bus, sqlite_session_factory):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+    publish = mock.Mock(side_effect=[ConnectionError, None])
+    dispatcher = make_dispatcher(sqlite_session_factory, publish)
+
+    assert dispatcher.dispatch_batch() == 0
+    assert outbox_rows(sqlite_session_factory) == [("Allocated",)]
+    assert dispatcher.dispatch_batch() == 1
+    assert outbox_rows(sqlite_session_factory) == []
+
+
+def test_rows_that_cannot_be_decoded_are_dead_lettered(
+    outbox_bus, sqlite_session_factory
+):
+    session = sqlite_session_factory()
+    session.execute(
+        "INSERT INTO outbox (event_type, payload) VALUES"
+        " ('Allocated', 'not json'), ('Unknown', '{}')"
+    )
+    session.commit()
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+    publish = mock.Mock()
+    dispatcher = make_dispatcher(sqlite_session_factory, publish)
+
+    assert dispatcher.dispatch_batch() == 3
+
+    publish.assert_called_once_with(
+        "line_allocated", events.Allocated("o1", "sku1", 10, "b1")
+    )
+    assert outbox_rows(sqlite_session_factory) == []
+    dead_letters = list(
+        session.execute("SELECT event_type, payload FROM outbox_dead_letters")
+    )
+    assert dead_letters == [("Allocated", "not json"), ("Unknown", "{}")]
+
+
+def test_dispatcher_keeps_running_after_errors(sqlite_session_factory):
+    dispatcher = make_dispatcher(sqlite_session_factory, mock.Mock())
+    dispatcher.dispatch_batch = mock.Mock(side_effect=[ConnectionError, 0])
+    with mock.patch("time.sleep", side_effect=[None, KeyboardInterrupt]):
+        with pytest.raises(KeyboardInterrupt):
+            dispatcher.run()
+    assert dispatcher.dispatch_batch.call_count == 2
+
+
+def test_a_unit_of_work_without_an_outbox_is_refused(sqlite_session_factory):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with pytest.raises(ValueError, match="Allocated, OutOfStock"):
+        bootstrap.bootstrap(start_orm=False, uow=uow, use_outbox=True)
+    assert uow.outbox_event_types == ()
+
+
+def test_per_request_buses_can_use_the_outbox(sqlite_session_factory, published):
+    make_bus = bootstrap.bootstrap_per_request(
+        session_factory=sqlite_session_factory,
+        publish=lambda *args: published.append(args),
+        use_outbox=True,
+    )
+    try:
+        make_bus().handle(commands.CreateBatch("b1", "sku1", 10, None))
+        make_bus().handle(commands.Allocate("o1", "sku1", 10))
+    finally:
+        clear_mappers()
+
+    assert published == []
+    assert outbox_rows(sqlite_session_factory) == [("Allocated",)]
+
+
+def test_dispatched_events_continue_the_trace_they_were_raised_in(
+    outbox_bus, sqlite_session_factory
+):
+    outbox_bus.handle(commands.CreateBatch("b1", "sku1", 10, None))
+    with tracing.Tracer(mock.Mock()).span("request") as span:
+        outbox_bus.handle(commands.Allocate("o1", "sku1", 10))
+    messages = []
+    dispatcher = make_dispatcher(
+        sqlite_session_factory,
+        lambda channel, event: messages.append(
+            json.loads(redis_eventpublisher.serialize(event))
+        ),
+    )
+
+    assert dispatcher.dispatch_batch() == 1
+    assert messages[0]["traceparent"] == span.traceparent
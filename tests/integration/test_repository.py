@@ -1,4 +1,6 @@
+from contextlib import contextmanager
 import pytest
+from sqlalchemy import event, exc
 from allocation.adapters import repository
 from allocation.domain import model
 
@@ -17,3 +19,107 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_loaded_batches_know_their_allocated_quantity(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    product = model.Product(sku="sku1", batches=[batch])
+    product.allocate(model.OrderLine("o1", "sku1", 10))
+    product.allocate(model.OrderLine("o2", "sku1", 20))
+    repo.add(product)
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    [loaded] = repo.get("sku1").batches
+    assert loaded.allocated_quantity == 30
+    assert loaded.available_quantity == 70
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add(model.Product("sku1", [model.Batch("b1", "sku1", 100, eta=None)]))
+    repo.add(model.Product("sku2", [model.Batch("b1", "sku2", 100, eta=None)]))
+    with pytest.raises(exc.IntegrityError):
+        session.commit()
+
+
+@contextmanager
+def counting_queries(engine):
+    statements = []
+
+    def count(_conn, _cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def add_product_with_allocations(session_factory, num_batches=5, lines_per_batch=5):
+    session = session_factory()
+    batches = [
+        model.Batch(ref=f"b{i}", sku="sku1", qty=100, eta=None)
+        for i in range(num_batches)
+    ]
+    for batch in batches:
+        for j in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"{batch.reference}-o{j}", "sku1", 1))
+    repository.SqlAlchemyRepository(session).add(model.Product("sku1", batches))
+    session.commit()
+
+
+@pytest.mark.parametrize(
+    "loading, expected_queries",
+    [
+        (repository.Loading.SELECTIN, 3),
+        (repository.Loading.JOINED, 1),
+        (repository.Loading.LAZY, 2 + 5),
+    ],
+)
+def test_loads_a_whole_aggregate_in_a_fixed_number_of_queries(
+    sqlite_session_factory, in_memory_sqlite_db, loading, expected_queries
+):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    with counting_queries(in_memory_sqlite_db) as statements:
+        product = repo.get("sku1", loading=loading)
+        available = [b.available_quantity for b in product.batches]
+
+    assert available == [95] * 5
+    assert len(statements) == expected_queries
+
+
+def test_get_by_batchref_uses_the_repository_default(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    with counting_queries(in_memory_sqlite_db) as statements:
+        product = repo.get_by_batchref("b3")
+        available = [b.available_quantity for b in product.batches]
+
+    assert available == [95] * 5
+    assert len(statements) == 3
+
+
+def test_read_only_paths_can_skip_allocations(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    add_product_with_allocations(sqlite_session_factory)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    with counting_queries(in_memory_sqlite_db) as statements:
+        product = repo.get("sku1", loading=repository.Loading.WITHOUT_ALLOCATIONS)
+        references = sorted(b.reference for b in product.batches)
+        allocated = [b.allocated_quantity for b in product.batches]
+
+    assert references == ["b0", "b1", "b2", "b3", "b4"]
+    assert allocated == [0] * 5
+    assert len(statements) == 2
@@ -5,8 +5,10 @@ import traceback
 from typing import List
 from unittest.mock import Mock
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from allocation.adapters.aggregate_cache import AggregateCache
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+from .test_repository import counting_queries
 from ..random_refs import random_sku, random_batchref, random_orderid
 
 pytestmark = pytest.mark.usefixtures("mappers")
@@ -78,6 +80,145 @@ def test_rolls_back_on_error(sqlite_session_factory):
     assert rows == []
 
 
+def test_committing_a_stale_version_is_a_conflict(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "STALE-LAMP", 100, None, product_version=1)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    other_uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+    with uow:
+        product = uow.products.get(sku="STALE-LAMP")
+        with other_uow:
+            other_product = other_uow.products.get(sku="STALE-LAMP")
+            other_product.allocate(model.OrderLine("o2", "STALE-LAMP", 10))
+            other_uow.commit()
+
+        product.allocate(model.OrderLine("o1", "STALE-LAMP", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow.commit()
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='STALE-LAMP'"
+    )
+    assert version == 2
+
+
+def allocate_through(uow, orderid, sku):
+    with uow:
+        product = uow.products.get(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, 10))
+        uow.commit()
+    return batchref
+
+
+def test_committed_aggregates_are_reused_after_a_version_check(
+    sqlite_session_factory, in_memory_sqlite_db
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "CACHED-LAMP", 100, None)
+    session.commit()
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, aggregate_cache=cache
+    )
+    allocate_through(uow, "o1", "CACHED-LAMP")
+
+    with counting_queries(in_memory_sqlite_db) as statements:
+        with uow:
+            product = uow.products.get(sku="CACHED-LAMP")
+            [batch] = product.batches
+            assert batch.available_quantity == 90
+    assert len(statements) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    assert allocate_through(uow, "o2", "CACHED-LAMP") == "batch1"
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='CACHED-LAMP'"
+    )
+    assert version == 3
+    assert get_allocated_batch_ref(session, "o2", "CACHED-LAMP") == "batch1"
+
+
+def test_cached_aggregates_are_reloaded_after_changes_elsewhere(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "SHARED-LAMP", 100, None)
+    session.commit()
+    cache = AggregateCache()
+    cached_uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, aggregate_cache=cache
+    )
+    allocate_through(cached_uow, "o1", "SHARED-LAMP")
+    allocate_through(
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory), "o2", "SHARED-LAMP"
+    )
+
+    with cached_uow:
+        [batch] = cached_uow.products.get(sku="SHARED-LAMP").batches
+        assert batch.available_quantity == 80
+    assert cache.hits == 0
+
+
+def test_cached_aggregates_are_reloaded_after_batches_are_added_elsewhere(
+    sqlite_session_factory,
+):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "GROWING-LAMP", 10, None)
+    session.commit()
+    cached_uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, aggregate_cache=AggregateCache()
+    )
+    assert allocate_through(cached_uow, "o1", "GROWING-LAMP") == "b1"
+    handlers.add_batch(
+        commands.CreateBatch("b2", "GROWING-LAMP", 100, None),
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+    )
+
+    assert allocate_through(cached_uow, "o2", "GROWING-LAMP") == "b2"
+    assert get_allocated_batch_ref(session, "o2", "GROWING-LAMP") == "b2"
+
+
+def test_aggregate_cache_evicts_least_recently_used(sqlite_session_factory):
+    session = sqlite_session_factory()
+    for sku in ("LRU-1", "LRU-2", "LRU-3"):
+        insert_batch(session, f"{sku}-batch", sku, 100, None)
+    session.commit()
+    cache = AggregateCache(max_size=2)
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, aggregate_cache=cache
+    )
+
+    allocate_through(uow, "o1", "LRU-1")
+    allocate_through(uow, "o1", "LRU-2")
+    allocate_through(uow, "o2", "LRU-1")
+    allocate_through(uow, "o1", "LRU-3")
+
+    assert cache.stats()["size"] == 2
+    assert cache.get("LRU-2", 2) is None
+    assert cache.get("LRU-1", 3) is not None
+
+
+def test_uncommitted_changes_never_reach_the_cache(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "DRAFT-LAMP", 100, None)
+    session.commit()
+    cache = AggregateCache()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_session_factory, aggregate_cache=cache
+    )
+    allocate_through(uow, "o1", "DRAFT-LAMP")
+
+    with uow:
+        product = uow.products.get(sku="DRAFT-LAMP")
+        product.allocate(model.OrderLine("o2", "DRAFT-LAMP", 10))
+
+    with uow:
+        [batch] = uow.products.get(sku="DRAFT-LAMP").batches
+        assert batch.available_quantity == 90
+
+
 def try_to_allocate(orderid, sku, exceptions, session_factory):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -1,11 +1,16 @@
 # pylint: disable=redefined-outer-name
 from datetime import date
-from sqlalchemy.orm import clear_mappers
+from sqlalchemy import create_engine
+from sqlalchemy.orm import clear_mappers, sessionmaker
 from unittest import mock
 import pytest
 from allocation import bootstrap, views
-from allocation.domain import commands
+from allocation.adapters.orm import metadata
+from allocation.adapters.view_cache import InMemoryViewCache
+from allocation.domain import commands, events, model
 from allocation.service_layer import unit_of_work
+from allocation.service_layer.projector import PROJECTED_EVENTS, ReadModelProjector
+from .test_repository import counting_queries
 
 today = date.today()
 
@@ -22,6 +27,19 @@ def sqlite_bus(sqlite_session_factory):
     clear_mappers()
 
 
+@pytest.fixture
+def batching_sqlite_bus(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        batch_events=True,
+    )
+    yield bus
+    clear_mappers()
+
+
 def test_allocations_view(sqlite_bus):
     sqlite_bus.handle(commands.CreateBatch("sku1batch", "sku1", 50, None))
     sqlite_bus.handle(commands.CreateBatch("sku2batch", "sku2", 50, today))
@@ -47,3 +65,146 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
+
+
+def test_reallocation_cascade_with_batched_events(batching_sqlite_bus):
+    bus = batching_sqlite_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    for orderid in ["o1", "o2", "o3"]:
+        bus.handle(commands.Allocate(orderid, "sku1", 10))
+    bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+    batchrefs = [
+        views.allocations(o, bus.uow)[0]["batchref"] for o in ["o1", "o2", "o3"]
+    ]
+    assert sorted(batchrefs) == ["b1", "b2", "b2"]
+
+
+def test_cached_view_is_invalidated_by_reallocation(sqlite_session_factory):
+    cache = InMemoryViewCache()
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        view_cache=cache,
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+        bus.handle(commands.Allocate("o1", "sku1", 40))
+        assert views.allocations("o1", bus.uow, cache)[0]["batchref"] == "b1"
+        assert views.allocations("o1", bus.uow, cache)[0]["batchref"] == "b1"
+        assert cache.stats() == {"hits": 1, "misses": 1}
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+        assert views.allocations("o1", bus.uow, cache) == [
+            {"sku": "sku1", "batchref": "b2"},
+        ]
+    finally:
+        clear_mappers()
+
+
+@pytest.fixture
+def file_sqlite_db(tmp_path):
+    # the projector applies events on its own thread, which an in-memory
+    # database would give a database of its own
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    return engine
+
+
+def projecting_uow(engine):
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        sessionmaker(bind=engine), projected_event_types=PROJECTED_EVENTS
+    )
+
+
+@pytest.fixture
+def projecting_sqlite_bus(file_sqlite_db):
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=projecting_uow(file_sqlite_db),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        batch_projection=True,
+    )
+    yield bus
+    clear_mappers()
+
+
+def test_reallocation_cascade_is_projected_in_one_transaction(
+    projecting_sqlite_bus, file_sqlite_db
+):
+    bus = projecting_sqlite_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+    for orderid in ["o1", "o2", "o3"]:
+        bus.handle(commands.Allocate(orderid, "sku1", 10))
+
+    with counting_queries(file_sqlite_db) as statements:
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+    view_writes = [s for s in statements if "allocations_view" in s]
+
+    assert len(view_writes) == 2  # one DELETE and one INSERT, both executemany
+    batchrefs = [
+        views.allocations(o, bus.uow)[0]["batchref"] for o in ["o1", "o2", "o3"]
+    ]
+    assert sorted(batchrefs) == ["b1", "b2", "b2"]
+
+
+def test_projector_catches_up_with_changes_it_missed(
+    projecting_sqlite_bus, file_sqlite_db
+):
+    bus = projecting_sqlite_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.Allocate("o1", "sku1", 10))
+    # a crash loses buffered events: the write model moves on without them
+    with bus.uow:
+        product = bus.uow.products.get("sku1")
+        product.allocate(model.OrderLine("o2", "sku1", 10))
+        bus.uow.commit()
+    assert views.allocations("o2", bus.uow) == []
+
+    projector = ReadModelProjector(projecting_uow(file_sqlite_db))
+    assert projector.catch_up() == 1
+    assert projector.catch_up() == 0
+
+    assert views.allocations("o1", bus.uow) == [{"sku": "sku1", "batchref": "b1"}]
+    assert views.allocations("o2", bus.uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_events_the_projector_gives_up_on_are_caught_up_with(
+    projecting_sqlite_bus, file_sqlite_db
+):
+    bus = projecting_sqlite_bus
+    bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+    bus.handle(commands.Allocate("o1", "sku1", 10))
+    projector = ReadModelProjector(projecting_uow(file_sqlite_db), max_retries=0)
+    assert projector.catch_up() == 0
+
+    with bus.uow:
+        bus.uow.products.get("sku1").allocate(model.OrderLine("o2", "sku1", 10))
+        bus.uow.commit()
+    with mock.patch.object(projector.uow, "commit", side_effect=OSError):
+        projector.add(events.Allocated("o2", "sku1", 10, "b1"))
+        projector.flush()
+    assert views.allocations("o2", bus.uow) == []
+
+    assert projector.catch_up() == 1
+    assert views.allocations("o2", bus.uow) == [{"sku": "sku1", "batchref": "b1"}]
+
+
+def test_batch_projection_needs_a_unit_of_work_that_counts_events(
+    sqlite_session_factory,
+):
+    with pytest.raises(ValueError, match="projected_event_types"):
+        bootstrap.bootstrap(
+            start_orm=False,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+            notifications=mock.Mock(),
+            publish=lambda *args: None,
+            batch_projection=True,
+        )
@@ -0,0 +1,166 @@
+# pylint: disable=redefined-outer-name
+import json
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from allocation.adapters.orm import metadata
+from allocation.adapters import write_behind
+from allocation.adapters.write_behind import CommitLog, WriteBehindStore
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def file_session_factory(tmp_path):
+    # the store's writer runs in its own thread, so not an in-memory database
+    engine = create_engine(f"sqlite:///{tmp_path / 'allocation.db'}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "commits.log")
+
+
+def start_store(log_path, session_factory):
+    store = WriteBehindStore(log_path, session_factory, flush_interval=60)
+    store.start()
+    return store
+
+
+def allocations_in_database(session_factory, sku):
+    session = session_factory()
+    rows = session.execute(
+        "SELECT ol.orderid, b.reference FROM allocations"
+        " JOIN order_lines AS ol ON orderline_id = ol.id"
+        " JOIN batches AS b ON batch_id = b.id"
+        " WHERE b.sku = :sku ORDER BY ol.orderid",
+        dict(sku=sku),
+    )
+    return [tuple(row) for row in rows]
+
+
+def version_in_database(session_factory, sku):
+    session = session_factory()
+    return session.execute(
+        "SELECT version_number FROM products WHERE sku = :sku", dict(sku=sku)
+    ).scalar()
+
+
+def test_commits_reach_the_database_when_flushed(log_path, file_session_factory):
+    store = start_store(log_path, file_session_factory)
+    uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "LAMP", 100), uow)
+    handlers.allocate(commands.Allocate("o1", "LAMP", 10), uow)
+    handlers.allocate(commands.Allocate("o2", "LAMP", 10), uow)
+
+    assert version_in_database(file_session_factory, "LAMP") is None
+    with uow:
+        [batch] = uow.products.get("LAMP").batches
+        assert batch.available_quantity == 80
+
+    store.flush()
+    assert allocations_in_database(file_session_factory, "LAMP") == [
+        ("o1", "b1"),
+        ("o2", "b1"),
+    ]
+    assert version_in_database(file_session_factory, "LAMP") == 3
+    store.stop()
+
+
+def test_quantity_changes_and_deallocations_are_written(
+    log_path, file_session_factory
+):
+    store = start_store(log_path, file_session_factory)
+    uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "TABLE", 20), uow)
+    handlers.allocate(commands.Allocate("o1", "TABLE", 10), uow)
+    handlers.allocate(commands.Allocate("o2", "TABLE", 10), uow)
+    store.flush()
+
+    handlers.change_batch_quantity(commands.ChangeBatchQuantity("b1", 10), uow)
+    store.flush()
+
+    assert len(allocations_in_database(file_session_factory, "TABLE")) == 1
+    session = file_session_factory()
+    [[qty]] = session.execute("SELECT _purchased_quantity FROM batches")
+    assert qty == 10
+    store.stop()
+
+
+def test_unflushed_commits_are_replayed_on_restart(log_path, file_session_factory):
+    store = start_store(log_path, file_session_factory)
+    uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "CHAIR", 100), uow)
+    handlers.allocate(commands.Allocate("o1", "CHAIR", 10), uow)
+    # crash: nothing was flushed
+
+    restarted = start_store(log_path, file_session_factory)
+
+    assert allocations_in_database(file_session_factory, "CHAIR") == [("o1", "b1")]
+    uow = unit_of_work.WriteBehindUnitOfWork(restarted, file_session_factory)
+    handlers.allocate(commands.Allocate("o2", "CHAIR", 10), uow)
+    restarted.stop()
+    assert version_in_database(file_session_factory, "CHAIR") == 3
+
+
+def test_replaying_records_already_in_the_database_is_harmless(
+    log_path, file_session_factory, tmp_path
+):
+    store = start_store(log_path, file_session_factory)
+    uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "SOFA", 100), uow)
+    handlers.allocate(commands.Allocate("o1", "SOFA", 10), uow)
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    store._write_to_database(records)  # pylint: disable=protected-access
+    # crash: written to the database, but the checkpoint never was
+
+    start_store(log_path, file_session_factory).stop()
+
+    assert allocations_in_database(file_session_factory, "SOFA") == [("o1", "b1")]
+    assert not (tmp_path / "commits.log").read_text()
+
+
+def test_committing_a_stale_copy_is_a_conflict(log_path, file_session_factory):
+    store = start_store(log_path, file_session_factory)
+    uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    other_uow = unit_of_work.WriteBehindUnitOfWork(store, file_session_factory)
+    handlers.add_batch(commands.CreateBatch("b1", "LAMP", 100), uow)
+
+    with uow:
+        product = uow.products.get("LAMP")
+        handlers.allocate(commands.Allocate("o2", "LAMP", 10), other_uow)
+        product.allocate(model.OrderLine("o1", "LAMP", 10))
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            uow.commit()
+    store.stop()
+
+
+def test_the_log_is_compacted_up_to_what_has_been_written(log_path):
+    log = CommitLog(log_path, compact_bytes=1)
+    log.open()
+    for seq in range(1, 4):
+        log.write(dict(seq=seq, sku="LAMP", version=seq, changes=[]))
+    log.sync(3)
+
+    log.truncate(2)
+    log.write(dict(seq=4, sku="LAMP", version=4, changes=[]))
+    log.close()
+
+    assert [record["seq"] for record in CommitLog(log_path).open()] == [3, 4]
+
+
+def test_stores_for_one_log_are_shared(log_path, file_session_factory):
+    store = write_behind.shared_store(log_path, file_session_factory)
+    store.start()
+    try:
+        assert write_behind.shared_store(log_path, file_session_factory) is store
+        with pytest.raises(ValueError, match="another database"):
+            write_behind.shared_store(log_path, lambda: None)
+    finally:
+        store.stop()
+    assert write_behind.shared_store(log_path, file_session_factory) is not store
@@ -44,3 +44,17 @@ def test_allocation_is_idempotent():
     batch.allocate(line)
     batch.allocate(line)
     assert batch.available_quantity == 18
+
+
+def test_deallocating_restores_the_available_quantity():
+    batch, line = make_batch_and_line("SHINY-BOWL", 20, 2)
+    batch.allocate(line)
+    batch.deallocate(line)
+    assert batch.available_quantity == 20
+
+
+def test_changing_purchased_quantity_keeps_allocations():
+    batch, line = make_batch_and_line("SHINY-BOWL", 20, 2)
+    batch.allocate(line)
+    batch.change_purchased_quantity(10)
+    assert batch.available_quantity == 8
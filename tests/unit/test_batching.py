@@ -0,0 +1,76 @@
+import threading
+from allocation.adapters.batching import BatchWorker
+
+
+class FakeSender:
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, batch):
+        self.sending.set()
+        self.release.wait(timeout=5)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError()
+        self.batches.append(batch)
+
+
+def test_sends_full_batches_without_waiting_for_the_delay():
+    send = FakeSender()
+    worker = BatchWorker(send, "test", max_batch=2, max_delay=60)
+    worker.extend([1, 2, 3])
+    worker.flush()
+    assert send.batches == [[1, 2], [3]]
+
+
+def test_adding_never_waits_for_a_send():
+    send = FakeSender()
+    send.release.clear()
+    worker = BatchWorker(send, "test", max_batch=1, max_delay=60, max_buffer=1)
+    worker.add(1)
+    assert send.sending.wait(timeout=5)
+
+    assert worker.add(2)
+    assert not worker.add(3)
+
+    assert worker.dropped == 1
+    send.release.set()
+    worker.flush()
+    assert send.batches == [[1], [2]]
+
+
+def test_failed_batches_are_retried_in_order():
+    send = FakeSender(failures=2)
+    worker = BatchWorker(send, "test", max_batch=2, max_delay=0.01, max_retries=2)
+    worker.extend([1, 2, 3])
+    worker.flush()
+    assert send.batches == [[1, 2], [3]]
+    assert worker.dropped == 0
+
+
+def test_batches_are_dropped_after_their_retries():
+    send = FakeSender(failures=2)
+    worker = BatchWorker(send, "test", max_delay=0.01, max_retries=1)
+    worker.add(1)
+    worker.flush()
+    worker.add(2)
+    worker.flush()
+    assert send.batches == [[2]]
+    assert worker.dropped == 1
+
+
+def test_unsent_items_are_retried():
+    batches = []
+
+    def send(batch):
+        batches.append(batch)
+        return [item for item in batch if item == 2 and len(batches) == 1]
+
+    worker = BatchWorker(send, "test", max_delay=0.01)
+    worker.extend([1, 2])
+    worker.flush()
+    assert batches == [[1, 2], [2]]
@@ -1,12 +1,15 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
+import asyncio
+import threading
 from collections import defaultdict
+from dataclasses import dataclass
 from datetime import date
 from typing import Dict, List
 import pytest
 from allocation import bootstrap
-from allocation.domain import commands
-from allocation.service_layer import handlers
+from allocation.domain import commands, events, model
+from allocation.service_layer import handlers, messagebus
 from allocation.adapters import notifications, repository
 from allocation.service_layer import unit_of_work
 
@@ -19,10 +22,10 @@ class FakeRepository(repository.AbstractRepository):
     def _add(self, product):
         self._products.add(product)
 
-    def _get(self, sku):
+    def _get(self, sku, loading=None):
         return next((p for p in self._products if p.sku == sku), None)
 
-    def _get_by_batchref(self, batchref):
+    def _get_by_batchref(self, batchref, loading=None):
         return next(
             (p for p in self._products for b in p.batches if b.reference == batchref),
             None,
@@ -41,6 +44,19 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
         pass
 
 
+class ConflictingUnitOfWork(FakeUnitOfWork):
+    def __init__(self, conflicts):
+        super().__init__()
+        self.conflicts = conflicts
+        self.commits = 0
+
+    def _commit(self):
+        self.commits += 1
+        if self.commits <= self.conflicts:
+            raise unit_of_work.ConcurrencyConflict()
+        super()._commit()
+
+
 class FakeNotifications(notifications.AbstractNotifications):
     def __init__(self):
         self.sent = defaultdict(list)  # type: Dict[str, List[str]]
@@ -58,6 +74,16 @@ def bootstrap_test_app():
     )
 
 
+def bootstrap_async_test_app(notifications=None):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=notifications or FakeNotifications(),
+        publish=lambda *args: None,
+        asynchronous=True,
+    )
+
+
 class TestAddBatch:
     def test_for_new_product(self):
         bus = bootstrap_test_app()
@@ -110,6 +136,106 @@ class TestAllocate:
         ]
 
 
+class TestRetries:
+    def bootstrap_with(self, uow):
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+            retry_policy=messagebus.RetryPolicy(
+                attempts=3,
+                backoff=0,
+                retry_on=(unit_of_work.ConcurrencyConflict,),
+            ),
+        )
+
+    def test_retries_commands_after_a_conflict(self):
+        uow = ConflictingUnitOfWork(conflicts=2)
+        bus = self.bootstrap_with(uow)
+        bus.handle(commands.CreateBatch("b1", "CONTESTED-SOFA", 100, None))
+        assert uow.commits == 3
+        assert uow.committed
+
+    def test_gives_up_after_the_last_attempt(self):
+        uow = ConflictingUnitOfWork(conflicts=3)
+        bus = self.bootstrap_with(uow)
+        with pytest.raises(unit_of_work.ConcurrencyConflict):
+            bus.handle(commands.CreateBatch("b1", "CONTESTED-SOFA", 100, None))
+        assert uow.commits == 3
+
+    def test_does_not_retry_other_errors(self):
+        uow = ConflictingUnitOfWork(conflicts=0)
+        bus = self.bootstrap_with(uow)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+
+class TestAllocateMany:
+    def test_allocates_every_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "FANCY-CHAIR", 100, None))
+        bus.handle(commands.CreateBatch("b2", "FANCY-TABLE", 100, None))
+        bus.handle(
+            commands.AllocateMany(
+                "o1", [("FANCY-CHAIR", 10), ("FANCY-TABLE", 5), ("FANCY-CHAIR", 2)]
+            )
+        )
+        [chairs] = bus.uow.products.get("FANCY-CHAIR").batches
+        [tables] = bus.uow.products.get("FANCY-TABLE").batches
+        assert chairs.available_quantity == 88
+        assert tables.available_quantity == 95
+
+    def test_commits_once_for_all_lines(self):
+        uow = FakeUnitOfWork()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "FANCY-LAMP", 100, None))
+        uow.committed = False
+        handlers.allocate_many(
+            commands.AllocateMany("o1", [("FANCY-LAMP", 1), ("FANCY-LAMP", 2)]), uow
+        )
+        assert uow.committed
+        assert len(list(uow.collect_new_events())) == 2
+
+    def test_returns_each_lines_batchref(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "FANCY-LAMP", 5, None))
+        bus.handle(commands.CreateBatch("b2", "FANCY-LAMP", 5, date(2030, 1, 1)))
+        batchrefs = bus.handle(
+            commands.AllocateMany(
+                "o1", [("FANCY-LAMP", 4), ("FANCY-LAMP", 3), ("FANCY-LAMP", 6)]
+            )
+        )
+        assert batchrefs == ["b1", "b2", None]
+
+    def test_refuses_duplicate_lines(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "FANCY-LAMP", 100, None))
+
+        with pytest.raises(handlers.DuplicateLine, match="FANCY-LAMP x 4"):
+            bus.handle(
+                commands.AllocateMany("o1", [("FANCY-LAMP", 4), ("FANCY-LAMP", 4)])
+            )
+        [batch] = bus.uow.products.get("FANCY-LAMP").batches
+        assert batch.available_quantity == 100
+
+    def test_errors_for_invalid_sku_without_committing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
+        bus.uow.committed = False
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(
+                commands.AllocateMany("o1", [("AREALSKU", 1), ("NONEXISTENTSKU", 1)])
+            )
+        assert not bus.uow.committed
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -140,3 +266,169 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+def handle_command_emitting(emitted, handler, batch_events):
+    uow = FakeUnitOfWork()
+
+    def emit(cmd):
+        product = model.Product(cmd.sku, batches=[])
+        product.events.extend(emitted)
+        uow.products.add(product)
+
+    bus = messagebus.MessageBus(
+        uow=uow,
+        event_handlers={events.OutOfStock: [handler], events.Deallocated: []},
+        command_handlers={commands.Allocate: emit},
+        batch_events=batch_events,
+    )
+    bus.handle(commands.Allocate("o1", "sku1", 1))
+
+
+def batch_recorder(seen):
+    @handlers.handles_batches
+    def record(batch):
+        seen.append(batch)
+
+    return record
+
+
+class TestDispatch:
+    def test_events_are_handled_by_their_base_classes_handlers_too(self):
+        @dataclass
+        class UrgentOutOfStock(events.OutOfStock):
+            pass
+
+        seen = []
+        bus = messagebus.MessageBus(
+            uow=FakeUnitOfWork(),
+            event_handlers={
+                events.OutOfStock: [lambda e: seen.append("out of stock")],
+                UrgentOutOfStock: [lambda e: seen.append("urgent")],
+            },
+            command_handlers={},
+        )
+        bus.handle(UrgentOutOfStock("sku1"))
+        bus.handle(events.OutOfStock("sku1"))
+        assert seen == ["urgent", "out of stock", "out of stock"]
+
+    def test_dependencies_are_bound_once(self):
+        def handler(message, uow, notifications):
+            return message, uow, notifications
+
+        injected = bootstrap.inject_dependencies(
+            handler, {"uow": "the uow", "notifications": "notifs", "publish": None}
+        )
+        assert injected("msg") == ("msg", "the uow", "notifs")
+        assert injected.__wrapped__ is handler
+
+    def test_handlers_without_dependencies_are_used_as_they_are(self):
+        def handler(message):
+            pass
+
+        assert bootstrap.inject_dependencies(handler, {"uow": None}) is handler
+
+
+class TestBatchedEvents:
+    def test_batch_handlers_get_consecutive_events_of_one_type(self):
+        seen = []
+        handle_command_emitting(
+            [
+                events.OutOfStock("sku1"),
+                events.OutOfStock("sku2"),
+                events.Deallocated("o1", "sku1", 1),
+                events.OutOfStock("sku3"),
+            ],
+            batch_recorder(seen),
+            batch_events=True,
+        )
+        assert seen == [
+            [events.OutOfStock("sku1"), events.OutOfStock("sku2")],
+            [events.OutOfStock("sku3")],
+        ]
+
+    def test_plain_handlers_still_get_one_event_at_a_time(self):
+        seen = []
+        handle_command_emitting(
+            [events.OutOfStock("sku1"), events.OutOfStock("sku2")],
+            seen.append,
+            batch_events=True,
+        )
+        assert seen == [events.OutOfStock("sku1"), events.OutOfStock("sku2")]
+
+    def test_batch_handlers_get_singleton_lists_when_batching_is_off(self):
+        seen = []
+        handle_command_emitting(
+            [events.OutOfStock("sku1"), events.OutOfStock("sku2")],
+            batch_recorder(seen),
+            batch_events=False,
+        )
+        assert seen == [[events.OutOfStock("sku1")], [events.OutOfStock("sku2")]]
+
+
+class TestAsyncMessageBus:
+    def test_reallocates_if_necessary(self):
+        bus = bootstrap_async_test_app()
+        history = [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+            commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
+            commands.ChangeBatchQuantity("batch1", 25),
+        ]
+        for msg in history:
+            asyncio.run(bus.handle(msg))
+        [batch1, batch2] = bus.uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert batch1.available_quantity == 5
+        assert batch2.available_quantity == 30
+
+    def test_errors_for_invalid_sku(self):
+        bus = bootstrap_async_test_app()
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            asyncio.run(bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10)))
+
+    def test_awaits_async_adapters(self):
+        class AsyncFakeNotifications(FakeNotifications):
+            async def send(self, destination, message):
+                super().send(destination, message)
+
+        fake_notifs = AsyncFakeNotifications()
+        bus = bootstrap_async_test_app(fake_notifs)
+        asyncio.run(
+            bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        )
+        asyncio.run(bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10)))
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS",
+        ]
+
+    def test_retried_commands_only_raise_their_events_once(self):
+        published = []
+        uow = ConflictingUnitOfWork(conflicts=0)
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+            asynchronous=True,
+        )
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "LUMPY-SOFA", 10, None)))
+        uow.conflicts = uow.commits + 1
+        asyncio.run(bus.handle(commands.Allocate("o1", "LUMPY-SOFA", 1)))
+        assert published == [events.Allocated("o1", "LUMPY-SOFA", 1, "b1")]
+
+    def test_runs_handlers_for_one_event_concurrently(self):
+        both_running = threading.Barrier(2, timeout=1)
+        finished = []
+
+        def handler(event):
+            both_running.wait()
+            finished.append(event)
+
+        bus = messagebus.AsyncMessageBus(
+            uow=unit_of_work.AsyncUnitOfWork(FakeUnitOfWork()),
+            event_handlers={events.OutOfStock: [handler, handler]},
+            command_handlers={},
+        )
+        asyncio.run(bus.handle(events.OutOfStock("sku1")))
+        assert finished == [events.OutOfStock("sku1")] * 2
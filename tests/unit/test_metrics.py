@@ -0,0 +1,88 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import pytest
+from allocation import bootstrap
+from allocation.adapters.metrics import PrometheusMetrics
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+@pytest.fixture
+def metrics():
+    return PrometheusMetrics()
+
+
+def bootstrap_instrumented_app(metrics, asynchronous=False):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+        asynchronous=asynchronous,
+        metrics=metrics,
+    )
+
+
+def samples(metrics):
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in metrics.render().splitlines()
+        if not line.startswith("#")
+    }
+
+
+def test_counts_messages_and_times_handlers(metrics):
+    bus = bootstrap_instrumented_app(metrics)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Allocate("o1", "LAMP", 20))
+
+    found = samples(metrics)
+    assert found['allocation_messages_total{message_type="CreateBatch"}'] == 1
+    assert found['allocation_messages_total{message_type="OutOfStock"}'] == 1
+    labels = 'message_type="Allocate",handler="allocate"'
+    assert found[f"allocation_handler_duration_seconds_count{{{labels}}}"] == 1
+    assert (
+        found[f'allocation_handler_duration_seconds_bucket{{{labels},le="+Inf"}}']
+        == 1
+    )
+    assert found['allocation_uow_duration_seconds_count{operation="commit"}'] == 2
+    assert found["allocation_queue_depth_count"] == 3
+    assert 'allocation_uow_duration_seconds_count{operation="rollback"}' not in found
+
+
+def test_counts_handler_errors(metrics):
+    bus = bootstrap_instrumented_app(metrics)
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+    found = samples(metrics)
+    labels = 'message_type="Allocate",handler="allocate"'
+    assert found[f"allocation_handler_errors_total{{{labels}}}"] == 1
+    assert found['allocation_uow_duration_seconds_count{operation="rollback"}'] == 1
+
+
+def test_times_handlers_on_the_async_bus(metrics):
+    bus = bootstrap_instrumented_app(metrics, asynchronous=True)
+    asyncio.run(bus.handle(commands.CreateBatch("b1", "LAMP", 10)))
+    labels = 'message_type="CreateBatch",handler="add_batch"'
+    assert (
+        samples(metrics)[f"allocation_handler_duration_seconds_count{{{labels}}}"]
+        == 1
+    )
+
+
+def test_renders_collected_gauges(metrics):
+    metrics.add_collector("view_cache", lambda: {"hits": 3, "misses": 1})
+    found = samples(metrics)
+    assert found["allocation_view_cache_hits"] == 3
+    assert found["allocation_view_cache_misses"] == 1
+
+
+def test_handlers_are_not_wrapped_without_metrics():
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=lambda *args: None,
+    )
+    assert bus.command_handlers[commands.CreateBatch].func is handlers.add_batch
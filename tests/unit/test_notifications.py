@@ -0,0 +1,171 @@
+# pylint: disable=too-few-public-methods
+import smtplib
+import time
+import pytest
+from allocation.adapters import notifications
+
+
+class FakeSMTPConnection(notifications.AbstractNotifications):
+    def __init__(self, server):
+        self.server = server
+        self.alive = True
+        self.closed = False
+
+    def send(self, destination, message):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected()
+        if self.server.refusing:
+            raise smtplib.SMTPRecipientsRefused({destination: (550, b"no")})
+        self.server.sent.append((destination, message))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSMTPServer:
+    def __init__(self):
+        self.sent = []
+        self.connections = []
+        self.down = False
+        self.refusing = False
+
+    def connect(self):
+        connection = FakeSMTPConnection(self)
+        connection.alive = not self.down
+        self.connections.append(connection)
+        return connection
+
+    def drop_connections(self):
+        for connection in self.connections:
+            connection.alive = False
+
+
+def test_sends_immediately_without_a_digest_window():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0, connect=server.connect
+    )
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    assert server.sent == [("stock@made.com", "Out of stock for sku1")]
+
+
+def test_reuses_pooled_connections():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0, connect=server.connect
+    )
+    for _ in range(3):
+        notifs.send("stock@made.com", "Out of stock for sku1")
+    assert len(server.connections) == 1
+    assert len(server.sent) == 3
+
+
+def test_reconnects_if_the_server_dropped_the_connection():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0, connect=server.connect
+    )
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    server.drop_connections()
+    notifs.send("stock@made.com", "Out of stock for sku2")
+
+    assert len(server.connections) == 2
+    assert server.sent[-1] == ("stock@made.com", "Out of stock for sku2")
+
+
+def test_coalesces_repeated_messages_into_one_digest():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=60, connect=server.connect
+    )
+    for _ in range(100):
+        notifs.send("stock@made.com", "Out of stock for sku1")
+    notifs.send("stock@made.com", "Out of stock for sku2")
+    assert server.sent == []
+
+    notifs.flush()
+    assert server.sent == [
+        (
+            "stock@made.com",
+            "Out of stock for sku1 (x100)\nOut of stock for sku2",
+        )
+    ]
+
+
+def test_digest_goes_out_when_the_window_closes():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0.01, connect=server.connect
+    )
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    time.sleep(0.1)
+    assert server.sent == [("stock@made.com", "Out of stock for sku1")]
+
+
+def test_closes_connections_that_fail():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0, connect=server.connect
+    )
+    server.refusing = True
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        notifs.send("stock@made.com", "Out of stock for sku1")
+    server.refusing = False
+    notifs.send("stock@made.com", "Out of stock for sku1")
+
+    first, second = server.connections
+    assert first.closed and not second.closed
+
+
+def test_digest_is_tried_again_if_it_cannot_be_sent():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0.01, connect=server.connect, max_retries=100
+    )
+    server.refusing = True
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    deadline = time.monotonic() + 1
+    while not server.connections and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+    server.refusing = False
+    notifs.flush()
+    assert server.sent == [("stock@made.com", "Out of stock for sku1 (x2)")]
+
+
+def test_digest_is_dropped_after_max_retries():
+    server = FakeSMTPServer()
+    notifs = notifications.PooledEmailNotifications(
+        digest_window=0.01, connect=server.connect, max_retries=2
+    )
+    server.down = True
+    notifs.send("stock@made.com", "Out of stock for sku1")
+    notifs.flush()
+
+    assert server.sent == []
+    # each attempt connects, then reconnects once as that connection is dropped
+    assert len(server.connections) == 6
+    assert all(connection.closed for connection in server.connections)
+
+
+class FakeSMTP:
+    opened = []
+
+    def __init__(self, host, port):
+        self.opened.append((host, port))
+
+    def noop(self):
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        pass
+
+
+def test_email_notifications_only_connect_to_send(monkeypatch):
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    notifs = notifications.EmailNotifications("smtp.example.com", 25)
+    assert FakeSMTP.opened == []
+    notifs.send("someone@example.com", "hi")
+    notifs.send("someone@example.com", "hi again")
+    assert FakeSMTP.opened == [("smtp.example.com", 25)]
@@ -1,7 +1,6 @@
 from datetime import date, timedelta
 from allocation.domain import events
-from allocation.domain.model import Product, OrderLine, Batch
-
+from allocation.domain.model import Product, OrderLine, Batch, best_fit
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -72,3 +71,90 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_prefers_earlier_batches_added_after_first_allocation():
+    shipment = Batch("slow-batch", "TIDY-SHELF", 100, eta=later)
+    product = Product(sku="TIDY-SHELF", batches=[shipment])
+    product.allocate(OrderLine("order1", "TIDY-SHELF", 10))
+
+    in_stock = Batch("in-stock-batch", "TIDY-SHELF", 100, eta=None)
+    product.batches.append(in_stock)
+    allocation = product.allocate(OrderLine("order2", "TIDY-SHELF", 10))
+
+    assert allocation == in_stock.reference
+
+
+def test_prefers_earlier_batches_that_replaced_others():
+    shipment = Batch("slow-batch", "TIDY-SHELF", 100, eta=later)
+    product = Product(sku="TIDY-SHELF", batches=[shipment])
+    product.allocate(OrderLine("order1", "TIDY-SHELF", 10))
+
+    in_stock = Batch("in-stock-batch", "TIDY-SHELF", 100, eta=None)
+    product.batches[0] = in_stock
+    allocation = product.allocate(OrderLine("order2", "TIDY-SHELF", 10))
+
+    assert allocation == in_stock.reference
+
+
+def test_skips_batches_exhausted_by_earlier_allocations():
+    earliest = Batch("speedy-batch", "DAINTY-CUP", 10, eta=today)
+    medium = Batch("normal-batch", "DAINTY-CUP", 100, eta=tomorrow)
+    product = Product(sku="DAINTY-CUP", batches=[medium, earliest])
+
+    first = product.allocate(OrderLine("order1", "DAINTY-CUP", 10))
+    second = product.allocate(OrderLine("order2", "DAINTY-CUP", 10))
+
+    assert first == earliest.reference
+    assert second == medium.reference
+
+
+def test_change_batch_quantity_deallocates_until_batch_is_not_overallocated():
+    batch = Batch("batch1", "GAUDY-VASE", 30, eta=None)
+    product = Product(sku="GAUDY-VASE", batches=[batch])
+    for orderid in ["o1", "o2", "o3"]:
+        product.allocate(OrderLine(orderid, "GAUDY-VASE", 10))
+
+    product.change_batch_quantity("batch1", 15)
+
+    assert batch.available_quantity == 5
+    assert [type(e) for e in list(product.events)[-4:]] == [
+        events.Deallocated,
+        events.Deallocated,
+        events.OutOfStock,
+        events.OutOfStock,
+    ]
+
+
+def test_change_batch_quantity_reallocates_displaced_lines_in_one_version():
+    batch = Batch("batch1", "GAUDY-VASE", 30, eta=None)
+    later_batch = Batch("batch2", "GAUDY-VASE", 30, eta=tomorrow)
+    product = Product(sku="GAUDY-VASE", batches=[batch, later_batch])
+    for orderid in ["o1", "o2", "o3"]:
+        product.allocate(OrderLine(orderid, "GAUDY-VASE", 10))
+    product.events.clear()
+
+    product.change_batch_quantity("batch1", 10)
+
+    assert product.version_number == 4
+    assert batch.available_quantity == 0
+    assert later_batch.available_quantity == 10
+    assert list(product.events) == [
+        events.Deallocated("o3", "GAUDY-VASE", 10),
+        events.Deallocated("o1", "GAUDY-VASE", 10),
+        events.Allocated("o3", "GAUDY-VASE", 10, "batch2"),
+        events.Allocated("o1", "GAUDY-VASE", 10, "batch2"),
+    ]
+
+
+def test_best_fit_moves_as_few_lines_as_possible():
+    lines = [
+        OrderLine("small", "SKU", 2),
+        OrderLine("medium", "SKU", 5),
+        OrderLine("large", "SKU", 20),
+    ]
+
+    assert best_fit(lines, 4) == [lines[1]]
+    assert best_fit(lines, 5) == [lines[1]]
+    assert best_fit(lines, 21) == [lines[2], lines[0]]
+    assert best_fit(lines, 100) == [lines[2], lines[1], lines[0]]
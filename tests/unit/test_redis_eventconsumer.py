@@ -0,0 +1,215 @@
+# pylint: disable=too-few-public-methods
+import json
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+
+
+class FakeStreamRedis:
+    def __init__(self, payloads):
+        self.messages = [
+            (f"{i}-0".encode(), {b"data": json.dumps(payload).encode()})
+            for i, payload in enumerate(payloads)
+        ]
+        self.pending = {}  # message id: [fields, consumer, deliveries]
+        self.acked = []
+        self.added = []
+        self.hashes = {}
+        self.locked = set()
+
+    def xreadgroup(self, group, consumer, streams, count, block):
+        if streams[redis_eventconsumer.STREAM] == ">":
+            batch, self.messages = self.messages[:count], self.messages[count:]
+        else:
+            batch = [
+                (message_id, fields)
+                for message_id, (fields, owner, _) in self.pending.items()
+                if owner == consumer
+            ][:count]
+        for message_id, fields in batch:
+            entry = self.pending.setdefault(message_id, [fields, consumer, 0])
+            entry[2] += 1
+        return [[b"change_batch_quantity", batch]] if batch else []
+
+    def xack(self, stream, group, *message_ids):
+        for message_id in message_ids:
+            del self.pending[message_id]
+        self.acked.extend(message_ids)
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, count):
+        # everything pending counts as idle
+        claimed = list(self.pending.items())[:count]
+        for _, entry in claimed:
+            entry[1] = consumer
+            entry[2] += 1
+        return [b"0-0", [(message_id, entry[0]) for message_id, entry in claimed], []]
+
+    def xpending_range(self, stream, group, min, max, count, consumername):
+        # pylint: disable=redefined-builtin
+        return [
+            dict(message_id=message_id, consumer=owner, times_delivered=deliveries)
+            for message_id, (_, owner, deliveries) in self.pending.items()
+            if owner == consumername
+        ][:count]
+
+    def xadd(self, stream, fields):
+        self.added.append((stream, fields))
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(key)
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, {})[key] = value
+
+    def lock(self, name, timeout):
+        return FakeLock(self.locked, name)
+
+
+class FakeLock:
+    def __init__(self, locked, name):
+        self.locked = locked
+        self.name = name
+
+    def acquire(self, blocking):
+        if self.name in self.locked:
+            return False
+        self.locked.add(self.name)
+        return True
+
+    def release(self):
+        self.locked.remove(self.name)
+
+
+class FakeBus:
+    def __init__(self, failing_refs=()):
+        self.handled = []
+        self.failing_refs = failing_refs
+
+    def handle(self, message):
+        if message.ref in self.failing_refs:
+            raise Exception("oops")
+        self.handled.append(message)
+
+
+def test_coalesces_changes_to_the_same_batch_into_the_last_one():
+    fake_redis = FakeStreamRedis(
+        [
+            {"batchref": "b1", "qty": 10},
+            {"batchref": "b2", "qty": 20},
+            {"batchref": "b1", "qty": 5},
+        ]
+    )
+    bus = FakeBus()
+    redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+
+    assert bus.handled == [
+        commands.ChangeBatchQuantity("b1", 5),
+        commands.ChangeBatchQuantity("b2", 20),
+    ]
+    assert sorted(fake_redis.acked) == [b"0-0", b"1-0", b"2-0"]
+
+
+def test_does_not_ack_messages_whose_handling_failed():
+    fake_redis = FakeStreamRedis(
+        [{"batchref": "b1", "qty": 10}, {"batchref": "b2", "qty": 20}]
+    )
+    bus = FakeBus(failing_refs=["b1"])
+    redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+
+    assert fake_redis.acked == [b"1-0"]
+
+
+def test_counts_only_the_entries_it_acked():
+    fake_redis = FakeStreamRedis(
+        [{"batchref": "b1", "qty": 10}, {"batchref": "b2", "qty": 20}]
+    )
+    bus = FakeBus(failing_refs=["b1", "b2"])
+    acked = redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+    assert acked == 0
+
+    # so consume() moves on from its own pending entries that keep failing
+    acked = redis_eventconsumer.consume_batch(
+        bus, "consumer-1", last_id="0", client=fake_redis
+    )
+    assert acked == 0
+
+
+def test_reclaims_entries_that_another_consumer_left_pending():
+    fake_redis = FakeStreamRedis([{"batchref": "b1", "qty": 10}])
+    redis_eventconsumer.consume_batch(
+        FakeBus(failing_refs=["b1"]), "dead-consumer", client=fake_redis
+    )
+    bus = FakeBus()
+    redis_eventconsumer.reclaim(bus, "consumer-2", client=fake_redis)
+
+    assert bus.handled == [commands.ChangeBatchQuantity("b1", 10)]
+    assert fake_redis.acked == [b"0-0"]
+
+
+def test_dead_letters_entries_after_max_deliveries():
+    fake_redis = FakeStreamRedis([{"batchref": "b1", "qty": 10}])
+    bus = FakeBus(failing_refs=["b1"])
+    redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+    for _ in range(redis_eventconsumer.MAX_DELIVERIES):
+        redis_eventconsumer.reclaim(bus, "consumer-1", client=fake_redis)
+
+    assert fake_redis.acked == [b"0-0"]
+    [(stream, fields)] = fake_redis.added
+    assert stream == redis_eventconsumer.DEAD_LETTERS
+    assert fields["id"] == b"0-0"
+    assert fields["deliveries"] == redis_eventconsumer.MAX_DELIVERIES + 1
+    assert json.loads(fields[b"data"]) == {"batchref": "b1", "qty": 10}
+
+
+def test_dead_letters_malformed_entries_and_handles_the_rest():
+    fake_redis = FakeStreamRedis([{"batchref": "b1", "qty": 10}])
+    fake_redis.messages += [
+        (b"1-0", {b"data": b"not json"}),
+        (b"2-0", {b"other": b"field"}),
+        (b"3-0", {b"data": json.dumps({"batchref": "b2"}).encode()}),
+    ]
+    bus = FakeBus()
+    acked = redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+
+    assert acked == 4
+    assert bus.handled == [commands.ChangeBatchQuantity("b1", 10)]
+    assert [fields["id"] for _, fields in fake_redis.added] == [
+        b"1-0",
+        b"2-0",
+        b"3-0",
+    ]
+
+
+def test_dead_letters_reclaimed_entries_that_were_deleted():
+    fake_redis = FakeStreamRedis([])
+    fake_redis.pending[b"0-0"] = [None, "dead-consumer", 1]
+    redis_eventconsumer.reclaim(FakeBus(), "consumer-2", client=fake_redis)
+
+    assert fake_redis.acked == [b"0-0"]
+    [(stream, fields)] = fake_redis.added
+    assert stream == redis_eventconsumer.DEAD_LETTERS
+    assert fields["id"] == b"0-0"
+
+
+def test_skips_changes_older_than_the_last_one_applied_to_the_batch():
+    fake_redis = FakeStreamRedis(
+        [{"batchref": "b1", "qty": 10}, {"batchref": "b2", "qty": 20}]
+    )
+    fake_redis.hset(redis_eventconsumer.APPLIED, "b1", b"5-0")
+    bus = FakeBus()
+    redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+
+    assert bus.handled == [commands.ChangeBatchQuantity("b2", 20)]
+    assert sorted(fake_redis.acked) == [b"0-0", b"1-0"]
+    assert fake_redis.hget(redis_eventconsumer.APPLIED, "b1") == b"5-0"
+    assert fake_redis.hget(redis_eventconsumer.APPLIED, "b2") == b"1-0"
+
+
+def test_leaves_changes_pending_while_another_consumer_applies_one_to_the_batch():
+    fake_redis = FakeStreamRedis([{"batchref": "b1", "qty": 10}])
+    fake_redis.locked.add(f"{redis_eventconsumer.STREAM}.lock:b1")
+    bus = FakeBus()
+    acked = redis_eventconsumer.consume_batch(bus, "consumer-1", client=fake_redis)
+
+    assert acked == 0
+    assert bus.handled == []
+    assert list(fake_redis.pending) == [b"0-0"]
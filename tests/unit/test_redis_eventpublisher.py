@@ -0,0 +1,181 @@
+# pylint: disable=too-few-public-methods
+import asyncio
+import json
+import threading
+import time
+from allocation import bootstrap
+from allocation.adapters import redis_eventpublisher
+from allocation.adapters.redis_eventpublisher import BufferedPublisher
+from allocation.domain import commands, events
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class FakeRedis:
+    def __init__(self, fail_times=0):
+        self.published = []
+        self.round_trips = 0
+        self.fail_times = fail_times
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, fake_redis):
+        self.fake_redis = fake_redis
+        self.commands = []
+
+    def publish(self, channel, message):
+        self.commands.append((channel, json.loads(message)["orderid"]))
+
+    def execute(self):
+        if self.fake_redis.fail_times:
+            self.fake_redis.fail_times -= 1
+            raise ConnectionError()
+        self.fake_redis.round_trips += 1
+        self.fake_redis.published.extend(self.commands)
+
+
+class SlowRedis(FakeRedis):
+    # whose first round trip waits until released
+    def __init__(self):
+        super().__init__()
+        self.executing = threading.Event()
+        self.release = threading.Event()
+
+    def pipeline(self, transaction=True):
+        pipe = super().pipeline(transaction)
+        execute = pipe.execute
+
+        def wait_then_execute():
+            self.executing.set()
+            self.release.wait(2)
+            execute()
+
+        pipe.execute = wait_then_execute
+        return pipe
+
+
+def allocated(orderid):
+    return events.Allocated(orderid, "sku1", 1, "b1")
+
+
+def eventually(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+def test_flushes_a_full_buffer_in_one_round_trip_in_order():
+    fake_redis = FakeRedis()
+    publish = BufferedPublisher(fake_redis, max_buffer=3, max_delay=60)
+    for orderid in ["o1", "o2", "o3"]:
+        publish("line_allocated", allocated(orderid))
+
+    assert eventually(lambda: fake_redis.round_trips == 1)
+    assert fake_redis.published == [
+        ("line_allocated", "o1"),
+        ("line_allocated", "o2"),
+        ("line_allocated", "o3"),
+    ]
+
+
+def test_flushes_a_partial_buffer_after_max_delay():
+    fake_redis = FakeRedis()
+    publish = BufferedPublisher(fake_redis, max_buffer=100, max_delay=0.01)
+    publish("line_allocated", allocated("o1"))
+    assert fake_redis.published == []
+
+    assert eventually(lambda: fake_redis.published == [("line_allocated", "o1")])
+
+
+def test_retries_events_in_order_if_redis_fails():
+    fake_redis = FakeRedis(fail_times=1)
+    publish = BufferedPublisher(fake_redis, max_buffer=100, max_delay=0.01)
+    publish("line_allocated", allocated("o1"))
+    publish.flush()
+    publish("line_allocated", allocated("o2"))
+    publish.flush()
+
+    assert fake_redis.published == [
+        ("line_allocated", "o1"),
+        ("line_allocated", "o2"),
+    ]
+
+
+def test_is_flushed_when_the_bus_has_handled_a_message():
+    fake_redis = FakeRedis()
+    publish = BufferedPublisher(fake_redis, max_buffer=100, max_delay=60)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=publish,
+    )
+    bus.handle(commands.CreateBatch("b1", "sku1", 100, None))
+    assert fake_redis.published == []
+
+    bus.handle(commands.Allocate("o1", "sku1", 10))
+    assert eventually(lambda: fake_redis.published == [("line_allocated", "o1")])
+
+    bus.handle(commands.Allocate("o2", "sku1", 10))
+    assert eventually(
+        lambda: fake_redis.published
+        == [("line_allocated", "o1"), ("line_allocated", "o2")]
+    )
+
+
+def test_gives_up_on_events_redis_keeps_refusing():
+    fake_redis = FakeRedis(fail_times=2)
+    publish = BufferedPublisher(
+        fake_redis, max_buffer=100, max_delay=0.01, max_retries=1
+    )
+    publish("line_allocated", allocated("o1"))
+    publish.flush()
+    publish("line_allocated", allocated("o2"))
+    publish.flush()
+
+    assert fake_redis.published == [("line_allocated", "o2")]
+
+
+def test_publishing_does_not_wait_for_redis():
+    fake_redis = SlowRedis()
+    publish = BufferedPublisher(fake_redis, max_buffer=1, max_delay=60)
+    started = time.monotonic()
+    publish("line_allocated", allocated("o1"))
+    assert fake_redis.executing.wait(1)
+    publish("line_allocated", allocated("o2"))
+    assert time.monotonic() - started < 0.5
+
+    fake_redis.release.set()
+    publish.flush()
+
+    assert fake_redis.published == [
+        ("line_allocated", "o1"),
+        ("line_allocated", "o2"),
+    ]
+
+
+def test_drops_events_past_max_pending_while_redis_is_slow():
+    fake_redis = SlowRedis()
+    publish = BufferedPublisher(fake_redis, max_buffer=1, max_delay=60, max_pending=1)
+    publish("line_allocated", allocated("o1"))
+    assert fake_redis.executing.wait(1)
+    publish("line_allocated", allocated("o2"))
+    publish("line_allocated", allocated("o3"))
+
+    fake_redis.release.set()
+    publish.flush()
+    assert fake_redis.published == [
+        ("line_allocated", "o1"),
+        ("line_allocated", "o2"),
+    ]
+
+
+def test_async_clients_are_not_shared_between_event_loops():
+    async def client():
+        return redis_eventpublisher.get_async_client()
+
+    first, again = asyncio.run(client()), asyncio.run(client())
+    assert first is not again
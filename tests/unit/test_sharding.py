@@ -0,0 +1,67 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from allocation import bootstrap
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, sharding
+from .test_handlers import FakeUnitOfWork, bootstrap_test_app
+
+# spread over all three workers
+SKUS = ("LAMP", "BED", "MIRROR", "STOOL")
+
+
+@pytest.fixture
+def lookup_uow():
+    return FakeUnitOfWork()
+
+
+@pytest.fixture
+def dispatcher(lookup_uow):
+    dispatcher = bootstrap.bootstrap_sharded(
+        start_orm=False, processes=3, uow=lookup_uow, bus_factory=bootstrap_test_app
+    )
+    yield dispatcher
+    dispatcher.close()
+
+
+def test_commands_for_a_sku_always_reach_the_same_worker(dispatcher):
+    # each worker has its own fake unit of work, so allocating only works
+    # in the worker that created the batch
+    for sku in SKUS:
+        dispatcher.handle(commands.CreateBatch(f"{sku}-b1", sku, 100))
+    for sku in SKUS:
+        dispatcher.handle(commands.Allocate("o1", sku, 10))
+
+
+def test_errors_from_workers_are_raised_to_the_caller(dispatcher):
+    with pytest.raises(handlers.InvalidSku, match="NONEXISTENTSKU"):
+        dispatcher.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+
+def test_batch_quantity_changes_are_routed_by_the_batchs_sku(dispatcher, lookup_uow):
+    # only the worker that created a batch knows it, so a change sent to any
+    # other worker would fail for want of the batch
+    refs = {sku: f"{sku}-b1" for sku in SKUS}
+    assert any(dispatcher.shard_for(refs[s]) != dispatcher.shard_for(s) for s in SKUS)
+    for sku in SKUS:
+        lookup_uow.products.add(
+            model.Product(sku, [model.Batch(refs[sku], sku, 100, None)])
+        )
+        dispatcher.handle(commands.CreateBatch(refs[sku], sku, 100))
+
+    for sku in SKUS:
+        dispatcher.handle(commands.ChangeBatchQuantity(refs[sku], 50))
+
+
+def test_callers_are_told_when_a_worker_dies(dispatcher):
+    shard = dispatcher.shard_for("LAMP")
+    dispatcher._workers[shard].terminate()  # pylint: disable=protected-access
+
+    with pytest.raises(sharding.WorkerDied, match=f"shard {shard}"):
+        dispatcher.handle(commands.Allocate("o1", "LAMP", 10), timeout=5)
+    other = next(sku for sku in SKUS if dispatcher.shard_for(sku) != shard)
+    dispatcher.handle(commands.CreateBatch("b1", other, 100), timeout=5)
+
+
+def test_commands_spanning_skus_are_not_sharded(dispatcher):
+    with pytest.raises(TypeError):
+        dispatcher.submit(commands.AllocateMany("o1", [("LAMP", 1), ("TABLE", 1)]))
@@ -0,0 +1,181 @@
+# pylint: disable=redefined-outer-name
+import asyncio
+import json
+import threading
+import pytest
+from allocation import bootstrap
+from allocation.adapters import redis_eventpublisher, tracing
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+REMOTE = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+class FakeSpanExporter(tracing.AbstractSpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def named(self, name):
+        return next(span for span in self.spans if span.name == name)
+
+
+@pytest.fixture
+def exporter():
+    return FakeSpanExporter()
+
+
+@pytest.fixture
+def tracer(exporter):
+    return tracing.Tracer(exporter)
+
+
+def bootstrap_traced_app(tracer, published, asynchronous=False):
+    def publish(channel, event):
+        published.append(json.loads(redis_eventpublisher.serialize(event)))
+
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=FakeNotifications(),
+        publish=publish,
+        asynchronous=asynchronous,
+        tracer=tracer,
+    )
+
+
+def test_handlers_and_commits_are_spans_of_the_callers_trace(tracer, exporter):
+    bus = bootstrap_traced_app(tracer, [])
+    with tracer.span("request") as request:
+        bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+        bus.handle(commands.Allocate("o1", "LAMP", 2))
+
+    allocate = exporter.named("allocate")
+    assert allocate.parent_id == request.span_id
+    assert allocate.attributes["message_type"] == "Allocate"
+    assert exporter.named("publish_allocated_event").parent_id == request.span_id
+    commits = [span for span in exporter.spans if span.name == "uow.commit"]
+    assert allocate.span_id in {span.parent_id for span in commits}
+    assert {span.trace_id for span in exporter.spans} == {request.trace_id}
+
+
+def test_published_events_carry_the_publishing_span(tracer, exporter):
+    published = []
+    bus = bootstrap_traced_app(tracer, published)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Allocate("o1", "LAMP", 2))
+
+    [message] = published
+    assert message["orderid"] == "o1"
+    assert (
+        message["traceparent"]
+        == exporter.named("publish_allocated_event").traceparent
+    )
+
+
+def test_events_are_published_without_a_traceparent_outside_a_trace():
+    published = []
+    bus = bootstrap_traced_app(None, published)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Allocate("o1", "LAMP", 2))
+    assert "traceparent" not in published[0]
+
+
+def test_async_handlers_are_spans_of_the_callers_trace(tracer, exporter):
+    bus = bootstrap_traced_app(tracer, [], asynchronous=True)
+
+    async def request():
+        with tracer.span("request") as span:
+            await bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+        return span
+
+    request_span = asyncio.run(request())
+    assert exporter.named("add_batch").parent_id == request_span.span_id
+
+
+def test_stream_messages_continue_the_trace_they_were_sent_from(tracer, exporter):
+    bus = bootstrap_traced_app(tracer, [])
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    exporter.spans.clear()
+
+    redis_eventconsumer.handle_change_batch_quantity(
+        commands.ChangeBatchQuantity("b1", 5), bus, tracer, REMOTE
+    )
+
+    root = exporter.named("consume change_batch_quantity")
+    assert root.traceparent.startswith("00-0af7651916cd43dd8448eb211c80319c-")
+    assert root.parent_id == "b7ad6b7169203331"
+    assert root.attributes["batchref"] == "b1"
+    assert exporter.named("change_batch_quantity").parent_id == root.span_id
+    assert {span.trace_id for span in exporter.spans} == {root.trace_id}
+
+
+def test_failures_are_recorded_on_the_span(tracer, exporter):
+    bus = bootstrap_traced_app(tracer, [])
+    with pytest.raises(Exception):
+        bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+    assert "NONEXISTENTSKU" in exporter.named("allocate").error
+
+
+def test_file_exporter_writes_zipkin_spans(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    exporter = tracing.FileSpanExporter(str(path), max_batch=2)
+    tracer = tracing.Tracer(exporter)
+    with tracer.span("parent"):
+        with tracer.span("child", sku="LAMP"):
+            pass
+    exporter.flush()
+
+    child, parent = [json.loads(line) for line in path.read_text().splitlines()]
+    assert child["parentId"] == parent["id"]
+    assert child["traceId"] == parent["traceId"]
+    assert child["tags"] == {"sku": "LAMP"}
+    assert child["localEndpoint"] == {"serviceName": "allocation"}
+
+
+class BlockingSpanExporter(tracing.BatchingSpanExporter):
+    def __init__(self, **kwargs):
+        super().__init__("allocation", **kwargs)
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.sent = []
+
+    def _send(self, spans):
+        self.sending.set()
+        self.release.wait(timeout=5)
+        self.sent.append([span["name"] for span in spans])
+
+
+def test_exporting_never_waits_for_the_collector():
+    exporter = BlockingSpanExporter(max_batch=1, max_queued=1)
+    tracer = tracing.Tracer(exporter)
+    with tracer.span("sending"):
+        pass
+    assert exporter.sending.wait(timeout=5)
+
+    for name in ("queued", "dropped"):
+        with tracer.span(name):
+            pass
+
+    assert exporter.dropped == 1
+    exporter.release.set()
+    exporter.flush()
+    assert exporter.sent == [["sending"], ["queued"]]
+
+
+class FailingSpanExporter(tracing.BatchingSpanExporter):
+    def _send(self, spans):
+        raise ConnectionError()
+
+
+def test_spans_the_collector_fails_to_take_are_dropped():
+    exporter = FailingSpanExporter("allocation", max_batch=2)
+    tracer = tracing.Tracer(exporter)
+    for name in ("first", "second", "third"):
+        with tracer.span(name):
+            pass
+    exporter.flush()
+    assert exporter.dropped == 3
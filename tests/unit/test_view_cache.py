@@ -0,0 +1,75 @@
+import time
+from allocation.adapters.view_cache import InMemoryViewCache, TieredViewCache
+
+ROWS = [{"sku": "sku1", "batchref": "b1"}]
+
+
+def cache_rows(cache, orderid, rows=ROWS):
+    cache.set(orderid, rows, cache.generation(orderid))
+
+
+def test_counts_hits_and_misses():
+    cache = InMemoryViewCache()
+    assert cache.get("o1") is None
+    cache_rows(cache, "o1")
+    assert cache.get("o1") == ROWS
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_evicts_least_recently_used():
+    cache = InMemoryViewCache(max_size=2)
+    cache_rows(cache, "o1")
+    cache_rows(cache, "o2")
+    cache.get("o1")
+    cache_rows(cache, "o3")
+    assert cache.get("o2") is None
+    assert cache.get("o1") == ROWS
+
+
+def test_entries_expire():
+    cache = InMemoryViewCache(ttl=0.01)
+    cache_rows(cache, "o1")
+    time.sleep(0.05)
+    assert cache.get("o1") is None
+
+
+def test_tiered_cache_fills_the_local_tier_from_the_shared_one():
+    local, shared = InMemoryViewCache(), InMemoryViewCache()
+    cache_rows(shared, "o1")
+    cache = TieredViewCache(local, shared)
+    assert cache.get("o1") == ROWS
+    assert local.get("o1") == ROWS
+
+    cache.invalidate("o1")
+    assert cache.get("o1") is None
+    assert shared.get("o1") is None
+
+
+def test_rows_read_before_an_invalidation_are_not_cached():
+    cache = InMemoryViewCache()
+    generation = cache.generation("o1")
+    cache.invalidate("o1")
+    cache.set("o1", ROWS, generation)
+    assert cache.get("o1") is None
+
+    cache_rows(cache, "o1")
+    assert cache.get("o1") == ROWS
+
+
+def test_invalidations_outlive_their_eviction():
+    cache = InMemoryViewCache(max_size=1)
+    generation = cache.generation("o1")
+    cache.invalidate("o1")
+    cache.invalidate("o2")
+    cache.set("o1", ROWS, generation)
+    assert cache.get("o1") is None
+
+
+def test_tiered_cache_drops_rows_invalidated_while_they_were_read():
+    local, shared = InMemoryViewCache(), InMemoryViewCache()
+    cache = TieredViewCache(local, shared)
+    generation = cache.generation("o1")
+    cache.invalidate("o1")
+    cache.set("o1", ROWS, generation)
+    assert local.get("o1") is None
+    assert shared.get("o1") is None